@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Sources sous forme d'archive (tar, tar.gz, tar.bz2, tar.xz, tar.zst, zip), lues en flux:
+pas d'extraction préalable sur le disque local.
+
+L'archive est décompressée et lue une seule fois par un thread dédié, qui distribue les entrées
+et leurs données à un ou plusieurs consommateurs (un par support écrit), chacun par une file
+bornée. Le consommateur le plus lent règle le rythme de la lecture.
+"""
+
+from typing import Any, Iterator, List, Optional, Set, Union
+import os
+import queue
+import signal
+import stat
+import subprocess
+import tarfile
+import threading
+import time
+import zipfile
+
+from copier import IOLimits, DEFAULT_CHUNK_SIZE
+from utils import get_logger, popen_command
+
+
+logger = get_logger("archive", "INFO")
+
+TAR_SUFFIXES = [".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz"]
+ZSTD_SUFFIXES = [".tar.zst", ".tzst"]
+ZIP_SUFFIXES = [".zip"]
+ARCHIVE_SUFFIXES = TAR_SUFFIXES + ZSTD_SUFFIXES + ZIP_SUFFIXES
+QUEUE_CHUNKS = 16 # blocs en attente par consommateur
+PUT_TIMEOUT = 0.5 # secondes, pour remarquer un consommateur détaché
+
+# kinds
+FILE, DIR, SYMLINK, HARDLINK = "file", "dir", "symlink", "hardlink"
+
+
+class ArchiveError(Exception):
+    """Archive illisible ou corrompue
+    """
+
+class _NoConsumers(Exception):
+    """Tous les consommateurs se sont détachés: inutile de poursuivre la lecture
+    """
+
+
+def is_archive(path: str) -> bool:
+    return os.path.isfile(path) and any(path.lower().endswith(suffix) for suffix in ARCHIVE_SUFFIXES)
+
+
+def archive_manifest(path: str) -> str:
+    """Identité de l'archive pour le cache d'images: chemin, taille et date suffisent,
+    une archive n'est pas modifiée en place
+    """
+    st = os.stat(path)
+
+    return "{}\0{}\0{}".format(os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+
+def archive_file_sizes(path: str) -> Optional[List[int]]:
+    """Tailles des fichiers de l'archive si elles sont lisibles sans décompresser (zip),
+    'None' sinon (tar: il faudrait lire toute l'archive)
+    """
+    if not path.lower().endswith(tuple(ZIP_SUFFIXES)):
+        return None
+
+    with zipfile.ZipFile(path) as zf:
+        return [info.file_size for info in zf.infolist() if not info.is_dir()]
+
+
+def safe_path(name: str) -> Optional[str]:
+    """Chemin relatif normalisé ('.' pour la racine), 'None' s'il sortirait de la destination
+    """
+    path = os.path.normpath(name.lstrip("/") or os.curdir)
+
+    if path == os.pardir or path.startswith(os.pardir + os.sep):
+        return None
+
+    return path
+
+
+class ArchiveEntry:
+    """Entrée d'une archive. Les données d'un fichier suivent l'entrée dans le flux
+    """
+    __slots__ = ("path", "kind", "mode", "uid", "gid", "mtime", "size", "linkname")
+
+    def __init__(self, path: str, kind: str, mode: int, uid: int=0, gid: int=0, mtime: float=0.0, size: int=0, linkname: str="") -> None:
+        self.path = path
+        self.kind = kind
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.mtime = mtime
+        self.size = size
+        self.linkname = linkname
+
+
+    def stat(self) -> os.stat_result:
+        """stat_result équivalent, pour appliquer une PermPolicy comme pour un fichier local
+        """
+        fmt = {DIR: stat.S_IFDIR, SYMLINK: stat.S_IFLNK}.get(self.kind, stat.S_IFREG)
+        mtime_ns = int(self.mtime * 10**9)
+
+        return os.stat_result((fmt | stat.S_IMODE(self.mode), 0, 0, 1, self.uid, self.gid, self.size, int(self.mtime), int(self.mtime), int(self.mtime)), {"st_atime_ns": mtime_ns, "st_mtime_ns": mtime_ns})
+
+
+    def __repr__(self) -> str:
+        return "ArchiveEntry: {}  {}  {} octets".format(self.path, self.kind, self.size)
+
+
+class _EndOfData:
+    """Fin des données du fichier en cours"""
+
+class _EndOfArchive:
+    """Fin de l'archive"""
+
+END_OF_DATA = _EndOfData()
+END_OF_ARCHIVE = _EndOfArchive()
+
+
+class ArchiveStream:
+    """Vue d'un consommateur sur l'archive partagée. Itérer donne les entrées; pour un fichier,
+    'chunks()' donne ses données et doit être épuisé avant l'entrée suivante.
+    'close()' détache le consommateur (erreur, annulation): la lecture continue pour les autres
+    """
+    def __init__(self, fanout: 'ArchiveFanout') -> None:
+        self.fanout = fanout
+        self.path = fanout.path
+        self.closed = False
+        self._queue: 'queue.Queue[Any]' = queue.Queue(maxsize=QUEUE_CHUNKS)
+        self._attached = False
+
+
+    def _get(self) -> Any:
+        item = self._queue.get()
+
+        if isinstance(item, Exception):
+            raise ArchiveError("{}: {}".format(self.path, item))
+
+        return item
+
+
+    def __iter__(self) -> Iterator[ArchiveEntry]:
+        if not self._attached:
+            self._attached = True
+            self.fanout._resolve()
+
+        while True:
+            item = self._get()
+
+            if item is END_OF_ARCHIVE:
+                return
+
+            yield item
+
+
+    def chunks(self) -> Iterator[bytes]:
+        while True:
+            item = self._get()
+
+            if item is END_OF_DATA:
+                return
+
+            yield item
+
+
+    def close(self) -> None:
+        if self.closed:
+            return
+
+        self.closed = True
+
+        if not self._attached:
+            self._attached = True
+            self.fanout._resolve()
+
+        # libère le lecteur s'il attend de la place dans notre file
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+
+class ArchiveFanout:
+    """Lecture unique de l'archive 'path' pour 'consumers' consommateurs ('streams').
+    La lecture démarre quand tous les consommateurs ont commencé à itérer ou se sont détachés;
+    pendant la lecture, elle occupe une place d'écrivain de 'limits' par support alimenté
+    """
+    def __init__(self, path: str, consumers: int=1, limits: Optional[IOLimits]=None, chunk_size: int=DEFAULT_CHUNK_SIZE) -> None:
+        self.path = path
+        self.limits = limits or IOLimits()
+        self.chunk_size = chunk_size
+        self.streams = [ArchiveStream(self) for _ in range(consumers)]
+        self.bytes_read = 0
+
+        self._pending = consumers
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="archive-reader", daemon=True)
+        self._thread.start()
+
+
+    def _resolve(self) -> None:
+        with self._cond:
+            self._pending -= 1
+            self._cond.notify_all()
+
+
+    def _run(self) -> None:
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending <= 0)
+
+        if all(stream.closed for stream in self.streams):
+            return
+
+        start = time.monotonic()
+
+        try:
+            with self.limits.writer(sum(not stream.closed for stream in self.streams)):
+                for item in self._read():
+                    self._publish(item)
+                self._publish(END_OF_ARCHIVE)
+        except _NoConsumers:
+            logger.info("Lecture de {} abandonnée: plus aucun consommateur".format(self.path))
+            return
+        except Exception as e:
+            logger.error("Lecture de {} impossible: {}".format(self.path, e))
+            self._publish(e, force=True)
+            return
+
+        logger.info("Archive {} lue: {} octets en {:.1f}s".format(self.path, self.bytes_read, time.monotonic() - start))
+
+
+    def _publish(self, item: Any, force: bool=False) -> None:
+        """Remet 'item' à chaque consommateur encore attaché. Bloque tant qu'une file est pleine
+        """
+        for stream in self.streams:
+            while not stream.closed:
+                try:
+                    stream._queue.put(item, timeout=PUT_TIMEOUT)
+                    break
+                except queue.Full:
+                    if force:
+                        # erreur: elle remplace les données en attente
+                        try:
+                            stream._queue.get_nowait()
+                        except queue.Empty:
+                            pass
+
+        if not force and all(stream.closed for stream in self.streams):
+            raise _NoConsumers()
+
+
+    def _read(self) -> Iterator[Union[ArchiveEntry, bytes, _EndOfData]]:
+        lower = self.path.lower()
+
+        if lower.endswith(tuple(ZIP_SUFFIXES)):
+            yield from self._read_zip()
+        elif lower.endswith(tuple(ZSTD_SUFFIXES)):
+            # décompression zstd dans son propre processus, en parallèle de la lecture du tar
+            proc = popen_command(["zstd", "-q", "-d", "-c", self.path], stdout=subprocess.PIPE)
+            try:
+                with tarfile.open(fileobj=proc.stdout, mode="r|") as tf:
+                    yield from self._read_tar(tf)
+            except BaseException:
+                proc.kill()
+                raise
+            finally:
+                proc.stdout.close()
+
+            # le tar peut s'arrêter avant la fin du flux (bourrage): SIGPIPE n'est pas une erreur
+            if proc.wait() not in (0, -signal.SIGPIPE):
+                raise ArchiveError("zstd: code de retour {}".format(proc.returncode))
+        else:
+            with tarfile.open(self.path, mode="r|*") as tf:
+                yield from self._read_tar(tf)
+
+
+    def _data(self, f: Any) -> Iterator[Union[bytes, _EndOfData]]:
+        while True:
+            chunk = f.read(self.chunk_size)
+            if not chunk:
+                break
+            self.bytes_read += len(chunk)
+            yield chunk
+
+        yield END_OF_DATA
+
+
+    def _read_tar(self, tf: tarfile.TarFile) -> Iterator[Union[ArchiveEntry, bytes, _EndOfData]]:
+        for member in tf:
+            if member.isreg():
+                kind = FILE
+            elif member.isdir():
+                kind = DIR
+            elif member.issym():
+                kind = SYMLINK
+            elif member.islnk():
+                kind = HARDLINK
+            else:
+                logger.warning("{}: entrée ignorée (type non supporté): {}".format(self.path, member.name))
+                continue
+
+            yield ArchiveEntry(member.name, kind, member.mode, member.uid, member.gid, member.mtime, member.size, member.linkname)
+
+            if kind == FILE:
+                yield from self._data(tf.extractfile(member))
+
+
+    def _read_zip(self) -> Iterator[Union[ArchiveEntry, bytes, _EndOfData]]:
+        with zipfile.ZipFile(self.path) as zf:
+            for info in zf.infolist():
+                unix_mode = info.external_attr >> 16
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+
+                if info.is_dir():
+                    yield ArchiveEntry(info.filename, DIR, unix_mode or 0o755, mtime=mtime)
+                elif stat.S_ISLNK(unix_mode):
+                    yield ArchiveEntry(info.filename, SYMLINK, unix_mode, mtime=mtime, linkname=zf.read(info).decode("utf-8", "surrogateescape"))
+                else:
+                    yield ArchiveEntry(info.filename, FILE, unix_mode or 0o644, mtime=mtime, size=info.file_size)
+
+                    with zf.open(info) as f:
+                        yield from self._data(f)
+
+
+def open_archive(path: str, limits: Optional[IOLimits]=None) -> ArchiveStream:
+    """Flux de l'archive pour un seul consommateur
+    """
+    return ArchiveFanout(path, 1, limits).streams[0]
+
+
+def inside_symlink(path: str, symlinks: Set[str]) -> bool:
+    """'path' passerait-il par un lien symbolique créé depuis l'archive (et pourrait sortir
+    de la destination)?
+    """
+    parent = os.path.dirname(path)
+
+    while parent:
+        if parent in symlinks:
+            return True
+        parent = os.path.dirname(parent)
+
+    return False
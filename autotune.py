@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Réglage automatique, par support, de la taille des écritures et du nombre d'écritures
+simultanées.
+
+Point de départ: les indications du noyau (queue/optimal_io_size, queue/minimum_io_size,
+queue/max_sectors_kb). Ensuite, le débit est mesuré par fenêtres pendant l'écriture et les
+paramètres sont ajustés un à un tant que le débit s'améliore. Le meilleur réglage est gardé
+en cache par modèle et numéro de série pour les prochaines fois.
+
+Seules les écritures qui atteignent le support (O_DIRECT, voir write_stream) sont mesurées:
+une copie de fichiers à travers le cache de pages mesurerait la mémoire, pas la clé. Un réglage
+en cache est revérifié à chaque utilisation et de nouveau ajusté si le débit s'effondre.
+"""
+
+from typing import Any, Deque, Dict, List, Optional, Tuple, BinaryIO
+import json
+import mmap
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from copier import IOLimits, Progress, DEFAULT_CHUNK_SIZE
+from lsblk import Device, read_sysfs_int, get_block_devices
+from utils import get_logger
+
+
+logger = get_logger("autotune", "INFO")
+
+TUNING_CACHE_FILE = "/var/cache/wildcopy/iotune.json"
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 32 * 1024 * 1024
+DEFAULT_DEPTH = 2
+MAX_DEPTH = 8
+WINDOW_BYTES = 64 * 1024 * 1024 # volume écrit entre deux mesures
+MIN_GAIN = 1.05 # amélioration minimale pour garder un nouveau réglage
+MAX_LOSS = 1.5 # un réglage en cache est revu si le débit mesuré tombe en dessous de bps / MAX_LOSS
+
+# (paramètre, opération) essayés tour à tour
+DIRECTIONS: List[Tuple[str, str]] = [("chunk_size", "up"), ("chunk_size", "down"), ("depth", "up"), ("depth", "down")]
+
+_cache_lock = threading.Lock()
+
+
+def sysfs_hints(name: str) -> Dict[str, int]:
+    """Indications du noyau pour le support 'name' (0 si inconnues)
+    """
+    return {
+        "optimal_io_size": read_sysfs_int(name, "queue/optimal_io_size"),
+        "minimum_io_size": read_sysfs_int(name, "queue/minimum_io_size"),
+        "max_sectors_kb": read_sysfs_int(name, "queue/max_sectors_kb"),
+    }
+
+
+def _clamp_chunk(size: int) -> int:
+    """Puissance de deux entre MIN_CHUNK_SIZE et MAX_CHUNK_SIZE
+    """
+    size = max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, size))
+
+    return 1 << (size.bit_length() - 1)
+
+
+def initial_chunk_size(hints: Dict[str, int]) -> int:
+    """Taille de départ: la taille optimale annoncée, sinon la taille max d'une requête,
+    au moins DEFAULT_CHUNK_SIZE, et jamais sous la taille minimale
+    """
+    size = hints.get("optimal_io_size") or max(hints.get("max_sectors_kb", 0) * 1024, DEFAULT_CHUNK_SIZE)
+
+    return _clamp_chunk(max(size, hints.get("minimum_io_size", 0)))
+
+
+def device_key(device: Device) -> str:
+    return "{}|{}".format(device.model, device.serial)
+
+
+def _load_cache(path: str) -> Dict[str, Any]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+class IOTuner:
+    """Réglage d'un support. Thread-safe: les écrivains lisent 'chunk_size' et 'depth' avant
+    chaque écriture, et signalent avec 'record' celles qui ont atteint le support
+    """
+    @classmethod
+    def for_path(cls, path: str, cache_file: str=TUNING_CACHE_FILE) -> 'IOTuner':
+        """Tuner du support 'path' (support ou partition)
+        """
+        blockdevices = get_block_devices()
+        device = blockdevices.get_by_path(path)
+
+        if device is None:
+            partition = blockdevices.get_partition_by_path(path)
+            device = blockdevices.get_device_of(partition) if partition else None
+
+        if device is None:
+            return cls(None, os.path.basename(path), cache_file)
+
+        return cls(device_key(device), device.name, cache_file)
+
+
+    def __init__(self, key: Optional[str], name: str, cache_file: str=TUNING_CACHE_FILE) -> None:
+        self.key = key
+        self.cache_file = cache_file
+        self.hints = sysfs_hints(name)
+
+        cached = _load_cache(cache_file).get(key, {}) if key else {}
+
+        self.chunk_size: int = cached.get("chunk_size") or initial_chunk_size(self.hints)
+        self.depth: int = cached.get("depth") or DEFAULT_DEPTH
+        self.converged = bool(cached)
+        self._cached_bps: float = cached.get("bps", 0.0)
+
+        self._lock = threading.Lock()
+        self._best: Dict[str, Any] = {"chunk_size": self.chunk_size, "depth": self.depth, "bps": 0.0}
+        self._direction = 0
+        self._window_bytes = 0
+        self._window_start: Optional[float] = None
+
+        logger.debug("IOTuner {}: chunk_size: {} depth: {} (cache: {})".format(name, self.chunk_size, self.depth, self.converged))
+
+
+    def record(self, nbytes: int) -> None:
+        """Signale 'nbytes' écrits sur le support (pas dans le cache de pages). Ajuste le réglage,
+        ou vérifie celui venu du cache, à chaque fin de fenêtre de mesure
+        """
+        with self._lock:
+            now = time.monotonic()
+
+            if self._window_start is None:
+                self._window_start = now
+
+            self._window_bytes += nbytes
+
+            if self._window_bytes < WINDOW_BYTES or (self.converged and not self._cached_bps):
+                return
+
+            elapsed = now - self._window_start
+            bps = self._window_bytes / elapsed if elapsed > 0 else 0.0
+            self._window_bytes = 0
+            self._window_start = now
+
+            if self.converged:
+                self._validate(bps)
+            else:
+                self._step(bps)
+
+
+    def _validate(self, bps: float) -> None:
+        """Réglage en cache: s'il n'atteint plus son débit (réglage mesuré autrement, support
+        différent sous le même modèle), le réglage reprend depuis le réglage courant
+        """
+        if bps * MAX_LOSS >= self._cached_bps:
+            return
+
+        logger.info("IOTuner {}: {:.1f} MB/s au lieu de {:.1f} MB/s, nouveau réglage".format(self.key, bps / 10**6, self._cached_bps / 10**6))
+
+        self._cached_bps = 0.0
+        self.converged = False
+        self._direction = 0
+        self._step(bps)
+
+
+    def _step(self, bps: float) -> None:
+        if bps > self._best["bps"] * MIN_GAIN:
+            # amélioration: on garde et on continue dans la même direction
+            self._best = {"chunk_size": self.chunk_size, "depth": self.depth, "bps": bps}
+        else:
+            # pas mieux: retour au meilleur réglage et direction suivante
+            self.chunk_size, self.depth = self._best["chunk_size"], self._best["depth"]
+            self._direction += 1
+
+        while self._direction < len(DIRECTIONS):
+            if self._apply(*DIRECTIONS[self._direction]):
+                return
+            self._direction += 1
+
+        self.converged = True
+        logger.info("IOTuner {}: chunk_size: {} depth: {} ({:.1f} MB/s)".format(self.key, self.chunk_size, self.depth, self._best["bps"] / 10**6))
+
+
+    def _apply(self, param: str, op: str) -> bool:
+        """Applique un pas dans la direction donnée. 'False' si la limite est atteinte
+        """
+        if param == "chunk_size":
+            value = _clamp_chunk(self.chunk_size * 2 if op == "up" else self.chunk_size // 2)
+        else:
+            value = max(1, min(MAX_DEPTH, self.depth + (1 if op == "up" else -1)))
+
+        if value == getattr(self, param):
+            return False
+
+        setattr(self, param, value)
+
+        return True
+
+
+    def save(self) -> None:
+        """Enregistre le meilleur réglage mesuré pour ce modèle/numéro de série
+        """
+        if not self.key or not self._best["bps"]:
+            return
+
+        with _cache_lock:
+            cache = _load_cache(self.cache_file)
+            cache[self.key] = {"chunk_size": self._best["chunk_size"], "depth": self._best["depth"], "bps": self._best["bps"]}
+
+            tmp_path = "{}.{}".format(self.cache_file, os.getpid())
+            try:
+                os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+                with open(tmp_path, "w") as f:
+                    json.dump(cache, f, indent=2)
+                os.replace(tmp_path, self.cache_file)
+            except OSError as e:
+                logger.warning("Impossible d'enregistrer le réglage de {}: {}".format(self.key, e))
+
+
+    def __repr__(self) -> str:
+        return "IOTuner: {}  chunk_size: {}  depth: {}  converged: {}".format(self.key, self.chunk_size, self.depth, self.converged)
+
+
+def _read_full(stream: BinaryIO, buf: mmap.mmap) -> int:
+    """Remplit 'buf' depuis 'stream' (un tube peut rendre moins que demandé). 0 en fin de flux
+    """
+    view = memoryview(buf)
+    filled = 0
+
+    while filled < len(buf):
+        n = stream.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+
+    view.release()
+
+    return filled
+
+
+def _pwrite_all(fd: int, buf: mmap.mmap, length: int, offset: int, tuner: IOTuner, progress: Optional[Progress]) -> None:
+    view = memoryview(buf)[:length]
+    written = 0
+
+    try:
+        while written < length:
+            written += os.pwrite(fd, view[written:], offset + written)
+    finally:
+        view.release()
+
+    tuner.record(length)
+
+    if progress is not None:
+        progress.add(length)
+
+
+def write_stream(fd: int, stream: BinaryIO, tuner: IOTuner, limits: Optional[IOLimits]=None, progress: Optional[Progress]=None) -> int:
+    """Écrit 'stream' sur 'fd' à partir du début, avec au plus 'tuner.depth' écritures en vol de
+    'tuner.chunk_size' octets. Les tampons viennent de mmap (alignés, compatibles O_DIRECT).
+    Retourne le nombre d'octets écrits
+    """
+    offset = 0
+    pending: Deque[Future] = deque()
+
+    with ThreadPoolExecutor(max_workers=MAX_DEPTH, thread_name_prefix="autotune") as executor:
+        while True:
+            while len(pending) >= tuner.depth:
+                pending.popleft().result()
+
+            buf = mmap.mmap(-1, tuner.chunk_size)
+            n = _read_full(stream, buf)
+
+            if not n:
+                buf.close()
+                break
+
+            if limits:
+                limits.consume(n)
+
+            pending.append(executor.submit(_pwrite_all, fd, buf, n, offset, tuner, progress))
+            offset += n
+
+        while pending:
+            pending.popleft().result()
+
+    return offset
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Mesure du temps de démarrage de wcp.py et du coût d'import des modules.
+
+Usage:
+./bench_startup.py [-n RUNS]
+"""
+
+from typing import List, Dict
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS: Dict[str, List[str]] = {
+    "python (référence)": [sys.executable, "-c", "pass"],
+    "import lsblk": [sys.executable, "-c", "import lsblk"],
+    "import wildcopy": [sys.executable, "-c", "import wildcopy"],
+    "import wcp": [sys.executable, "-c", "import wcp"],
+    "wcp.py devices": [sys.executable, "wcp.py", "devices"],
+    "wcp.py devices --fresh": [sys.executable, "wcp.py", "devices", "--fresh"],
+}
+
+
+def time_command(cmd: List[str], runs: int) -> List[float]:
+    """Temps d'exécution (secondes) de 'runs' lancements de 'cmd'
+    """
+    timings = list()
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Temps de démarrage de wcp.py")
+    parser.add_argument("-n", "--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    print("{:<26} {:>10} {:>10} {:>10}".format("scénario", "min (ms)", "méd (ms)", "max (ms)"))
+
+    for name, cmd in SCENARIOS.items():
+        timings = time_command(cmd, args.runs)
+        print("{:<26} {:>10.1f} {:>10.1f} {:>10.1f}".format(name, min(timings) * 1000, statistics.median(timings) * 1000, max(timings) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Clonage d'un support modèle ("golden") vers plusieurs supports, bloc à bloc: la table de
+partitions, les chargeurs de démarrage et les systèmes de fichiers sont reproduits tels quels.
+
+Seules les zones utiles sont copiées:
+- le début du support jusqu'à la première partition (table de partitions, chargeur de démarrage),
+  et les espaces entre partitions (EBR des partitions logiques, chargeurs);
+- pour les partitions ext2/3/4, les blocs marqués utilisés dans les bitmaps des groupes;
+- les autres partitions en entier.
+
+Le modèle est lu une seule fois; chaque bloc lu est écrit sur toutes les cibles, chacune par son
+propre thread. Une cible en erreur est écartée sans interrompre les autres.
+"""
+
+from typing import List, Optional, Tuple
+import fcntl
+import os
+import queue
+import re
+import struct
+import threading
+import time
+
+from copier import IOLimits, CopyCancelled, DEFAULT_CHUNK_SIZE
+from lsblk import BlockDevices, Device, read_sysfs_int
+from metrics import BYTES_WRITTEN, DEVICES_COMPLETED
+from utils import get_logger, run_command
+from wildcopy import BLKRRPART, MKE2FS_FILESYSTEMS
+
+
+logger = get_logger("clone", "INFO")
+
+Range = Tuple[int, int] # (début, fin) en octets
+
+CLONE_CHUNK_SIZE = 4 * DEFAULT_CHUNK_SIZE
+QUEUE_CHUNKS = 8 # blocs en attente par cible
+MERGE_GAP = 256 * 1024 # deux zones plus proches sont copiées d'un seul tenant
+GAP_MAX = 16 * 1024 * 1024 # espaces entre partitions copiés en entier jusqu'à cette taille
+GAP_EDGE = 1024 * 1024 # au-delà, seuls le début et la fin sont copiés
+GPT_TAIL = 1024 * 1024 # zone de fin qui contient la copie de secours de la table GPT
+GPT_SIGNATURE = b"EFI PART"
+
+# ext2/3/4 (fs/ext4/ext4.h)
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_MAGIC = 0xEF53
+EXT_FEATURE_COMPAT_SPARSE_SUPER2 = 0x200
+EXT_FEATURE_INCOMPAT_META_BG = 0x10
+EXT_FEATURE_INCOMPAT_64BIT = 0x80
+EXT_FEATURE_RO_COMPAT_SPARSE_SUPER = 0x1
+EXT_BG_BLOCK_UNINIT = 0x2
+
+
+class CloneError(Exception):
+    """Clonage impossible (modèle monté, cible trop petite...)
+    """
+
+
+def merge_ranges(ranges: List[Range], gap: int=0) -> List[Range]:
+    """Trie et fusionne les zones qui se chevauchent ou sont à moins de 'gap' octets
+    """
+    merged: List[Range] = list()
+
+    for start, end in sorted(ranges):
+        if end <= start:
+            continue
+
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def _has_backup(group: int, sparse_super: bool) -> bool:
+    """Le groupe contient-il une copie du superbloc et des descripteurs?
+    """
+    if not sparse_super or group <= 1:
+        return True
+
+    for base in (3, 5, 7):
+        n = base
+        while n < group:
+            n *= base
+        if n == group:
+            return True
+
+    return False
+
+
+def ext_used_ranges(fd: int, offset: int, size: int) -> Optional[List[Range]]:
+    """Zones utilisées d'un système de fichiers ext2/3/4 commençant à 'offset', relatives au début
+    de la partition, d'après les bitmaps de blocs. 'None' si le superbloc n'est pas reconnu ou si
+    la disposition n'est pas gérée (meta_bg): la partition est alors copiée en entier.
+
+    Les groupes BLOCK_UNINIT n'ont pas de bitmap valide: on y reprend ce que le noyau y considère
+    comme utilisé (copie du superbloc et des descripteurs, bitmaps et table d'inodes du groupe),
+    et le groupe entier avec sparse_super2, dont les copies ne sont pas aux places habituelles
+    """
+    sb = os.pread(fd, 1024, offset + EXT_SUPERBLOCK_OFFSET)
+
+    if len(sb) < 1024 or struct.unpack_from("<H", sb, 0x38)[0] != EXT_MAGIC:
+        return None
+
+    blocks_lo, = struct.unpack_from("<I", sb, 0x4)
+    first_data_block, log_block_size = struct.unpack_from("<II", sb, 0x14)
+    blocks_per_group, = struct.unpack_from("<I", sb, 0x20)
+    inodes_per_group, = struct.unpack_from("<I", sb, 0x28)
+    rev_level, = struct.unpack_from("<I", sb, 0x4C)
+    inode_size, = struct.unpack_from("<H", sb, 0x58)
+    compat, incompat, ro_compat = struct.unpack_from("<III", sb, 0x5C)
+    reserved_gdt, = struct.unpack_from("<H", sb, 0xCE)
+    desc_size, = struct.unpack_from("<H", sb, 0xFE)
+    blocks_hi, = struct.unpack_from("<I", sb, 0x150)
+
+    if incompat & EXT_FEATURE_INCOMPAT_META_BG:
+        return None
+
+    is_64bit = bool(incompat & EXT_FEATURE_INCOMPAT_64BIT)
+    block_size = 1024 << log_block_size
+    blocks_count = blocks_lo | (blocks_hi << 32 if is_64bit else 0)
+    desc_size = desc_size if is_64bit and desc_size >= 64 else 32
+    inode_size = inode_size if rev_level >= 1 else 128
+
+    if not blocks_per_group or blocks_count * block_size > size:
+        return None
+
+    groups = (blocks_count - first_data_block + blocks_per_group - 1) // blocks_per_group
+    gdt_blocks = (groups * desc_size + block_size - 1) // block_size
+    itable_blocks = (inodes_per_group * inode_size + block_size - 1) // block_size
+    sparse_super = bool(ro_compat & EXT_FEATURE_RO_COMPAT_SPARSE_SUPER)
+
+    gdt = os.pread(fd, gdt_blocks * block_size, offset + (first_data_block + 1) * block_size)
+    if len(gdt) < groups * desc_size:
+        return None
+
+    # secteur de démarrage et superbloc, hors bitmap avec des blocs de 1 KiB
+    ranges: List[Range] = [(0, max(block_size, EXT_SUPERBLOCK_OFFSET + 1024))]
+
+    for group in range(groups):
+        desc = gdt[group * desc_size:(group + 1) * desc_size]
+        block_bitmap, inode_bitmap, inode_table = struct.unpack_from("<III", desc, 0x0)
+        flags, = struct.unpack_from("<H", desc, 0x12)
+
+        if is_64bit:
+            hi = struct.unpack_from("<III", desc, 0x20)
+            block_bitmap |= hi[0] << 32
+            inode_bitmap |= hi[1] << 32
+            inode_table |= hi[2] << 32
+
+        group_start = first_data_block + group * blocks_per_group
+        group_blocks = min(blocks_per_group, blocks_count - group_start)
+
+        if flags & EXT_BG_BLOCK_UNINIT:
+            if compat & EXT_FEATURE_COMPAT_SPARSE_SUPER2:
+                used = [(group_start, group_start + group_blocks)]
+            else:
+                used = [(block_bitmap, block_bitmap + 1), (inode_bitmap, inode_bitmap + 1), (inode_table, inode_table + itable_blocks)]
+                if _has_backup(group, sparse_super):
+                    used.append((group_start, group_start + 1 + gdt_blocks + reserved_gdt))
+        else:
+            bitmap = os.pread(fd, block_size, offset + block_bitmap * block_size)
+            # à l'octet près (8 blocs): quelques blocs libres copiés, mais un parcours en C
+            used = [(group_start + m.start() * 8, group_start + min(m.end() * 8, group_blocks)) for m in re.finditer(rb"[^\x00]+", bitmap[:(group_blocks + 7) // 8])]
+
+        ranges += [(start * block_size, min(end, blocks_count) * block_size) for start, end in used]
+
+    return merge_ranges(ranges, MERGE_GAP)
+
+
+def _is_gpt(fd: int, sector_size: int) -> bool:
+    return os.pread(fd, len(GPT_SIGNATURE), sector_size) == GPT_SIGNATURE
+
+
+class ClonePlan:
+    """Zones à copier du modèle, en octets depuis le début du support
+    """
+    def __init__(self, golden: Device, fd: int) -> None:
+        self.golden = golden
+        self.size = golden.size
+        self.gpt = _is_gpt(fd, read_sysfs_int(golden.name, "queue/logical_block_size", 512))
+        self.ranges: List[Range] = list()
+
+        partitions = sorted(golden.get_partitions(), key=lambda partition: partition.start)
+        previous_end = 0
+
+        for partition in partitions:
+            start, end = partition.start, partition.start + partition.size
+            self._add_gap(previous_end, start)
+            previous_end = max(previous_end, end)
+
+            used = ext_used_ranges(fd, start, partition.size) if partition.fstype in MKE2FS_FILESYSTEMS else None
+
+            if used is None:
+                logger.info("{}: copie intégrale ({})".format(partition.path, partition.fstype or "pas de système de fichiers reconnu"))
+                self.ranges.append((start, end))
+            else:
+                logger.info("{}: {} octets utilisés sur {}".format(partition.path, sum(e - s for s, e in used), partition.size))
+                self.ranges += [(start + s, start + e) for s, e in used]
+
+        # fin minimale d'une cible: dernière partition, et copie de secours de la table GPT
+        self.min_target_size = previous_end + (GPT_TAIL if self.gpt else 0)
+
+        if not partitions:
+            self.ranges.append((0, self.size))
+            self.min_target_size = self.size
+
+        self.ranges = merge_ranges(self.ranges, MERGE_GAP)
+        self.used_end = previous_end
+
+
+    def _add_gap(self, start: int, end: int) -> None:
+        if end - start <= GAP_MAX:
+            self.ranges.append((start, end))
+        else:
+            self.ranges += [(start, start + GAP_EDGE), (end - GAP_EDGE, end)]
+
+
+    @property
+    def bytes(self) -> int:
+        return sum(end - start for start, end in self.ranges)
+
+
+    @property
+    def gpt_tail(self) -> Optional[Range]:
+        """Copie de secours de la table GPT, reprise telle quelle sur les cibles de même taille
+        que le modèle (sur les autres, 'sgdisk -e' la recrée à la fin de la cible)
+        """
+        if self.gpt and self.size - GPT_TAIL >= self.used_end:
+            return (self.size - GPT_TAIL, self.size)
+
+        return None
+
+
+    def __repr__(self) -> str:
+        return "ClonePlan: {}  {}  {} zone(s), {} octets sur {}".format(self.golden.path, "gpt" if self.gpt else "msdos", len(self.ranges), self.bytes, self.size)
+
+
+class CloneTarget:
+    """Une cible, écrite par son propre thread depuis sa file
+    """
+    def __init__(self, device: Device) -> None:
+        self.device = device
+        self.path = device.path
+        self.size = device.size
+        self.bytes = 0
+        self.error: Optional[str] = None
+        self.queue: 'queue.Queue[Optional[Tuple[int, bytes]]]' = queue.Queue(maxsize=QUEUE_CHUNKS)
+        self.fd = -1
+
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+    def run(self, limits: IOLimits) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            if not self.ok:
+                continue # cible écartée: on vide la file pour ne pas bloquer la lecture
+
+            offset, data = item
+            try:
+                limits.consume(len(data))
+                view = memoryview(data)
+                written = 0
+                while written < len(data):
+                    written += os.pwrite(self.fd, view[written:], offset + written)
+                self.bytes += written
+            except OSError as e:
+                self.fail("écriture à {}: {}".format(offset, e.strerror))
+
+
+    def fail(self, error: str) -> None:
+        if self.ok:
+            self.error = error
+            logger.error("{}: {}".format(self.path, error))
+
+
+    def __repr__(self) -> str:
+        status = "OK" if self.ok else "ÉCHEC ({})".format(self.error)
+        return "{}  {}  {} octets".format(self.path, status, self.bytes)
+
+
+def _finish_target(target: CloneTarget, plan: ClonePlan) -> None:
+    """Après la copie: efface une éventuelle table GPT de secours périmée en fin de cible,
+    recrée celle du modèle à la fin de la cible ('sgdisk -e') si besoin, et fait relire la table
+    des partitions par le noyau
+    """
+    tail = max(target.size - GPT_TAIL, plan.used_end)
+    if not (plan.gpt and target.size == plan.size) and tail < target.size:
+        os.pwrite(target.fd, bytes(target.size - tail), tail)
+
+    os.fsync(target.fd)
+
+    if plan.gpt and target.size != plan.size:
+        if run_command(["sgdisk", "-e", target.path], capture_output=True).returncode != 0:
+            raise CloneError("sgdisk -e a échoué")
+
+    try:
+        fcntl.ioctl(target.fd, BLKRRPART)
+    except OSError as e:
+        logger.debug("BLKRRPART sur {}: {}".format(target.path, e))
+
+
+def clone_device(golden: Device, targets: List[Device], limits: Optional[IOLimits]=None, cancel: Optional[threading.Event]=None, chunk_size: int=CLONE_CHUNK_SIZE) -> List[CloneTarget]:
+    """Clone 'golden' sur 'targets'. Le modèle et les cibles sont ouverts en exclusif
+    (aucune partition ne doit être montée). Chaque cible occupe une place d'écrivain de 'limits':
+    pas plus de cibles que 'max_writers'. Retourne l'état de chaque cible
+    """
+    limits = limits or IOLimits()
+
+    if limits.max_writers and len(targets) > limits.max_writers:
+        raise CloneError("{} cibles pour {} écrivains au plus".format(len(targets), limits.max_writers))
+
+    try:
+        fd = os.open(golden.path, os.O_RDONLY | os.O_EXCL)
+    except OSError as e:
+        raise CloneError("Impossible d'ouvrir le modèle {} en exclusif (partition montée?): {}".format(golden.path, e))
+
+    clone_targets = [CloneTarget(device) for device in targets]
+    start = time.monotonic()
+
+    try:
+        plan = ClonePlan(golden, fd)
+        logger.info(str(plan))
+
+        for target in clone_targets:
+            if target.size < plan.min_target_size:
+                target.fail("trop petit: {} octets, {} requis".format(target.size, plan.min_target_size))
+                continue
+            try:
+                target.fd = os.open(target.path, os.O_WRONLY | os.O_EXCL)
+            except OSError as e:
+                target.fail("ouverture en exclusif impossible (partition montée?): {}".format(e.strerror))
+
+        live = [target for target in clone_targets if target.ok]
+        if not live:
+            raise CloneError("Aucune cible utilisable")
+
+        threads = [threading.Thread(target=target.run, args=(limits,), name="clone-{}".format(target.device.name)) for target in live]
+        for thread in threads:
+            thread.start()
+
+        try:
+            with limits.writer(len(live)):
+                _read_and_dispatch(fd, plan, live, chunk_size, cancel)
+        finally:
+            for target in live:
+                target.queue.put(None)
+            for thread in threads:
+                thread.join()
+
+        for target in live:
+            if target.ok:
+                try:
+                    _finish_target(target, plan)
+                except (OSError, CloneError) as e:
+                    target.fail(str(e))
+    finally:
+        os.close(fd)
+        for target in clone_targets:
+            if target.fd >= 0:
+                os.close(target.fd)
+
+    for target in clone_targets:
+        BYTES_WRITTEN.inc(target.bytes)
+        DEVICES_COMPLETED.inc(status="ok" if target.ok else "failed")
+
+    logger.info("Clonage de {} terminé en {:.1f}s: {}/{} cible(s)".format(golden.path, time.monotonic() - start, sum(target.ok for target in clone_targets), len(clone_targets)))
+
+    return clone_targets
+
+
+def _read_and_dispatch(fd: int, plan: ClonePlan, targets: List[CloneTarget], chunk_size: int, cancel: Optional[threading.Event]) -> None:
+    """Lit chaque zone une fois et la remet aux cibles
+    """
+    same_size = [target for target in targets if target.size == plan.size]
+    work = [(r, targets) for r in plan.ranges]
+
+    if plan.gpt_tail and same_size:
+        work.append((plan.gpt_tail, same_size))
+
+    for (range_start, range_end), recipients in work:
+        for offset in range(range_start, range_end, chunk_size):
+            if cancel is not None and cancel.is_set():
+                raise CopyCancelled("Clonage de {} interrompu".format(plan.golden.path))
+
+            data = os.pread(fd, min(chunk_size, range_end - offset), offset)
+
+            for target in recipients:
+                if target.ok:
+                    target.queue.put((offset, data))
+
+            if not any(target.ok for target in targets):
+                raise CloneError("Toutes les cibles sont en erreur")
+
+
+def resolve_clone(golden_path: str, target_paths: List[str], blockdevices: BlockDevices) -> Tuple[Device, List[Device]]:
+    """Vérifie que le modèle et les cibles sont des supports amovibles connectés et distincts
+    """
+    removables = {device.path: device for device in blockdevices.get_removables()}
+
+    for path in [golden_path] + target_paths:
+        if path not in removables:
+            raise CloneError("{} n'est pas un support amovible connecté".format(path))
+
+    if golden_path in target_paths or len(set(target_paths)) != len(target_paths):
+        raise CloneError("Le modèle et les cibles doivent être des supports distincts")
+
+    return removables[golden_path], [removables[path] for path in target_paths]
@@ -0,0 +1,611 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Copie d'une arborescence vers le point de montage d'un support, avec limites d'E/S globales
+partagées entre plusieurs copies simultanées.
+"""
+
+from typing import Dict, List, Optional, Iterator, Tuple, TYPE_CHECKING
+import hashlib
+import os
+import stat
+import threading
+import time
+from contextlib import contextmanager
+
+from scanner import TreeScanner, DIR, FILE, SYMLINK
+from utils import get_logger
+
+if TYPE_CHECKING:
+    from autotune import IOTuner
+    from archive import ArchiveStream
+
+
+logger = get_logger("copier", "INFO")
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEDUP_MIN_SIZE = 4096 # en dessous, un lien ne fait pas gagner de bloc
+
+
+class CopyCancelled(Exception):
+    """La copie a été interrompue à la demande de l'utilisateur
+    """
+
+
+class Throttle:
+    """Seau à jetons: limite le débit cumulé de tous les threads qui l'utilisent.
+    'bytes_per_sec' à 0: pas de limite.
+    """
+    def __init__(self, bytes_per_sec: int=0) -> None:
+        self.bytes_per_sec = bytes_per_sec
+        self._lock = threading.Lock()
+        self._tokens = float(bytes_per_sec)
+        self._last = time.monotonic()
+
+
+    def consume(self, nbytes: int) -> None:
+        """Attend que 'nbytes' puissent être écrits sans dépasser le débit
+        """
+        if not self.bytes_per_sec:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.bytes_per_sec, self._tokens + (now - self._last) * self.bytes_per_sec)
+            self._last = now
+            self._tokens -= nbytes
+            wait = -self._tokens / self.bytes_per_sec if self._tokens < 0 else 0.0
+
+        if wait:
+            time.sleep(wait)
+
+
+class IOLimits:
+    """Limites d'E/S globales: nombre de supports écrits simultanément et débit total.
+    0 pour 'illimité'.
+    """
+    def __init__(self, max_writers: int=0, bytes_per_sec: int=0) -> None:
+        self.max_writers = max_writers
+        self.throttle = Throttle(bytes_per_sec)
+        self.writers = 0 # places d'écrivain occupées
+        self._cond = threading.Condition()
+
+
+    @contextmanager
+    def writer(self, count: int=1) -> Iterator[None]:
+        """Réserve 'count' places d'écrivain (une par support alimenté) pour la durée du bloc.
+        Les places sont prises toutes ensemble pour que deux lectures partagées ne se bloquent
+        pas mutuellement; 'count' est ramené à max_writers
+        """
+        if not self.max_writers:
+            yield
+            return
+
+        count = min(count, self.max_writers)
+
+        with self._cond:
+            self._cond.wait_for(lambda: self.writers + count <= self.max_writers)
+            self.writers += count
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.writers -= count
+                self._cond.notify_all()
+
+
+    def consume(self, nbytes: int) -> None:
+        self.throttle.consume(nbytes)
+
+
+class CopyStats:
+    """Bilan d'une copie
+    """
+    def __init__(self) -> None:
+        self.files = 0
+        self.dirs = 0
+        self.links = 0
+        self.bytes = 0
+        self.deduped = 0
+        self.bytes_saved = 0
+        self.seconds = 0.0
+
+
+    @property
+    def bytes_per_sec(self) -> float:
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+
+    def __repr__(self) -> str:
+        s = "Fichiers: {}  Répertoires: {}  Liens: {}  Octets: {}  Durée: {:.1f}s".format(self.files, self.dirs, self.links, self.bytes, self.seconds)
+
+        if self.deduped:
+            s += "  Doublons liés: {} ({} octets évités)".format(self.deduped, self.bytes_saved)
+
+        return s
+
+
+class PermPolicy:
+    """Mode, propriétaire et dates appliqués à chaque fichier et répertoire au moment où la copie
+    le crée, par appels sur le descripteur ouvert (fchown, fchmod, futimens): pas de second parcours.
+
+    'file_mode' / 'dir_mode': mode imposé, None pour reprendre celui de la source (si 'preserve_mode').
+    'root_mode': mode de la racine de la copie (le point de montage).
+    'uid' / 'gid': propriétaire imposé, None pour laisser celui du processus.
+    """
+    def __init__(self, file_mode: Optional[int]=None, dir_mode: Optional[int]=None, root_mode: Optional[int]=None, uid: Optional[int]=None, gid: Optional[int]=None, preserve_mode: bool=True, preserve_times: bool=True) -> None:
+        self.file_mode = file_mode
+        self.dir_mode = dir_mode
+        self.root_mode = root_mode
+        self.uid = uid
+        self.gid = gid
+        self.preserve_mode = preserve_mode
+        self.preserve_times = preserve_times
+
+
+    @classmethod
+    def for_fat(cls, preserve_times: bool=True) -> 'PermPolicy':
+        """vfat, exfat: ni propriétaire ni permissions unix, seulement les dates
+        """
+        return cls(preserve_mode=False, preserve_times=preserve_times)
+
+
+    def _mode(self, st: os.stat_result, is_dir: bool) -> Optional[int]:
+        mode = self.dir_mode if is_dir else self.file_mode
+
+        if mode is None and self.preserve_mode:
+            mode = stat.S_IMODE(st.st_mode)
+
+        return mode
+
+
+    def apply(self, fd: int, st: os.stat_result, is_dir: bool=False, times: bool=True) -> None:
+        """Applique la politique au fichier ouvert 'fd', créé à partir de la source 'st'.
+        chown avant chmod: chown efface les bits setuid/setgid
+        """
+        if self.uid is not None or self.gid is not None:
+            os.fchown(fd, -1 if self.uid is None else self.uid, -1 if self.gid is None else self.gid)
+
+        mode = self._mode(st, is_dir)
+        if mode is not None:
+            os.fchmod(fd, mode)
+
+        if times and self.preserve_times:
+            os.utime(fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+    def apply_link(self, path: str, st: os.stat_result) -> None:
+        """Liens symboliques: pas de descripteur, appels sans suivre le lien
+        """
+        if self.uid is not None or self.gid is not None:
+            os.lchown(path, -1 if self.uid is None else self.uid, -1 if self.gid is None else self.gid)
+
+        if self.preserve_times:
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+    def __repr__(self) -> str:
+        def _oct(mode: Optional[int]) -> str:
+            return oct(mode) if mode is not None else "-"
+
+        return "PermPolicy: fichiers: {}  répertoires: {}  racine: {}  uid: {}  gid: {}  dates: {}".format(_oct(self.file_mode), _oct(self.dir_mode), _oct(self.root_mode), self.uid, self.gid, self.preserve_times)
+
+
+DEFAULT_POLICY = PermPolicy()
+
+
+class Progress:
+    """Avancement d'une copie: octets traités (écrits ou évités par dédoublonnage), face aux totaux
+    de la source connus au fil du parcours. Thread-safe
+    """
+    def __init__(self) -> None:
+        self.bytes_done = 0
+        self.bytes_written = 0 # écrits sur le support, même si la copie échoue ensuite
+        self.scanner: Optional[TreeScanner] = None
+        self._start: Optional[float] = None
+        self._lock = threading.Lock()
+
+
+    def begin(self, scanner: TreeScanner) -> None:
+        self.scanner = scanner
+        self._start = time.monotonic()
+
+
+    def add(self, nbytes: int) -> None:
+        """'nbytes' écrits
+        """
+        with self._lock:
+            self.bytes_done += nbytes
+            self.bytes_written += nbytes
+
+
+    def skip(self, nbytes: int) -> None:
+        """'nbytes' traités sans être écrits
+        """
+        with self._lock:
+            self.bytes_done += nbytes
+
+
+    @property
+    def bytes_total(self) -> int:
+        return self.scanner.bytes if self.scanner else 0
+
+
+    @property
+    def final(self) -> bool:
+        """'True' une fois le parcours terminé: le total n'augmentera plus
+        """
+        return self.scanner is not None and self.scanner.done.is_set()
+
+
+    @property
+    def percent(self) -> float:
+        return 100.0 * self.bytes_done / self.bytes_total if self.bytes_total else 0.0
+
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Secondes restantes au débit moyen, 'None' tant que le total n'est pas connu
+        """
+        if not self.final or not self.bytes_done or self._start is None:
+            return None
+
+        rate = self.bytes_done / (time.monotonic() - self._start)
+
+        return (self.bytes_total - self.bytes_done) / rate if rate else None
+
+
+    def __repr__(self) -> str:
+        if self.scanner is None:
+            return "-"
+
+        total = "{}{}".format("" if self.final else ">", self.bytes_total)
+        eta = " ETA {:.0f}s".format(self.eta) if self.eta is not None else ""
+
+        return "{:.0f}% ({}/{} octets){}".format(self.percent, self.bytes_done, total, eta)
+
+
+def file_digest(path: str, chunk_size: int=DEFAULT_CHUNK_SIZE) -> str:
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class DedupIndex:
+    """Fichiers déjà copiés, pour écrire une seule fois les fichiers identiques de la source puis
+    les lier (liens physiques: ext uniquement). L'empreinte d'un fichier est calculée pendant sa
+    copie: seuls les fichiers suivants de même taille sont relus pour être comparés, avant leur
+    copie. Deux fichiers ne sont liés que si la copie leur donnerait aussi le même mode et les
+    mêmes dates, puisqu'un lien physique les partage
+    """
+    def __init__(self, policy: PermPolicy=DEFAULT_POLICY) -> None:
+        self.policy = policy
+        self.bytes_hashed = 0 # relus pour comparaison, en plus de la copie
+        self._copies: Dict[Tuple[int, Optional[int], Optional[int]], Dict[str, str]] = dict() # clé -> empreinte -> copie
+        self._by_inode: Dict[Tuple[int, int], str] = dict() # liens physiques de la source -> copie
+
+
+    def wants(self, st: os.stat_result) -> bool:
+        return stat.S_ISREG(st.st_mode) and st.st_size >= DEDUP_MIN_SIZE
+
+
+    def find(self, src_path: str, st: os.stat_result) -> Tuple[Optional[str], Optional[str]]:
+        """Copie déjà écrite identique à 'src_path' et empreinte de 'src_path' si elle a dû être
+        calculée. ('None', 'None') pour le premier fichier de sa taille: son empreinte sera
+        calculée pendant sa copie
+        """
+        if not self.wants(st):
+            return None, None
+
+        existing = self._by_inode.get((st.st_dev, st.st_ino))
+        if existing:
+            return existing, None
+
+        copies = self._copies.get(self._key(st))
+        if not copies:
+            return None, None
+
+        digest = file_digest(src_path)
+        self.bytes_hashed += st.st_size
+
+        return copies.get(digest), digest
+
+
+    def add(self, st: os.stat_result, dst_path: str, digest: Optional[str]) -> None:
+        """Enregistre la copie 'dst_path' d'un fichier de la source
+        """
+        if not self.wants(st):
+            return
+
+        self._by_inode.setdefault((st.st_dev, st.st_ino), dst_path)
+
+        if digest:
+            self._copies.setdefault(self._key(st), dict()).setdefault(digest, dst_path)
+
+
+    def _key(self, st: os.stat_result) -> Tuple[int, Optional[int], Optional[int]]:
+        mode = stat.S_IMODE(st.st_mode) if self.policy.file_mode is None and self.policy.preserve_mode else None
+        mtime = st.st_mtime_ns if self.policy.preserve_times else None
+
+        return (st.st_size, mode, mtime)
+
+
+    def __repr__(self) -> str:
+        return "DedupIndex: {} taille(s)  octets relus: {}".format(len(self._copies), self.bytes_hashed)
+
+
+def copy_file(src_path: str, dst_path: str, limits: Optional[IOLimits]=None, chunk_size: int=DEFAULT_CHUNK_SIZE, cancel: Optional[threading.Event]=None, tuner: Optional['IOTuner']=None, policy: PermPolicy=DEFAULT_POLICY, digest: Optional['hashlib._Hash']=None) -> int:
+    """Copie le contenu d'un fichier par blocs de 'chunk_size', ou de la taille réglée par 'tuner'
+    (écritures dans le cache de pages: elles ne servent pas à ses mesures). Mode, propriétaire
+    et dates sont appliqués selon 'policy' avant fermeture. 'digest' est mis à jour avec le
+    contenu lu. Retourne le nombre d'octets écrits
+    """
+    written = 0
+
+    with open(src_path, "rb") as src:
+        st = os.fstat(src.fileno())
+
+        # créé en 0o600, le mode définitif est posé une fois le contenu écrit. Jamais à travers
+        # un lien déjà présent à la place de la destination
+        fd = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+        with open(fd, "wb", closefd=True) as dst:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise CopyCancelled("Copie de {} interrompue".format(src_path))
+
+                chunk = src.read(tuner.chunk_size if tuner else chunk_size)
+                if not chunk:
+                    break
+
+                if limits:
+                    limits.consume(len(chunk))
+
+                dst.write(chunk)
+                written += len(chunk)
+
+                if digest is not None:
+                    digest.update(chunk)
+
+            dst.flush() # sinon l'écriture du reste du tampon modifierait mtime après futimens
+            policy.apply(fd, st)
+
+    return written
+
+
+def _copy_link(src_path: str, dst_path: str, policy: PermPolicy) -> int:
+    """Recrée le lien symbolique. Retourne 0 si le système de fichiers cible ne les supporte pas (FAT)
+    """
+    try:
+        os.symlink(os.readlink(src_path), dst_path)
+        policy.apply_link(dst_path, os.lstat(src_path))
+    except OSError as e:
+        logger.warning("Lien symbolique ignoré: {}: {}".format(dst_path, e))
+        return 0
+
+    return 1
+
+
+def _link_duplicate(existing: str, dst_path: str) -> bool:
+    """Lien physique vers le fichier déjà copié. 'False' si impossible: le doublon est alors copié
+    """
+    try:
+        os.link(existing, dst_path)
+    except OSError as e:
+        logger.debug("Lien de {} vers {} impossible: {}".format(dst_path, existing, e))
+        return False
+
+    return True
+
+
+def _make_dir(dst_path: str, st: os.stat_result, policy: PermPolicy, mode: Optional[int]=None) -> None:
+    """Crée le répertoire s'il n'existe pas et lui applique la politique, sauf les dates:
+    la création des fichiers qu'il contiendra les modifierait. Un lien symbolique à sa place
+    n'est jamais suivi
+    """
+    try:
+        os.mkdir(dst_path, 0o700)
+    except FileExistsError:
+        if not stat.S_ISDIR(os.lstat(dst_path).st_mode):
+            raise FileExistsError("{} existe et n'est pas un répertoire".format(dst_path))
+
+    fd = os.open(dst_path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    try:
+        if mode is not None:
+            PermPolicy(dir_mode=mode, uid=policy.uid, gid=policy.gid).apply(fd, st, is_dir=True, times=False)
+        else:
+            policy.apply(fd, st, is_dir=True, times=False)
+    finally:
+        os.close(fd)
+
+
+def _set_dir_times(dst_path: str, st: os.stat_result) -> None:
+    fd = os.open(dst_path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    try:
+        os.utime(fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+    finally:
+        os.close(fd)
+
+
+def copy_tree(src: str, dst: str, limits: Optional[IOLimits]=None, chunk_size: int=DEFAULT_CHUNK_SIZE, cancel: Optional[threading.Event]=None, tuner: Optional['IOTuner']=None, policy: PermPolicy=DEFAULT_POLICY, dedup: Optional[DedupIndex]=None, scanner: Optional[TreeScanner]=None, progress: Optional[Progress]=None) -> CopyStats:
+    """Copie le contenu du répertoire 'src' dans le répertoire existant 'dst'. Les fichiers sont
+    copiés un à un: seule la taille des écritures de 'tuner' s'applique, pas le nombre d'écritures en vol.
+    Mode, propriétaire et dates de chaque entrée sont posés à sa création selon 'policy'; les dates
+    des répertoires le sont à la fin, une fois leur contenu écrit.
+    Avec 'dedup', les doublons deviennent des liens physiques vers le premier exemplaire copié
+    (voir DedupIndex).
+    Les entrées viennent de 'scanner' (parcours parallèle déjà lancé, voir scanner.py), sinon
+    d'un parcours lancé ici: la copie commence sans attendre la fin du parcours
+    """
+    stats = CopyStats()
+    start = time.monotonic()
+    dir_times: List[Tuple[str, os.stat_result]] = list()
+
+    logger.info("Copie de {} vers {} ({})".format(src, dst, policy))
+
+    _make_dir(dst, os.stat(src), policy, mode=policy.root_mode)
+
+    scanner = scanner or TreeScanner(src).start()
+    if progress is not None:
+        progress.begin(scanner)
+
+    try:
+        for entry in scanner:
+            src_path = entry.path
+            dst_path = os.path.join(dst, entry.rel)
+
+            if entry.kind == SYMLINK:
+                stats.links += _copy_link(src_path, dst_path, policy)
+            elif entry.kind == DIR:
+                _make_dir(dst_path, entry.st, policy)
+                dir_times.append((dst_path, entry.st))
+                stats.dirs += 1
+            elif entry.kind == FILE:
+                existing, digest = dedup.find(src_path, entry.st) if dedup else (None, None)
+
+                if existing and _link_duplicate(existing, dst_path):
+                    stats.deduped += 1
+                    stats.bytes_saved += entry.st.st_size
+                    if progress is not None:
+                        progress.skip(entry.st.st_size)
+                    continue
+
+                hasher = hashlib.sha256() if dedup and digest is None and dedup.wants(entry.st) else None
+
+                written = copy_file(src_path, dst_path, limits, chunk_size, cancel, tuner, policy, hasher)
+                stats.bytes += written
+                stats.files += 1
+
+                if progress is not None:
+                    progress.add(written)
+
+                if dedup:
+                    dedup.add(entry.st, dst_path, digest or (hasher.hexdigest() if hasher else None))
+            else:
+                logger.warning("Fichier spécial ignoré: {}".format(src_path))
+    finally:
+        scanner.stop()
+
+    if policy.preserve_times:
+        for dst_path, st in reversed(dir_times):
+            _set_dir_times(dst_path, st)
+
+    stats.seconds = time.monotonic() - start
+    logger.info("Copie terminée vers {}: {}".format(dst, stats))
+
+    if dedup:
+        logger.info("Dédoublonnage: {} doublon(s) lié(s), {} octets évités, {} octets relus pour comparaison".format(stats.deduped, stats.bytes_saved, dedup.bytes_hashed))
+
+    return stats
+
+
+def _write_chunks(chunks: Iterator[bytes], dst_path: str, st: os.stat_result, limits: Optional[IOLimits], cancel: Optional[threading.Event], policy: PermPolicy) -> int:
+    """Comme copy_file, pour des données reçues par blocs
+    """
+    written = 0
+
+    fd = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+    with open(fd, "wb", closefd=True) as dst:
+        for chunk in chunks:
+            if cancel is not None and cancel.is_set():
+                raise CopyCancelled("Copie de {} interrompue".format(dst_path))
+
+            if limits:
+                limits.consume(len(chunk))
+
+            dst.write(chunk)
+            written += len(chunk)
+
+        dst.flush()
+        policy.apply(fd, st)
+
+    return written
+
+
+def copy_archive(stream: 'ArchiveStream', dst: str, limits: Optional[IOLimits]=None, cancel: Optional[threading.Event]=None, tuner: Optional['IOTuner']=None, policy: PermPolicy=DEFAULT_POLICY, progress: Optional[Progress]=None) -> CopyStats:
+    """Écrit le contenu de l'archive lue en flux dans le répertoire existant 'dst', avec la même
+    politique que copy_tree ('progress' ne compte que les octets écrits, le total est inconnu). Les entrées qui sortiraient de 'dst' (chemins absolus, '..',
+    passage par un lien de l'archive) sont ignorées
+    """
+    from archive import DIR, FILE, HARDLINK, SYMLINK, safe_path, inside_symlink
+
+    stats = CopyStats()
+    start = time.monotonic()
+    dir_times: List[Tuple[str, os.stat_result]] = list()
+    symlinks = set()
+
+    logger.info("Copie de {} vers {} ({})".format(stream.path, dst, policy))
+
+    _make_dir(dst, os.stat(dst), policy, mode=policy.root_mode)
+
+    for entry in stream:
+        rel = safe_path(entry.path)
+
+        if rel == os.curdir:
+            continue # racine, déjà créée
+
+        # 'rel' lui-même déjà créé comme lien: un répertoire ou un fichier à sa place le suivrait
+        if rel is None or rel in symlinks or inside_symlink(rel, symlinks):
+            logger.warning("Entrée ignorée (hors de la destination): {}".format(entry.path))
+            if entry.kind == FILE:
+                for _ in stream.chunks():
+                    pass
+            continue
+
+        dst_path = os.path.join(dst, rel)
+        st = entry.stat()
+
+        # les archives ne contiennent pas toujours les répertoires parents (zip)
+        parent = os.path.dirname(rel)
+        if parent and not os.path.isdir(os.path.join(dst, parent)):
+            os.makedirs(os.path.join(dst, parent), 0o755)
+
+        if entry.kind == DIR:
+            _make_dir(dst_path, st, policy)
+            dir_times.append((dst_path, st))
+            stats.dirs += 1
+        elif entry.kind == FILE:
+            written = _write_chunks(stream.chunks(), dst_path, st, limits, cancel, policy)
+            stats.bytes += written
+            stats.files += 1
+
+            if progress is not None:
+                progress.add(written)
+        elif entry.kind == SYMLINK:
+            try:
+                os.symlink(entry.linkname, dst_path)
+                policy.apply_link(dst_path, st)
+                symlinks.add(rel)
+                stats.links += 1
+            except OSError as e:
+                logger.warning("Lien symbolique ignoré: {}: {}".format(dst_path, e))
+        elif entry.kind == HARDLINK:
+            target = safe_path(entry.linkname)
+            if target in (None, os.curdir) or inside_symlink(target, symlinks) or target in symlinks:
+                logger.warning("Lien ignoré (hors de la destination): {}".format(entry.path))
+                continue
+
+            try:
+                os.link(os.path.join(dst, target), dst_path)
+                stats.links += 1
+            except OSError:
+                # pas de liens physiques (FAT): copie du fichier déjà écrit
+                written = copy_file(os.path.join(dst, target), dst_path, limits, cancel=cancel, tuner=tuner, policy=policy)
+                stats.bytes += written
+                stats.files += 1
+
+                if progress is not None:
+                    progress.add(written)
+
+    if policy.preserve_times:
+        for dst_path, st in reversed(dir_times):
+            _set_dir_times(dst_path, st)
+
+    stats.seconds = time.monotonic() - start
+    logger.info("Copie terminée vers {}: {}".format(dst, stats))
+
+    return stats
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Cache local d'images de systèmes de fichiers ext prêtes à l'emploi, compressées avec zstd.
+
+Une image est identifiée par le manifeste de la source (chemins, types, tailles, dates, modes,
+propriétaires et inodes de tous les fichiers) et les options de formatage. Si la source n'a pas changé, l'image est
+décompressée à la volée directement sur la partition au lieu d'être reconstruite.
+Les images les moins récemment utilisées sont supprimées quand le cache dépasse son budget.
+"""
+
+from typing import Dict, Iterator, List, Optional
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from archive import ArchiveError, archive_manifest, is_archive, open_archive
+from autotune import IOTuner, write_stream
+from copier import IOLimits, Progress, copy_archive
+from metrics import VERIFY_FAILURES
+from scanner import SYMLINK, TreeScanner
+from utils import get_logger, run_command, popen_command
+from wildcopy import MKE2FS_FILESYSTEMS
+
+
+logger = get_logger("imagestore", "INFO")
+
+DEFAULT_STORE_DIR = "/var/cache/wildcopy/images"
+DEFAULT_BUDGET = 20 * 1024**3
+IMAGE_SUFFIX = ".img.zst"
+META_SUFFIX = ".json"
+IMAGE_ALIGN = 1024 * 1024
+IMAGE_MIN_OVERHEAD = 64 * 1024 * 1024 # journal, tables d'inodes...
+IMAGE_OVERHEAD_RATIO = 1.1
+ZSTD_LEVEL = 3
+
+
+class ImageStoreError(Exception):
+    """Construction ou restauration d'une image impossible
+    """
+
+
+def source_manifest(src: str) -> str:
+    """Empreinte de 'src' calculée sur les métadonnées de chaque entrée, lues par un TreeScanner
+    (chemin relatif, type et mode, taille, mtime, ctime, inode, propriétaire, groupe, cible des liens).
+    Le contenu des fichiers n'est pas lu: une modification qui conserverait taille, mtime et ctime
+    passerait inaperçue, ce qui suppose de changer l'horloge du système. Une source recopiée
+    ailleurs (autres inodes) donne une autre empreinte: l'image est simplement reconstruite
+    """
+    lines = list()
+
+    for entry in TreeScanner(src).start():
+        st = entry.st
+        target = os.readlink(entry.path) if entry.kind == SYMLINK else ""
+
+        lines.append("{}\0{}\0{}\0{}\0{}\0{}\0{}\0{}\0{}\n".format(entry.rel, st.st_mode, st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino, st.st_uid, st.st_gid, target))
+
+    # le parcours parallèle remet les entrées dans un ordre quelconque
+    lines.sort()
+
+    digest = hashlib.sha256()
+    for line in lines:
+        digest.update(line.encode("utf-8", "surrogateescape"))
+
+    return digest.hexdigest()
+
+
+def image_key(manifest: str, fstype: str, label: Optional[str], mode: Optional[int]) -> str:
+    options = json.dumps({"fstype": fstype, "label": label, "mode": mode}, sort_keys=True)
+
+    return hashlib.sha256("{}\0{}".format(manifest, options).encode()).hexdigest()
+
+
+def _tree_usage(src: str) -> List[int]:
+    """[octets, nombre d'entrées] de l'arborescence
+    """
+    total, count = 0, 0
+
+    for dirpath, dirnames, filenames in os.walk(src):
+        for name in dirnames + filenames:
+            total += os.lstat(os.path.join(dirpath, name)).st_size
+            count += 1
+
+    return [total, count]
+
+
+class ImageStore:
+    """Images compressées rangées dans 'directory', au plus 'budget' octets au total.
+    Les constructions tournent sur un pool dédié: une tâche dont l'image est déjà en cache
+    n'attend jamais une construction en cours.
+    """
+    def __init__(self, directory: str=DEFAULT_STORE_DIR, budget: int=DEFAULT_BUDGET, builders: int=1) -> None:
+        self.directory = directory
+        self.budget = budget
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, builders), thread_name_prefix="imagestore")
+        self._building: Dict[str, Future] = dict()
+        self._in_use: Dict[str, int] = dict()
+        self._manifests: Dict[str, Future] = dict()
+
+
+    def image_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + IMAGE_SUFFIX)
+
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + META_SUFFIX)
+
+
+    def manifest(self, src: str) -> str:
+        """Manifeste de 'src', calculé une fois par source pour la durée de vie du cache:
+        les tâches concurrentes sur la même source attendent le même calcul
+        """
+        with self._lock:
+            future = self._manifests.get(src)
+            owner = future is None
+            if owner:
+                future = self._manifests[src] = Future()
+
+        if owner:
+            try:
+                future.set_result(archive_manifest(src) if is_archive(src) else source_manifest(src))
+            except Exception as e:
+                with self._lock:
+                    self._manifests.pop(src, None) # nouvel essai à la prochaine demande
+                future.set_exception(e)
+
+        return future.result()
+
+
+    def key_for(self, src: str, fstype: str, label: Optional[str]=None, mode: Optional[int]=None) -> str:
+        return image_key(self.manifest(src), fstype, label, mode)
+
+
+    def lookup(self, key: str) -> Optional[Dict[str, int]]:
+        """Métadonnées de l'image si elle est en cache (et la marque comme récemment utilisée),
+        'None' sinon
+        """
+        path = self.image_path(key)
+
+        try:
+            with open(self._meta_path(key)) as f:
+                meta = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+
+        return meta
+
+
+    def build_async(self, key: str, src: str, fstype: str, label: Optional[str]=None) -> Future:
+        """Lance la construction de l'image en arrière-plan, une seule fois par clé
+        """
+        with self._lock:
+            future = self._building.get(key)
+
+            if future is None:
+                future = self._executor.submit(self._build, key, src, fstype, label)
+                self._building[key] = future
+                future.add_done_callback(lambda _: self._forget_build(key))
+
+        return future
+
+
+    def _forget_build(self, key: str) -> None:
+        with self._lock:
+            self._building.pop(key, None)
+
+
+    def _build(self, key: str, src: str, fstype: str, label: Optional[str]) -> str:
+        if fstype not in MKE2FS_FILESYSTEMS:
+            raise ImageStoreError("Images non supportées pour {}".format(fstype))
+
+        if self.lookup(key):
+            return self.image_path(key)
+
+        raw_path = os.path.join(self.directory, "{}.{}.img".format(key, os.getpid()))
+        tmp_path = raw_path + ".zst"
+        scratch = None
+
+        try:
+            if is_archive(src):
+                # mke2fs -d ne lit qu'une arborescence: extraction dans le cache le temps de la construction
+                scratch = os.path.join(self.directory, "{}.{}.d".format(key, os.getpid()))
+                os.mkdir(scratch, 0o700)
+                copy_archive(open_archive(src), scratch)
+                src = scratch
+
+            payload, entries = _tree_usage(src)
+            image_size = int(payload * IMAGE_OVERHEAD_RATIO) + IMAGE_MIN_OVERHEAD
+            image_size = (image_size + IMAGE_ALIGN - 1) // IMAGE_ALIGN * IMAGE_ALIGN
+
+            logger.info("Construction de l'image {} depuis {} ({} octets)".format(key[:12], src, image_size))
+
+            with open(raw_path, "wb") as f:
+                f.truncate(image_size)
+
+            cmd = ["mke2fs", "-q", "-F", "-t", fstype, "-N", str(entries + 1024), "-d", src]
+            if label:
+                cmd += ["-L", label[:12]]
+            cmd += [raw_path]
+
+            run_command(cmd, check=True)
+            run_command(["zstd", "-q", "-f", "-T0", "-{}".format(ZSTD_LEVEL), raw_path, "-o", tmp_path], check=True)
+
+            os.replace(tmp_path, self.image_path(key))
+
+            with open(self._meta_path(key), "w") as f:
+                json.dump({"image_size": image_size, "payload": payload, "fstype": fstype}, f)
+        except (OSError, ArchiveError, subprocess.CalledProcessError) as e:
+            logger.error("Construction de l'image {} impossible: {}".format(key[:12], e))
+            raise ImageStoreError(str(e))
+        finally:
+            for path in [raw_path, tmp_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+            if scratch:
+                shutil.rmtree(scratch, ignore_errors=True)
+
+        logger.info("Image {} en cache".format(key[:12]))
+        self.evict()
+
+        return self.image_path(key)
+
+
+    def restore(self, key: str, partition_path: str, limits: Optional[IOLimits]=None, tuner: Optional[IOTuner]=None, progress: Optional[Progress]=None) -> int:
+        """Décompresse l'image à la volée sur la partition (en O_DIRECT, taille et nombre
+        d'écritures réglés par 'tuner') puis étend le système de fichiers à toute la partition.
+        Retourne le nombre d'octets écrits, aussi comptés au fur et à mesure dans 'progress'
+        """
+        tuner = tuner or IOTuner.for_path(partition_path)
+
+        with self.using(key):
+            meta = self.lookup(key)
+            if meta is None:
+                raise ImageStoreError("Image {} absente du cache".format(key[:12]))
+
+            logger.info("Restauration de l'image {} sur {}".format(key[:12], partition_path))
+
+            proc = popen_command(["zstd", "-q", "-d", "-c", self.image_path(key)], stdout=subprocess.PIPE)
+            # les images font un nombre entier de MiB: toutes les écritures restent alignées
+            fd = os.open(partition_path, os.O_WRONLY | os.O_EXCL | getattr(os, "O_DIRECT", 0))
+
+            try:
+                written = write_stream(fd, proc.stdout, tuner, limits, progress)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+                proc.stdout.close()
+
+            if proc.wait() != 0 or written != meta["image_size"]:
+                VERIFY_FAILURES.inc(check="image")
+                raise ImageStoreError("Décompression de l'image {} incomplète".format(key[:12]))
+
+        # l'image a été construite à la taille de la source: on l'étend à la partition
+        run_command(["resize2fs", "-f", partition_path], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        return written
+
+
+    @contextmanager
+    def using(self, key: str) -> Iterator[None]:
+        """L'image 'key' ne peut pas être supprimée du cache pendant la durée du bloc
+        """
+        with self._lock:
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_use[key] -= 1
+
+
+    def evict(self) -> List[str]:
+        """Supprime les images les moins récemment utilisées jusqu'à repasser sous le budget.
+        Les images en cours de restauration sont conservées
+        """
+        images = list()
+
+        for name in os.listdir(self.directory):
+            if name.endswith(IMAGE_SUFFIX) and name.count(".") == 2:
+                st = os.stat(os.path.join(self.directory, name))
+                images.append((st.st_mtime, st.st_size, name[:-len(IMAGE_SUFFIX)]))
+
+        total = sum(size for _, size, _ in images)
+        evicted = list()
+
+        for _, size, key in sorted(images):
+            if total <= self.budget:
+                break
+
+            with self._lock:
+                if self._in_use.get(key):
+                    continue
+
+                for path in [self._meta_path(key), self.image_path(key)]:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+            total -= size
+            evicted.append(key)
+            logger.info("Image {} supprimée du cache".format(key[:12]))
+
+        return evicted
+
+
+    def wait(self) -> None:
+        """Attend la fin des constructions en cours
+        """
+        with self._lock:
+            futures = list(self._building.values())
+
+        for future in futures:
+            try:
+                future.result()
+            except ImageStoreError:
+                pass
@@ -0,0 +1,714 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Exécution non interactive de copies décrites dans un fichier de tâches (JSON ou TOML).
+
+Exemple (TOML):
+
+    [defaults]
+    fstype = "ext4"
+    mode = "0o755"          # racine du support
+    dir_mode = "0o755"
+    file_mode = "0o644"
+    owner = "1000:1000"     # ou "utilisateur:groupe"
+    reset = true
+    probe = true
+    cache = true
+    dedup = true            # fichiers identiques écrits une fois puis liés (ext uniquement)
+
+    [[jobs]]
+    src = "/srv/payloads/formation"
+    device = "serial:AA00000000012345"
+    label = "Formation"
+
+    [[jobs]]
+    src = "/srv/payloads/archives"
+    device = "/dev/sdc"
+    fstype = "ext2"
+
+    [[jobs]]
+    src = "/srv/payloads/formation.tar.zst"   # archive lue en flux
+    device = "serial:AA00000000067890"
+
+'device' désigne le support par son chemin ("/dev/sdb" ou "path:/dev/sdb"),
+son numéro de série ("serial:..."), ou le label, l'uuid ou le partuuid d'une de ses partitions
+("label:...", "uuid:...", "partuuid:..."). Sans préfixe, on essaie le chemin, puis le numéro
+de série, puis le label. Préférer le numéro de série: il ne change pas si le noyau renomme
+le support (/dev/sdb -> /dev/sdc) entre deux exécutions.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+import grp
+import json
+import os
+import pwd
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait as futures_wait
+
+from archive import ArchiveFanout, ArchiveStream, archive_file_sizes, is_archive, open_archive
+from autotune import IOTuner
+from copier import IOLimits, CopyCancelled, CopyStats, DedupIndex, PermPolicy, Progress, copy_archive, copy_tree
+from imagestore import ImageStore
+from lsblk import BlockDevices, Device, get_block_devices, invalidate_cache
+from metrics import BYTES_DEDUPED, BYTES_WRITTEN, DEVICES_COMPLETED, VERIFY_FAILURES, phase
+from probe import ProbeResult, ProbeRules, probe_device
+from scanner import TreeScanner
+from utils import get_logger
+from wildcopy import PedDevice, PedPartition, ChmodFailed, MKE2FS_FILESYSTEMS, FAT_FILESYSTEMS, SUPPORTED_FILESYSTEMS, CLUSTER_SIZES, DEFAULT_FSTYPE, DEFAULT_MODE, choose_cluster_size, cluster_size_for_slack, erase_block_size
+
+
+logger = get_logger("jobs", "INFO")
+
+DEFAULT_WORKERS = 4
+FS_OVERHEAD = 0.03 # part du support prise par le système de fichiers (tables d'inodes, journal, FAT)
+JOB_FIELDS = ["name", "src", "device", "fstype", "label", "mode", "dir_mode", "file_mode", "owner", "preserve_times", "format", "reset", "probe", "cache", "dedup", "umount"]
+MODE_FIELDS = ["mode", "dir_mode", "file_mode"]
+
+# libparted n'est pas thread-safe: les manipulations des tables de partitions sont sérialisées
+_parted_lock = threading.Lock()
+
+
+class JobError(Exception):
+    """Tâche invalide ou en échec
+    """
+
+class DeviceNotFound(JobError):
+    """Aucun support amovible ne correspond au sélecteur
+    """
+
+
+class Job:
+    """Une copie: répertoire source -> support
+    """
+    def __init__(self, src: str, device: str, fstype: str=DEFAULT_FSTYPE, label: Optional[str]=None, mode: Optional[int]=None, dir_mode: Optional[int]=None, file_mode: Optional[int]=None, owner: Optional[str]=None, preserve_times: bool=True, format: bool=True, reset: bool=False, probe: bool=False, cache: bool=False, dedup: bool=False, umount: bool=True, name: Optional[str]=None) -> None:
+        self.src = src
+        self.device = device
+        self.fstype = fstype
+        self.label = label
+        self.mode = mode # racine du support, DEFAULT_MODE par défaut
+        self.dir_mode = dir_mode
+        self.file_mode = file_mode
+        self.owner = owner
+        self.preserve_times = preserve_times
+        self.format = format
+        self.reset = reset # remise à zéro rapide (discard + effacement des signatures) avant partitionnement
+        self.probe = probe # sonde de débit et de capacité avant démarrage (destructif)
+        self.cache = cache # utilise (ou construit en arrière-plan) une image en cache de la source
+        self.dedup = dedup # fichiers identiques de la source écrits une fois puis liés (ext)
+        self.umount = umount
+        self.name = name or "{} -> {}".format(os.path.basename(src.rstrip(os.sep)), device)
+
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], base_dir: str="") -> 'Job':
+        """Construit une tâche depuis une entrée du fichier de tâches. Les chemins relatifs
+        sont résolus par rapport à 'base_dir'
+        """
+        unknown = set(data) - set(JOB_FIELDS)
+        if unknown:
+            raise JobError("Champ(s) inconnu(s): {}".format(", ".join(sorted(unknown))))
+
+        for field in ["src", "device"]:
+            if not data.get(field):
+                raise JobError("Champ obligatoire manquant: {}".format(field))
+
+        kwargs = dict(data)
+        kwargs["src"] = os.path.abspath(os.path.join(base_dir, data["src"]))
+
+        for field in MODE_FIELDS:
+            if isinstance(data.get(field), str):
+                kwargs[field] = int(data[field], 8)
+
+        return cls(**kwargs)
+
+
+    def validate(self) -> None:
+        if not os.path.isdir(self.src) and not is_archive(self.src):
+            raise JobError("{}: la source doit être un répertoire ou une archive (tar, zip, tar.zst): {}".format(self.name, self.src))
+
+        if self.format and self.fstype not in SUPPORTED_FILESYSTEMS:
+            raise JobError("{}: système de fichiers non supporté: {}".format(self.name, self.fstype))
+
+        if self.reset and not self.format:
+            raise JobError("{}: 'reset' implique 'format'".format(self.name))
+
+        if self.probe and not self.format:
+            raise JobError("{}: 'probe' implique 'format'".format(self.name))
+
+        if self.cache and not self.format:
+            raise JobError("{}: 'cache' implique 'format'".format(self.name))
+
+        if self.dedup and self.fstype in FAT_FILESYSTEMS:
+            raise JobError("{}: 'dedup' impossible sur {} (pas de liens physiques)".format(self.name, self.fstype))
+
+        if self.dedup and is_archive(self.src):
+            raise JobError("{}: 'dedup' non supporté pour une archive".format(self.name))
+
+        if self.cache and (self.dir_mode is not None or self.file_mode is not None or self.owner):
+            # l'image reprend modes et propriétaires de la source (mke2fs -d)
+            raise JobError("{}: 'cache' incompatible avec 'dir_mode', 'file_mode' et 'owner'".format(self.name))
+
+        self.policy()
+
+
+    def policy(self) -> PermPolicy:
+        """Politique de mode, propriétaire et dates appliquée pendant la copie
+        """
+        if self.fstype in FAT_FILESYSTEMS:
+            return PermPolicy.for_fat(self.preserve_times)
+
+        uid, gid = _parse_owner(self.owner) if self.owner else (None, None)
+
+        return PermPolicy(file_mode=self.file_mode, dir_mode=self.dir_mode, root_mode=self.mode or DEFAULT_MODE, uid=uid, gid=gid, preserve_times=self.preserve_times)
+
+
+    def __repr__(self) -> str:
+        return "Job: {}  src: {}  device: {}  fstype: {}  format: {}".format(self.name, self.src, self.device, self.fstype, self.format)
+
+
+def _parse_owner(owner: str) -> Tuple[Optional[int], Optional[int]]:
+    """"uid:gid", "utilisateur:groupe", "utilisateur" (groupe principal) ou ":groupe"
+    """
+    user, _, group = owner.partition(":")
+    uid, gid = None, None
+
+    try:
+        if user:
+            entry = pwd.getpwuid(int(user)) if user.isdigit() else pwd.getpwnam(user)
+            uid = entry.pw_uid
+            gid = entry.pw_gid
+        if group:
+            gid = int(group) if group.isdigit() else grp.getgrnam(group).gr_gid
+    except (KeyError, ValueError):
+        # identifiants numériques inconnus localement: acceptés tels quels
+        if not (user.isdigit() and (not group or group.isdigit())):
+            raise JobError("Propriétaire inconnu: {}".format(owner))
+        uid, gid = int(user), int(group) if group else None
+
+    return uid, gid
+
+
+class JobResult:
+    """Résultat de l'exécution d'une tâche
+    """
+    def __init__(self, job: Job, device_path: Optional[str]=None) -> None:
+        self.job = job
+        self.device_path = device_path
+        self.device_size = 0
+        self.probe: Optional[ProbeResult] = None
+        self.stats: Optional[CopyStats] = None
+        self.error: Optional[str] = None
+        self.cancelled = False
+        self.progress = Progress()
+        self.seconds = 0.0
+
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+    def __repr__(self) -> str:
+        if self.cancelled:
+            status = "ANNULÉE"
+        else:
+            status = "OK" if self.ok else "ÉCHEC ({})".format(self.error)
+
+        s = "{}  [{}]  {}  {:.1f}s".format(self.job.name, self.device_path or "-", status, self.seconds)
+
+        if self.stats and self.stats.deduped:
+            s += "  doublons liés: {} ({} octets évités)".format(self.stats.deduped, self.stats.bytes_saved)
+
+        return s
+
+
+def summarize(results: List[JobResult]) -> str:
+    """Bilan d'un lot de tâches: supports réussis, en échec et annulés, octets écrits et doublons liés
+    """
+    ok = sum(1 for result in results if result.ok)
+    cancelled = sum(1 for result in results if result.cancelled)
+    stats = [result.stats for result in results if result.stats]
+
+    s = "Bilan: {} OK, {} en échec, {} annulée(s)  Octets écrits: {}".format(ok, len(results) - ok - cancelled, cancelled, sum(stat.bytes for stat in stats))
+
+    deduped = sum(stat.deduped for stat in stats)
+    if deduped:
+        s += "  Doublons liés: {} ({} octets évités)".format(deduped, sum(stat.bytes_saved for stat in stats))
+
+    return s
+
+
+def load_job_file(path: str) -> List[Job]:
+    """Lit un fichier de tâches JSON ou TOML (selon l'extension). Les valeurs de la table
+    'defaults' s'appliquent à toutes les tâches
+    """
+    if path.endswith(".toml"):
+        import tomllib
+        with open(path, "rb") as f:
+            data = tomllib.load(f)
+    else:
+        with open(path) as f:
+            data = json.load(f)
+
+    if isinstance(data, list):
+        data = {"jobs": data}
+
+    defaults = data.get("defaults", {})
+    base_dir = os.path.dirname(os.path.abspath(path))
+
+    jobs = [Job.from_dict(dict(defaults, **entry), base_dir) for entry in data.get("jobs", [])]
+
+    if not jobs:
+        raise JobError("Aucune tâche dans {}".format(path))
+
+    return jobs
+
+
+def resolve_device(selector: str, blockdevices: BlockDevices) -> Device:
+    """Retourne le support amovible désigné par 'selector' (voir BlockDevices.find)
+    """
+    device = blockdevices.find(selector)
+
+    if device is None or not device.is_removable():
+        raise DeviceNotFound("Aucun support amovible ne correspond à '{}'".format(selector))
+
+    return device
+
+
+def run_job(job: Job, device_path: str, limits: Optional[IOLimits]=None, cancel: Optional[threading.Event]=None, store: Optional[ImageStore]=None, source: Optional[ArchiveStream]=None, progress: Optional[Progress]=None) -> CopyStats:
+    """Partitionne et formate le support si demandé, puis y copie la source.
+    Avec 'cache', l'image de la source est restaurée si elle est dans 'store', sinon la copie
+    se fait normalement et l'image est construite en arrière-plan pour les tâches suivantes.
+    Source archive: 'source' est le flux partagé avec d'autres tâches (voir run_jobs), sinon
+    l'archive est lue pour cette seule tâche.
+    Source répertoire: son parcours démarre avant toute écriture sur le support, et la tâche
+    échoue avant le formatage si la place qu'elle occupera dépasse déjà celle estimée disponible
+    """
+    logger.info("Démarrage: {} sur {}".format(job.name, device_path))
+    limits = limits or IOLimits()
+
+    key = None
+    if job.cache and store is not None and job.fstype in MKE2FS_FILESYSTEMS:
+        key = store.key_for(job.src, job.fstype, job.label, job.mode)
+
+    meta = store.lookup(key) if key else None
+    scanner = None
+
+    try:
+        with _parted_lock:
+            device = PedDevice(device_path, force=job.format)
+
+            if not meta and not is_archive(job.src):
+                scanner = _start_scanner(job, device)
+
+            if job.reset:
+                if scanner is not None:
+                    scanner.check()
+                with phase("reset"):
+                    device.fast_reset()
+
+            if job.format:
+                with phase("partition"):
+                    partition = device.partition_device(job.fstype)
+
+        tuner = IOTuner.for_path(device_path)
+
+        if meta and meta["image_size"] <= partition.size:
+            if source is not None:
+                source.close() # les autres supports alimentés par l'archive n'attendent pas celui-ci
+            stats = _restore_image(job, partition, store, key, limits, tuner, progress)
+        else:
+            if scanner is None and not is_archive(job.src):
+                scanner = _start_scanner(job, device)
+
+            stats = _format_and_copy(job, device, partition if job.format else None, limits, cancel, tuner, source, scanner, progress)
+
+            if key:
+                store.build_async(key, job.src, job.fstype, job.label)
+    finally:
+        if scanner is not None:
+            scanner.stop()
+
+    tuner.save()
+
+    return stats
+
+
+def _restore_image(job: Job, partition: PedPartition, store: ImageStore, key: str, limits: IOLimits, tuner: IOTuner, progress: Optional[Progress]=None) -> CopyStats:
+    stats = CopyStats()
+    start = time.monotonic()
+
+    with limits.writer(), phase("restore"):
+        stats.bytes = store.restore(key, partition.path, limits, tuner, progress)
+
+    partition.mount(job.fstype)
+    try:
+        partition.chmod(job.mode or DEFAULT_MODE)
+    except ChmodFailed:
+        pass
+
+    if job.umount:
+        with phase("umount"):
+            partition.umount()
+
+    stats.seconds = time.monotonic() - start
+    logger.info("Image restaurée sur {}: {}".format(partition.path, stats))
+
+    return stats
+
+
+def _start_scanner(job: Job, device: PedDevice) -> TreeScanner:
+    """Parcours de la source limité à la place estimée disponible sur le support, qui compte
+    aussi la perte en fin de clusters pour choisir la taille de cluster FAT. Sans formatage,
+    la limite (place libre de la partition) n'est posée qu'une fois celle-ci montée
+    """
+    limit = int(device.size * (1 - FS_OVERHEAD)) if job.format else 0
+
+    return TreeScanner(job.src, limit=limit, cluster_sizes=CLUSTER_SIZES.get(job.fstype, ())).start()
+
+
+def _format_and_copy(job: Job, device: PedDevice, partition: Optional[PedPartition], limits: IOLimits, cancel: Optional[threading.Event], tuner: IOTuner, source: Optional[ArchiveStream]=None, scanner: Optional[TreeScanner]=None, progress: Optional[Progress]=None) -> CopyStats:
+    archive = is_archive(job.src)
+
+    if scanner is not None:
+        scanner.check() # source déjà trop grosse: on s'arrête avant de formater
+
+    if partition is not None:
+        cluster_size = None
+        if job.fstype in FAT_FILESYSTEMS:
+            erase_block = erase_block_size(os.path.basename(device.path))
+
+            if scanner is not None:
+                # totaux du parcours déjà lancé; s'il attend la copie, les premières entrées suffisent
+                if not scanner.settle():
+                    logger.info("{}: taille de cluster d'après les {} premiers fichiers".format(job.name, scanner.files))
+                cluster_size = cluster_size_for_slack(job.fstype, scanner.bytes, scanner.slack, partition.size, erase_block)
+            elif archive:
+                file_sizes = archive_file_sizes(job.src)
+
+                # tailles inconnues (tar): taille de cluster par défaut de mkfs
+                if file_sizes is not None:
+                    cluster_size = choose_cluster_size(job.fstype, file_sizes, partition.size, erase_block)
+
+        with phase("format"):
+            device.format_partition(partition, fstype=job.fstype, partlabel=job.label, mount=True, mode=job.mode, cluster_size=cluster_size)
+    else:
+        partitions = device.get_partitions()
+        if not partitions:
+            raise JobError("{}: aucune partition sur {}".format(job.name, device.path))
+        partition = partitions[0]
+        partition.mount()
+
+    mountpoint = partition.mountpoint
+    if not mountpoint:
+        raise JobError("{}: impossible de monter {}".format(job.name, partition.path))
+
+    if scanner is not None and not scanner.limit:
+        # partition existante: les fichiers qu'elle contient déjà ne sont pas comptés comme libérables
+        st = os.statvfs(mountpoint)
+        scanner.set_limit(st.f_bavail * st.f_frsize)
+        scanner.check()
+
+    try:
+        if archive:
+            # les places d'écrivain sont prises par la lecture de l'archive, une par support alimenté
+            with phase("copy"):
+                stats = copy_archive(source or open_archive(job.src, limits), mountpoint, limits, cancel=cancel, tuner=tuner, policy=job.policy(), progress=progress)
+        else:
+            # empreintes calculées pendant la copie: pas de parcours préalable de la source
+            dedup = DedupIndex(job.policy()) if job.dedup else None
+
+            with limits.writer(), phase("copy"):
+                stats = copy_tree(job.src, mountpoint, limits, cancel=cancel, tuner=tuner, policy=job.policy(), dedup=dedup, scanner=scanner, progress=progress)
+    except CopyCancelled:
+        partition.umount()
+        raise
+
+    if job.umount:
+        with phase("umount"):
+            partition.umount()
+
+    return stats
+
+
+def probe_job_device(result: JobResult, limits: Optional[IOLimits]=None) -> ProbeResult:
+    """Démonte les partitions du support de la tâche et le sonde
+    """
+    with _parted_lock:
+        device = PedDevice(result.device_path, force=True)
+
+    for partition in device.get_partitions():
+        partition.umount()
+
+    with (limits or IOLimits()).writer(), phase("probe"):
+        probe = probe_device(result.device_path, result.device_size)
+
+    if not probe.genuine:
+        VERIFY_FAILURES.inc(check="capacity")
+
+    return probe
+
+
+def execute_job(result: JobResult, limits: Optional[IOLimits]=None, store: Optional[ImageStore]=None, cancel: Optional[threading.Event]=None, source: Optional[ArchiveStream]=None) -> JobResult:
+    """Exécute la tâche de 'result' et y consigne bilan, erreur et durée
+    """
+    start = time.monotonic()
+    try:
+        result.stats = run_job(result.job, result.device_path, limits, cancel=cancel, store=store, source=source, progress=result.progress)
+        BYTES_WRITTEN.inc(result.stats.bytes)
+        BYTES_DEDUPED.inc(result.stats.bytes_saved)
+        DEVICES_COMPLETED.inc(status="ok")
+    except CopyCancelled as e:
+        result.error = str(e)
+        result.cancelled = True
+        logger.warning("Annulée: {}".format(result.job.name))
+        BYTES_WRITTEN.inc(result.progress.bytes_written)
+        DEVICES_COMPLETED.inc(status="cancelled")
+    except Exception as e:
+        result.error = str(e) or e.__class__.__name__
+        logger.error("Échec: {}: {}".format(result.job.name, result.error))
+        BYTES_WRITTEN.inc(result.progress.bytes_written) # écrits avant l'échec
+        DEVICES_COMPLETED.inc(status="failed")
+    finally:
+        if source is not None:
+            source.close() # en cas d'échec, détache la tâche du flux partagé
+        invalidate_cache() # partitions, montages et systèmes de fichiers du support ont changé
+    result.seconds = time.monotonic() - start
+
+    return result
+
+
+def _share_archives(runnable: List[JobResult], workers: int, limits: IOLimits) -> Dict[int, ArchiveStream]:
+    """Regroupe les tâches qui copient la même archive pour qu'elle ne soit lue qu'une fois:
+    un flux par tâche, indexé par id() du résultat. Les tâches d'un groupe avancent au rythme
+    de la lecture et doivent toutes tourner en même temps: groupes de 'workers' tâches au plus
+    (et 'max_writers', chaque support occupant une place d'écrivain), rangés de façon contiguë
+    dans 'runnable' (modifiée sur place)
+    """
+    size = min(workers, limits.max_writers) if limits.max_writers else workers
+
+    groups: Dict[str, List[JobResult]] = dict()
+
+    for result in runnable:
+        if is_archive(result.job.src):
+            groups.setdefault(result.job.src, []).append(result)
+
+    order = list()
+    sources: Dict[int, ArchiveStream] = dict()
+
+    for result in runnable:
+        group = groups.pop(result.job.src, None) if is_archive(result.job.src) else [result]
+
+        if group is None:
+            continue
+
+        order += group
+
+        if is_archive(result.job.src):
+            for i in range(0, len(group), size):
+                batch = group[i:i + size]
+                fanout = ArchiveFanout(result.job.src, len(batch), limits)
+                sources.update((id(member), stream) for member, stream in zip(batch, fanout.streams))
+
+                logger.info("{}: lue une fois pour {} support(s)".format(result.job.src, len(batch)))
+
+    runnable[:] = order
+
+    return sources
+
+
+def run_jobs(jobs: List[Job], workers: int=DEFAULT_WORKERS, limits: Optional[IOLimits]=None, probe_rules: Optional[ProbeRules]=None, store: Optional[ImageStore]=None) -> List[JobResult]:
+    """Exécute les tâches sur un pool de 'workers' threads. Les supports sont résolus une fois
+    avant le démarrage; une tâche invalide n'empêche pas les autres de s'exécuter.
+    Les supports des tâches avec 'probe' sont d'abord sondés: ceux rejetés par 'probe_rules'
+    sont écartés, les plus lents démarrent en premier.
+    """
+    blockdevices = get_block_devices(max_age=0, removables_only=True)
+    limits = limits or IOLimits()
+
+    results = [JobResult(job) for job in jobs]
+    runnable: List[JobResult] = list()
+    used_paths: Dict[str, Job] = dict()
+
+    for result in results:
+        try:
+            result.job.validate()
+            device = resolve_device(result.job.device, blockdevices)
+            result.device_path = device.path
+            result.device_size = device.size
+
+            if result.device_path in used_paths:
+                raise JobError("{} est déjà la cible de '{}'".format(result.device_path, used_paths[result.device_path].name))
+
+            used_paths[result.device_path] = result.job
+            runnable.append(result)
+        except JobError as e:
+            result.error = str(e)
+            logger.error(result.error)
+
+    probe_rules = probe_rules or ProbeRules()
+
+    def _probe(result: JobResult) -> None:
+        try:
+            result.probe = probe_job_device(result, limits)
+            reason = probe_rules.reject_reason(result.probe)
+        except Exception as e:
+            reason = "sonde impossible: {}".format(e)
+
+        if reason:
+            result.error = "{}: support rejeté: {}".format(result.job.name, reason)
+            logger.error(result.error)
+            DEVICES_COMPLETED.inc(status="rejected")
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(_probe, [result for result in runnable if result.job.probe]))
+
+    runnable = [result for result in runnable if result.ok]
+    runnable.sort(key=lambda result: (result.probe is None, result.probe.write_bps if result.probe else 0))
+
+    sources = _share_archives(runnable, max(1, workers), limits)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(lambda result: execute_job(result, limits, store, source=sources.get(id(result))), runnable))
+
+    if store is not None:
+        store.wait()
+
+    return results
+
+
+class BackgroundJob:
+    """Tâche soumise à 'BackgroundJobs'
+    """
+    def __init__(self, id: int, job: Job, device_path: str) -> None:
+        self.id = id
+        self.job = job
+        self.result = JobResult(job, device_path)
+        self.cancel_event = threading.Event()
+        self.future: Optional[Future] = None
+        self.submitted = time.time()
+        self.started: Optional[float] = None
+
+
+    @property
+    def device_path(self) -> str:
+        return self.result.device_path
+
+
+    @property
+    def state(self) -> str:
+        if self.future is None or not self.future.done():
+            return "en cours" if self.started else "en attente"
+
+        if self.future.cancelled() or self.result.cancelled:
+            return "annulée"
+
+        return "terminée" if self.result.ok else "échec"
+
+
+    def is_active(self) -> bool:
+        return self.future is not None and not self.future.done()
+
+
+    def __repr__(self) -> str:
+        if self.started and self.is_active():
+            elapsed = " {:.0f}s".format(time.time() - self.started)
+            if self.result.progress.scanner is not None:
+                elapsed += "  {}".format(self.result.progress)
+        elif not self.is_active() and self.started:
+            elapsed = " {:.0f}s".format(self.result.seconds)
+        else:
+            elapsed = ""
+
+        return "[{}] {:<10} {}  {}{}".format(self.id, self.state, self.device_path, self.job.name, elapsed)
+
+
+class BackgroundJobs:
+    """Exécution de tâches en arrière-plan sur un pool de threads, pour le shell interactif:
+    on peut lister les supports et soumettre d'autres copies pendant que les précédentes s'écrivent
+    """
+    def __init__(self, workers: int=DEFAULT_WORKERS, limits: Optional[IOLimits]=None, store: Optional[ImageStore]=None) -> None:
+        self.limits = limits or IOLimits()
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="wcp-job")
+        self._lock = threading.Lock()
+        self._jobs: Dict[int, BackgroundJob] = dict()
+        self._next_id = 1
+
+
+    def submit(self, job: Job, device_path: str) -> BackgroundJob:
+        """Soumet 'job' sur le support 'device_path'. JobError si la tâche est invalide ou si le
+        support est déjà la cible d'une tâche active
+        """
+        job.validate()
+
+        with self._lock:
+            if device_path in self.busy_paths():
+                raise JobError("{} est déjà la cible d'une tâche en cours".format(device_path))
+
+            background = BackgroundJob(self._next_id, job, device_path)
+            self._jobs[background.id] = background
+            self._next_id += 1
+
+            background.future = self._executor.submit(self._run, background)
+
+        return background
+
+
+    def _run(self, background: BackgroundJob) -> JobResult:
+        background.started = time.time()
+
+        return execute_job(background.result, self.limits, self.store, background.cancel_event)
+
+
+    def get(self, id: int) -> Optional[BackgroundJob]:
+        return self._jobs.get(id, None)
+
+
+    def get_all(self) -> List[BackgroundJob]:
+        return [self._jobs[id] for id in sorted(self._jobs)]
+
+
+    def active(self) -> List[BackgroundJob]:
+        return [background for background in self.get_all() if background.is_active()]
+
+
+    def busy_paths(self) -> List[str]:
+        """Supports cibles des tâches en attente ou en cours
+        """
+        return [background.device_path for background in self.active()]
+
+
+    def cancel(self, id: int) -> bool:
+        """Annule une tâche en attente, ou interrompt la copie d'une tâche en cours
+        (le partitionnement et le formatage déjà commencés vont à leur terme)
+        """
+        background = self.get(id)
+
+        if background is None or not background.is_active():
+            return False
+
+        background.cancel_event.set()
+        background.future.cancel()
+
+        return True
+
+
+    def wait(self, id: Optional[int]=None, timeout: Optional[float]=None) -> List[BackgroundJob]:
+        """Attend la fin de la tâche 'id', ou de toutes les tâches actives
+        """
+        targets = [self.get(id)] if id is not None else self.active()
+        targets = [background for background in targets if background is not None]
+
+        futures_wait([background.future for background in targets], timeout=timeout)
+
+        return targets
+
+
+    def shutdown(self, cancel: bool=False) -> None:
+        if cancel:
+            for background in self.active():
+                self.cancel(background.id)
+
+        self._executor.shutdown(wait=True)
@@ -3,13 +3,28 @@
 
 from typing import Optional, List, Dict, DefaultDict, Union, Any
 import json
+import os
 import subprocess
+import threading
+import time
 from collections import defaultdict
 import shlex
 
+from utils import run_command
+
 
 LINUX_DEV_DIR = "/dev/"
-LSBLK_CMD_LINE = ["lsblk", "-b", "-O", "--json"]
+SYSFS_BLOCK_DIR = "/sys/class/block/"
+SYSFS_SECTOR_SIZE = 512 # les positions et tailles de sysfs sont toujours en secteurs de 512 octets
+DEVICE_PROPS = ("name", "model", "vendor", "type", "size", "state", "owner", "group", "serial", "rm", "wwn")
+PARTITION_PROPS = ("name", "fstype", "mountpoint", "label", "uuid", "partlabel", "partuuid", "type", "size", "owner", "group")
+PARTITION_INDEXES = ("uuid", "label", "partlabel", "partuuid")
+DEVICE_SELECTORS = ("path", "serial", "uuid", "partuuid", "label")
+# Uniquement les colonnes utilisées: bien plus rapide que -O sur les machines à milliers de devices
+LSBLK_COLUMNS = sorted(set(DEVICE_PROPS) | set(PARTITION_PROPS))
+LSBLK_CMD_LINE = ["lsblk", "-b", "--json", "-o", ",".join(LSBLK_COLUMNS)]
+LSBLK_CACHE_TTL = 2.0  # secondes
+LSBLK_CACHE_FILE = os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), "wildcopy-lsblk-{}.json".format(os.getuid()))
 
 
 class PartitionNotMounted(Exception):
@@ -17,16 +32,29 @@ class PartitionNotMounted(Exception):
 
 
 class BlockDevices:
-    def __init__(self) -> None:
-        self._json = self._get_json()
+    """Supports listés par lsblk. 'removables_only' et 'ignore_types' filtrent dès la lecture
+    de la sortie de lsblk: les entrées écartées ne sont jamais instanciées. Les partitions ne sont
+    construites qu'à la première demande.
+    """
+    def __init__(self, removables_only: bool=False, ignore_types: Optional[List[str]]=None) -> None:
+        self._removables_only = removables_only
+        self._ignore_types = set(ignore_types or [])
+
         self._devices: List[Device] = list()
         self._types: DefaultDict[str, List[Device]] = defaultdict(list)
         self._removables: DefaultDict[bool, List[Device]] = defaultdict(list)
         self._by_name: Dict[str, Device] = dict()
         self._by_path: Dict[str, Device] = dict()
-        self._partitions_by_path: Dict[str, Partition] = dict()
+        self._by_serial: Dict[str, Device] = dict()
+
+        # index des partitions, construits à la première recherche de partition
+        self._partitions_by_path: Optional[Dict[str, Partition]] = None
+        self._partitions_by: Dict[str, Dict[str, Partition]] = dict()
+
+        for dev in self._get_json():
+            if not self._keep(dev):
+                continue
 
-        for dev in self._json:
             device = Device(dev)
             self._devices.append(device)
             self._types[device.type].append(device)
@@ -34,16 +62,48 @@ class BlockDevices:
             self._by_name[device.name] = device
             self._by_path[device.path] = device
 
-            for partition in device.get_partitions():
-                self._partitions_by_path[partition.path] = partition
+            if device.serial:
+                self._by_serial[device.serial] = device
+
+
+    def _keep(self, dev: Dict[str, Any]) -> bool:
+        """Filtrage sur le json brut, avant toute instanciation
+        """
+        if self._removables_only and dev.get("rm") is not True:
+            return False
+
+        return dev.get("type") not in self._ignore_types
 
 
     def _get_json(self) -> Any:
-        cmd_res = subprocess.run(LSBLK_CMD_LINE, stdout=subprocess.PIPE)
-        return json.loads(cmd_res.stdout.decode())["blockdevices"]
+        return json.loads(_run_lsblk())["blockdevices"]
+
+
+    def _index_partitions(self) -> None:
+        # construits à part puis publiés d'un coup: l'instance peut être partagée entre threads (cache)
+        by_path: Dict[str, Partition] = dict()
+        by: Dict[str, Dict[str, Partition]] = {key: dict() for key in PARTITION_INDEXES}
+
+        for device in self._devices:
+            for partition in device.get_partitions():
+                by_path[partition.path] = partition
+
+                for key, index in by.items():
+                    value = getattr(partition, key)
+                    if value:
+                        index[value] = partition
+
+        self._partitions_by = by
+        self._partitions_by_path = by_path
+
+
+    def _get_partition_by(self, key: str, value: str) -> Optional['Partition']:
+        if self._partitions_by_path is None:
+            self._index_partitions()
+
+        return self._partitions_by[key].get(value, None)
 
 
-    #TODO plutôt ignore_types: List[str]
     def get_all(self, ignore_loop=True) -> List['Device']:
         """Return a list of all device. Loop devices ignored by default
         """
@@ -73,25 +133,201 @@ class BlockDevices:
         return self._by_path.get(device_path, None)
 
 
+    def get_by_serial(self, serial: str) -> 'Device':
+        """Le numéro de série ne change pas quand le noyau renomme le support (sdb -> sdc)
+        """
+        return self._by_serial.get(serial, None)
+
+
     def get_partition_by_path(self, part_path:str) -> 'Partition':
+        if self._partitions_by_path is None:
+            self._index_partitions()
+
         return self._partitions_by_path.get(part_path, None)
 
 
+    def get_partition_by_uuid(self, uuid: str) -> 'Partition':
+        return self._get_partition_by("uuid", uuid)
+
+
+    def get_partition_by_label(self, label: str) -> 'Partition':
+        """Label du système de fichiers ou, à défaut, label de partition (gpt)
+        """
+        return self._get_partition_by("label", label) or self._get_partition_by("partlabel", label)
+
+
+    def get_partition_by_partuuid(self, partuuid: str) -> 'Partition':
+        return self._get_partition_by("partuuid", partuuid)
+
+
+    def get_device_of(self, partition: 'Partition') -> 'Device':
+        """Support contenant 'partition'
+        """
+        return self._by_name.get(partition.parent_name, None)
+
+
+    def find(self, selector: str) -> Optional['Device']:
+        """Retourne le support désigné par 'selector': "path:/dev/sdb", "serial:...", "uuid:...",
+        "partuuid:..." ou "label:..." (ces trois derniers désignent le support d'une de ses partitions).
+        Sans préfixe, on essaie le chemin, puis le numéro de série, puis le label.
+        """
+        kind, _, value = selector.partition(":")
+        if kind not in DEVICE_SELECTORS:
+            kind, value = "", selector
+
+        if kind in ["", "path"] and self.get_by_path(value):
+            return self.get_by_path(value)
+
+        if kind in ["", "serial"] and self.get_by_serial(value):
+            return self.get_by_serial(value)
+
+        getters = {"uuid": self.get_partition_by_uuid, "partuuid": self.get_partition_by_partuuid, "label": self.get_partition_by_label}
+
+        for key, getter in getters.items():
+            if kind == key or (not kind and key == "label"):
+                partition = getter(value)
+                if partition:
+                    return self.get_device_of(partition)
+
+        return None
+
+
     def __repr__(self) -> str:
         return "{}".format(" ".join([device.name for device in self.get_all()]))
 
 
 
+def read_sysfs(name: str, attr: str) -> Optional[str]:
+    """Lit l'attribut 'attr' (ex: "queue/discard_max_bytes") du périphérique bloc 'name' dans sysfs.
+    Retourne None si l'attribut n'existe pas
+    """
+    try:
+        with open(os.path.join(SYSFS_BLOCK_DIR, name, attr)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def read_sysfs_int(name: str, attr: str, default: int=0) -> int:
+    value = read_sysfs(name, attr)
+
+    try:
+        return int(value) if value is not None else default
+    except ValueError:
+        return default
+
+
+def _run_lsblk() -> str:
+    cmd_res = run_command(LSBLK_CMD_LINE, stdout=subprocess.PIPE)
+    return cmd_res.stdout.decode()
+
+
+def _dev_dir_stamp() -> int:
+    """mtime de /dev, modifié par udev à chaque ajout ou retrait d'un noeud de périphérique
+    """
+    try:
+        return os.stat(LINUX_DEV_DIR).st_mtime_ns
+    except OSError:
+        return 0
+
+
+class _CachedBlockDevices(BlockDevices):
+    """BlockDevices construit à partir d'une sortie de lsblk déjà lue
+    """
+    def __init__(self, raw: str, removables_only: bool=False) -> None:
+        self._raw = raw
+        super().__init__(removables_only=removables_only)
+
+    def _get_json(self) -> Any:
+        return json.loads(self._raw)["blockdevices"]
+
+
+_cache_lock = threading.Lock()
+_cache: Dict[str, Any] = dict()
+
+
+def get_block_devices(max_age: float=LSBLK_CACHE_TTL, removables_only: bool=False) -> BlockDevices:
+    """Retourne un BlockDevices dont la sortie de lsblk a au plus 'max_age' secondes.
+    Le cache est partagé entre processus (fichier dans XDG_RUNTIME_DIR) et invalidé
+    dès que le contenu de /dev change (branchement ou retrait d'un support).
+    'max_age' à 0 force une nouvelle lecture.
+    """
+    now = time.time()
+    stamp = _dev_dir_stamp()
+
+    with _cache_lock:
+        if max_age > 0 and _cache and _cache["stamp"] == stamp and now - _cache["time"] < max_age:
+            if removables_only not in _cache["blockdevices"]:
+                _cache["blockdevices"][removables_only] = _CachedBlockDevices(_cache["raw"], removables_only)
+            return _cache["blockdevices"][removables_only]
+
+        raw = _read_cache_file(stamp, now, max_age) if max_age > 0 else None
+
+        if raw is None:
+            raw = _run_lsblk()
+            _write_cache_file(stamp, now, raw)
+
+        blockdevices = _CachedBlockDevices(raw, removables_only)
+        _cache.update({"stamp": stamp, "time": now, "raw": raw, "blockdevices": {removables_only: blockdevices}})
+
+        return blockdevices
+
+
+def invalidate_cache() -> None:
+    """Vide le cache de lsblk, à appeler après toute modification d'un support
+    """
+    with _cache_lock:
+        _cache.clear()
+
+        try:
+            os.remove(LSBLK_CACHE_FILE)
+        except OSError:
+            pass
+
+
+def _read_cache_file(stamp: int, now: float, max_age: float) -> Optional[str]:
+    try:
+        with open(LSBLK_CACHE_FILE) as f:
+            if os.fstat(f.fileno()).st_uid != os.getuid():  # fichier déposé par un autre utilisateur
+                return None
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if cached.get("stamp") != stamp or not 0 <= now - cached.get("time", 0) < max_age:
+        return None
+
+    return cached.get("raw")
+
+
+def _write_cache_file(stamp: int, now: float, raw: str) -> None:
+    tmp_path = "{}.{}".format(LSBLK_CACHE_FILE, os.getpid())
+
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"stamp": stamp, "time": now, "raw": raw}, f)
+        os.replace(tmp_path, LSBLK_CACHE_FILE)
+    except OSError:
+        pass
+
+
 class Device:
+    __slots__ = DEVICE_PROPS + ("path", "ident", "_children", "_partitions", "_partitions_by_name", "_partitions_by_path")
+
     @classmethod
     def from_path(cls, device_path: str) -> 'Device':
         return BlockDevices().get_by_path(device_path)
 
 
-    def __init__(self, _json: Dict[str, Any]) -> None:
-        self._json = _json
-        self._props = ["name", "model", "vendor", "type", "size", "state", "owner", "group", "serial", "rm", "size"]
+    @classmethod
+    def from_serial(cls, serial: str) -> 'Device':
+        """Retrouve un support par son numéro de série, quel que soit le nom que lui a donné le noyau
+        """
+        return BlockDevices(removables_only=True).get_by_serial(serial)
+
 
+    def __init__(self, _json: Dict[str, Any]) -> None:
         self.name: str
         self.model: str
         self.vendor: str
@@ -102,36 +338,59 @@ class Device:
         self.group: str
         self.serial: str
         self.rm: bool
+        self.wwn: str
 
-        for prop in self._props:
-            setattr(self, prop, self._json[prop])
+        for prop in DEVICE_PROPS:
+            setattr(self, prop, _json.get(prop))
 
-        self.hrsize = Unit(self.size)
         self.path = LINUX_DEV_DIR + self.name
         self.model = self.model.strip() if self.model else ""
         self.vendor = self.vendor.strip() if self.vendor else ""
+        self.serial = self.serial.strip() if self.serial else ""
         self.ident = self.model or self.serial
 
-        self._partitions: List['Partition'] = list()
+        # construites à la première demande, à partir du json des partitions (libéré ensuite)
+        self._children: Optional[List[Dict[str, Any]]] = _json.get("children") or []
+        self._partitions: Optional[List['Partition']] = None
         self._partitions_by_name: Dict[str, 'Partition'] = dict()
         self._partitions_by_path: Dict[str, 'Partition'] = dict()
 
-        for part in _json.get("children", []):
-            partition = Partition(part)
-            self._partitions.append(partition)
-            self._partitions_by_name[partition.name] = partition
-            self._partitions_by_path[partition.path] = partition
 
+    @property
+    def hrsize(self) -> 'Unit':
+        return Unit(self.size)
+
+
+    @property
+    def stable_id(self) -> str:
+        """Identifiant qui survit au renommage du support par le noyau (numéro de série ou wwn)
+        """
+        return self.serial or self.wwn or self.path
+
+
+    def _load_partitions(self) -> List['Partition']:
+        if self._partitions is None:
+            partitions = [Partition(part, self.name) for part in self._children]
+
+            self._partitions_by_name = {partition.name: partition for partition in partitions}
+            self._partitions_by_path = {partition.path: partition for partition in partitions}
+            self._partitions = partitions
+            self._children = None
 
-    def get_partitions(self) -> List['Partition']:
         return self._partitions
 
 
+    def get_partitions(self) -> List['Partition']:
+        return self._load_partitions()
+
+
     def get_partition_by_name(self, name: str) -> 'Partition':
+        self._load_partitions()
         return self._partitions_by_name.get(name, None)
 
 
     def get_partition_by_path(self, path: str) -> 'Partition':
+        self._load_partitions()
         return self._partitions_by_path.get(path, None)
 
 
@@ -139,14 +398,21 @@ class Device:
         return self.rm == True
 
 
+    def supports_discard(self) -> bool:
+        """Retourne 'True' si le support accepte les requêtes discard (TRIM)
+        """
+        return read_sysfs_int(self.name, "queue/discard_max_bytes") > 0
+
+
     def __repr__(self) -> str:
-        return "Path: {}  Device: {}  Size: {}  Partitions: {}  Removable: {}  Type: {}".format(self.path, self.ident, self.hrsize.hr, len(self._partitions), self.is_removable(), self.type)
+        return "Path: {}  Device: {}  Size: {}  Partitions: {}  Removable: {}  Type: {}".format(self.path, self.ident, self.hrsize.hr, len(self.get_partitions()), self.is_removable(), self.type)
 
 
 class Partition:
-    def __init__(self, _json: Dict[str, str]) -> None:
-        self._json = _json
-        self._props = ["name", "fstype", "mountpoint", "label", "uuid", "partlabel", "partuuid", "type", "size", "owner", "group"]
+    __slots__ = PARTITION_PROPS + ("path", "parent_name")
+
+    def __init__(self, _json: Dict[str, str], parent_name: str="") -> None:
+        self.parent_name = parent_name
 
         self.name: str
         self.fstype: str
@@ -160,13 +426,17 @@ class Partition:
         self.owner: str
         self.group: str
 
-        for prop in self._props:
-            setattr(self, prop, _json[prop])
+        for prop in PARTITION_PROPS:
+            setattr(self, prop, _json.get(prop))
 
-        self.hrsize = Unit(self.size)
         self.path = LINUX_DEV_DIR + self.name
 
 
+    @property
+    def hrsize(self) -> 'Unit':
+        return Unit(self.size)
+
+
     def __repr__(self) -> str:
         s = "Partition: {}  Filesystem: {}  Size: {}  Mountpoint: {}".format(self.path, self.fstype, self.hrsize.hr, self.mountpoint or "-")
 
@@ -180,6 +450,13 @@ class Partition:
 
         return s
 
+    @property
+    def start(self) -> int:
+        """Position du début de la partition sur le support, en octets
+        """
+        return read_sysfs_int(self.name, "start") * SYSFS_SECTOR_SIZE
+
+
     def is_mounted(self) -> bool:
         """Retourne True si la partition est montée, False sinon
         """
@@ -189,7 +466,7 @@ class Partition:
     def is_listable(self) -> bool:
         if self.is_mounted():
             cmd = "test -r {}; echo \"$?\"".format(self.mountpoint)
-            cmd_res = subprocess.run(cmd, stdout=subprocess.PIPE, shell=True)
+            cmd_res = run_command(cmd, name="test", stdout=subprocess.PIPE, shell=True)
             return cmd_res.stdout.decode().strip() == "0"
         return False
 
@@ -200,7 +477,7 @@ class Partition:
         
         if self.is_listable():
             cmd = ["ls", "-A", self.mountpoint]  # ls -A --almost-all  do not list implied . and ..
-            cmd_res = subprocess.run(cmd, stdout=subprocess.PIPE)
+            cmd_res = run_command(cmd, stdout=subprocess.PIPE)
             part_content = cmd_res.stdout.decode().strip()
 
             return not part_content
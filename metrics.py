@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Métriques de la station de copie: compteurs et histogrammes exportés dans un fichier local,
+au format texte de Prometheus (node_exporter, collecteur textfile) ou en JSON.
+
+Les valeurs sont celles du processus courant, depuis son démarrage.
+"""
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from utils import get_logger
+
+
+logger = get_logger("metrics", "INFO")
+
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+EXPORT_INTERVAL = 15.0 # secondes
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]]=None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+
+    if not pairs:
+        return ""
+
+    return "{" + ",".join('{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs) + "}"
+
+
+class Counter:
+    """Compteur croissant, éventuellement ventilé par labels
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values: Dict[LabelKey, float] = dict()
+
+
+    def inc(self, amount: float=1, **labels: Any) -> None:
+        key = _label_key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+
+    def prometheus(self) -> List[str]:
+        with self._lock:
+            return ["{}{} {}".format(self.name, _format_labels(key), value) for key, value in sorted(self._values.items())]
+
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [{"labels": dict(key), "value": value} for key, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    """Valeur instantanée
+    """
+    kind = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+
+class Histogram:
+    """Répartition de valeurs (durées...) par seuils cumulés
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...]=DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series: Dict[LabelKey, Dict[str, Any]] = dict()
+
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _label_key(labels)
+
+        with self._lock:
+            series = self._series.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+
+            series["sum"] += value
+            series["count"] += 1
+
+
+    def prometheus(self) -> List[str]:
+        lines = list()
+
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series["counts"]):
+                    lines.append("{}_bucket{} {}".format(self.name, _format_labels(key, ("le", str(bound))), count))
+                lines.append("{}_bucket{} {}".format(self.name, _format_labels(key, ("le", "+Inf")), series["count"]))
+                lines.append("{}_sum{} {}".format(self.name, _format_labels(key), series["sum"]))
+                lines.append("{}_count{} {}".format(self.name, _format_labels(key), series["count"]))
+
+        return lines
+
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [{"labels": dict(key), "count": s["count"], "sum": s["sum"], "buckets": dict(zip(self.buckets, s["counts"]))} for key, s in sorted(self._series.items())]
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Any] = dict()
+        self.start_time = time.time()
+
+
+    def _register(self, metric: Any) -> Any:
+        return self._metrics.setdefault(metric.name, metric)
+
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._register(Counter(name, help))
+
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._register(Gauge(name, help))
+
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...]=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, buckets))
+
+
+    def prometheus(self) -> str:
+        """Format texte d'exposition de Prometheus
+        """
+        lines = list()
+
+        for metric in self._metrics.values():
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            lines += metric.prometheus()
+
+        return "\n".join(lines) + "\n"
+
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Instantané JSON, avec le débit de la station en supports par heure
+        """
+        uptime = time.time() - self.start_time
+
+        return {
+            "timestamp": time.time(),
+            "uptime_seconds": uptime,
+            "devices_per_hour": DEVICES_COMPLETED.value(status="ok") * 3600 / uptime if uptime > 0 else 0.0,
+            "metrics": {name: metric.snapshot() for name, metric in self._metrics.items()},
+        }
+
+
+    def write(self, path: str) -> None:
+        """Écrit les métriques dans 'path' (JSON si l'extension est .json, sinon texte Prometheus).
+        Écriture atomique: un collecteur ne lit jamais un fichier à moitié écrit
+        """
+        if path.endswith(".json"):
+            content = json.dumps(self.snapshot(), indent=2)
+        else:
+            content = self.prometheus()
+
+        tmp_path = "{}.{}".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+
+REGISTRY = Registry()
+
+DEVICES_COMPLETED = REGISTRY.counter("wildcopy_devices_completed_total", "Supports traités, par statut (ok, failed, rejected, cancelled)")
+BYTES_WRITTEN = REGISTRY.counter("wildcopy_bytes_written_total", "Octets écrits sur les supports")
+BYTES_DEDUPED = REGISTRY.counter("wildcopy_bytes_deduped_total", "Octets non écrits grâce aux liens entre fichiers identiques")
+PHASE_SECONDS = REGISTRY.histogram("wildcopy_phase_duration_seconds", "Durée des phases d'une copie (probe, reset, partition, format, copy, restore, umount)")
+VERIFY_FAILURES = REGISTRY.counter("wildcopy_verify_failures_total", "Vérifications en échec, par contrôle (capacity, image)")
+SPAWNS = REGISTRY.counter("wildcopy_process_spawns_total", "Processus lancés, par commande (lsblk, udisksctl, mke2fs...)")
+START_TIME = REGISTRY.gauge("wildcopy_start_time_seconds", "Démarrage du processus (epoch)")
+START_TIME.set(REGISTRY.start_time)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Mesure la durée du bloc comme phase 'name'
+    """
+    start = time.monotonic()
+
+    try:
+        yield
+    finally:
+        PHASE_SECONDS.observe(time.monotonic() - start, phase=name)
+
+
+class Exporter:
+    """Réécrit le fichier de métriques toutes les 'interval' secondes, et une dernière fois à l'arrêt
+    """
+    def __init__(self, path: str, interval: float=EXPORT_INTERVAL, registry: Registry=REGISTRY) -> None:
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-exporter", daemon=True)
+
+
+    def start(self) -> 'Exporter':
+        self._thread.start()
+        return self
+
+
+    def stop(self) -> None:
+        """Ne lève pas d'exception: appelé dans des 'finally', il ne doit pas masquer le bilan des copies
+        """
+        self._stop.set()
+        self._thread.join()
+        self._write()
+
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._write()
+
+
+    def _write(self) -> None:
+        try:
+            self.registry.write(self.path)
+        except OSError as e:
+            logger.error("Écriture des métriques dans {} impossible: {}".format(self.path, e))
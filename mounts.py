@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Montage et démontage directs par les appels système mount(2) et umount2(2), sans udisksctl
+ni su: un appel système au lieu de plusieurs processus, et un point de montage connu d'avance
+(MOUNT_ROOT/<partition>), sans relire lsblk.
+
+Réservé à root. Options adaptées à l'écriture en masse: noatime, et pour ext3/ext4 un
+intervalle de commit du journal allongé (le démontage écrit de toute façon tout sur le support).
+"""
+
+from typing import Dict, Optional
+import ctypes
+import ctypes.util
+import errno
+import os
+import re
+import threading
+
+from utils import get_logger
+
+
+logger = get_logger("mounts", "INFO")
+
+MOUNT_ROOT = "/run/wildcopy/mnt"
+MOUNTINFO = "/proc/self/mountinfo"
+
+# linux/mount.h
+MS_NOATIME = 1024
+MS_NODIRATIME = 2048
+
+MOUNT_FLAGS = MS_NOATIME | MS_NODIRATIME
+COMMIT_INTERVAL = 60 # secondes
+MOUNT_DATA = {"ext3": "commit={}".format(COMMIT_INTERVAL), "ext4": "commit={}".format(COMMIT_INTERVAL)}
+
+_libc: Optional[ctypes.CDLL] = None
+_lock = threading.Lock()
+_mounted: Dict[str, str] = dict() # partition -> point de montage, pour les montages de ce processus
+
+
+class MountError(OSError):
+    """mount(2) ou umount2(2) en échec
+    """
+
+
+def _get_libc() -> ctypes.CDLL:
+    global _libc
+
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+    return _libc
+
+
+def mountpoint_for(partition_path: str) -> str:
+    return os.path.join(MOUNT_ROOT, os.path.basename(partition_path))
+
+
+def mounted_at(partition_path: str) -> Optional[str]:
+    """Point de montage de la partition si elle a été montée par ce processus
+    """
+    return _mounted.get(partition_path)
+
+
+def system_mountpoint(partition_path: str) -> Optional[str]:
+    """Point de montage de la partition, quel que soit qui l'a montée (udisks, bureau...),
+    d'après MOUNTINFO: pas de lsblk. 'None' si elle n'est pas montée
+    """
+    try:
+        rdev = os.stat(partition_path).st_rdev
+        with open(MOUNTINFO) as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+
+    device = "{}:{}".format(os.major(rdev), os.minor(rdev))
+
+    for line in lines:
+        # id parent majeur:mineur racine point_de_montage ...
+        fields = line.split()
+        if len(fields) > 4 and fields[2] == device:
+            # espaces, tabulations... échappés en octal (\040)
+            return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[4])
+
+    return None
+
+
+def mount(partition_path: str, fstype: str, flags: int=MOUNT_FLAGS, data: Optional[str]=None) -> str:
+    """Monte la partition sur MOUNT_ROOT/<partition>. Retourne le point de montage
+    """
+    target = mountpoint_for(partition_path)
+    data = MOUNT_DATA.get(fstype, "") if data is None else data
+
+    os.makedirs(target, mode=0o700, exist_ok=True)
+
+    ret = _get_libc().mount(partition_path.encode(), target.encode(), fstype.encode(), ctypes.c_ulong(flags), data.encode() if data else None)
+
+    if ret != 0:
+        err = ctypes.get_errno()
+        _remove_dir(target)
+        raise MountError(err, "mount {} sur {}: {}".format(partition_path, target, os.strerror(err)))
+
+    with _lock:
+        _mounted[partition_path] = target
+
+    logger.info("{} montée sur {} ({})".format(partition_path, target, data or "-"))
+
+    return target
+
+
+def umount(partition_path: str) -> None:
+    """Démonte la partition montée par 'mount' et supprime son point de montage. Pas de démontage
+    différé si elle est occupée: elle serait encore écrite pendant le formatage suivant
+    """
+    with _lock:
+        target = _mounted.get(partition_path) or mountpoint_for(partition_path)
+
+    ret = _get_libc().umount2(target.encode(), 0)
+
+    err = ctypes.get_errno() if ret != 0 else 0
+
+    if err and err not in (errno.EINVAL, errno.ENOENT): # EINVAL, ENOENT: pas (ou plus) monté
+        raise MountError(err, "umount {}: {}".format(target, os.strerror(err)))
+
+    with _lock:
+        _mounted.pop(partition_path, None)
+
+    _remove_dir(target)
+
+    if not err:
+        logger.info("Démonté: {}".format(partition_path))
+
+
+def _remove_dir(target: str) -> None:
+    try:
+        os.rmdir(target)
+    except OSError:
+        pass
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Sonde rapide d'un support avant copie: débit d'écriture/lecture séquentiel mesuré sur quelques
+zones réparties sur tout le support, et vérification que la capacité annoncée est réelle
+(les clés contrefaites reviennent au début une fois leur capacité réelle dépassée).
+
+Pour qu'un tel repli se voie, des zones sont aussi écrites aux capacités réelles plausibles
+(puissances de deux, binaires et décimales, comme f3probe): sur une contrefaçon, l'une d'elles
+retombe sur la zone 0, écrite avant elle.
+
+ATTENTION: destructif pour les zones sondées. À n'utiliser que sur un support qui va être
+remis à zéro ou reformaté.
+"""
+
+from typing import List, Optional
+import mmap
+import os
+import struct
+import time
+
+from utils import get_logger
+
+
+logger = get_logger("probe", "INFO")
+
+DEFAULT_SAMPLES = 8
+DEFAULT_SAMPLE_SIZE = 4 * 1024 * 1024
+PROBE_ALIGN = 1024 * 1024
+DIRECT_ALIGN = 4096 # alignement suffisant pour O_DIRECT, y compris sur les supports 4Kn
+SECTOR_SIZE = 512
+MIN_WRAP_CAPACITY = 256 * 1024 * 1024 # plus petite capacité réelle de contrefaçon recherchée
+WRAP_BASES = (MIN_WRAP_CAPACITY, 250 * 10**6) # capacités binaires (256 MiB...) et décimales (250 MB...)
+HEADER = struct.Struct("<8sQQ")  # magic, nonce, position absolue du secteur
+MAGIC = b"WCPROBE0"
+
+
+class ProbeResult:
+    """Résultat de la sonde d'un support
+    """
+    def __init__(self, path: str, size: int) -> None:
+        self.path = path
+        self.size = size
+        self.write_bps = 0.0
+        self.read_bps = 0.0
+        self.bad_offsets: List[int] = list()
+        self.errors: List[str] = list()
+
+
+    @property
+    def genuine(self) -> bool:
+        """'False' si des zones relues ne correspondent pas à ce qui y a été écrit
+        """
+        return not self.bad_offsets and not self.errors
+
+
+    def __repr__(self) -> str:
+        s = "Probe: {}  Écriture: {:.1f} MB/s  Lecture: {:.1f} MB/s".format(self.path, self.write_bps / 10**6, self.read_bps / 10**6)
+
+        if not self.genuine:
+            s += "  CAPACITÉ DOUTEUSE ({} zone(s) en erreur)".format(len(self.bad_offsets) + len(self.errors))
+
+        return s
+
+
+class ProbeRules:
+    """Règles de rejet d'un support après sonde. 0: pas de minimum
+    """
+    def __init__(self, min_write_bps: float=0, min_read_bps: float=0, reject_fake: bool=True) -> None:
+        self.min_write_bps = min_write_bps
+        self.min_read_bps = min_read_bps
+        self.reject_fake = reject_fake
+
+
+    def reject_reason(self, result: ProbeResult) -> Optional[str]:
+        """Raison du rejet du support, 'None' s'il est accepté
+        """
+        if self.reject_fake and not result.genuine:
+            return "capacité annoncée non vérifiée ({})".format(", ".join(result.errors) or "données relues incorrectes")
+
+        if self.min_write_bps and result.write_bps < self.min_write_bps:
+            return "écriture trop lente: {:.1f} MB/s".format(result.write_bps / 10**6)
+
+        if self.min_read_bps and result.read_bps < self.min_read_bps:
+            return "lecture trop lente: {:.1f} MB/s".format(result.read_bps / 10**6)
+
+        return None
+
+
+def wrap_offsets(size: int, sample_size: int=DEFAULT_SAMPLE_SIZE) -> List[int]:
+    """Capacités réelles plausibles d'une contrefaçon, en dessous de 'size': une zone écrite
+    à un multiple de la capacité réelle retombe sur la zone 0
+    """
+    last = size - sample_size
+    offsets = set()
+
+    for capacity in WRAP_BASES:
+        while capacity <= last:
+            offsets.add(capacity // DIRECT_ALIGN * DIRECT_ALIGN)
+            capacity *= 2
+
+    return sorted(offsets)
+
+
+def sample_offsets(size: int, samples: int=DEFAULT_SAMPLES, sample_size: int=DEFAULT_SAMPLE_SIZE) -> List[int]:
+    """Positions des zones sondées: 0, les capacités de 'wrap_offsets', puis 'samples' zones
+    alignées et réparties du début à la toute fin du support. Les zones ne se chevauchent pas,
+    sans quoi un support sain serait vu comme contrefait
+    """
+    last = (size - sample_size) // PROBE_ALIGN * PROBE_ALIGN
+
+    if last <= 0:
+        return [0]
+
+    if samples < 2:
+        spread = [last]
+    else:
+        step = last / (samples - 1)
+        spread = [int(i * step) // PROBE_ALIGN * PROBE_ALIGN for i in range(samples - 1)] + [last]
+
+    offsets: List[int] = list()
+
+    for offset in [0] + wrap_offsets(size, sample_size) + spread:
+        if all(abs(offset - other) >= sample_size for other in offsets):
+            offsets.append(offset)
+
+    return sorted(offsets)
+
+
+def _fill_pattern(buf: mmap.mmap, offset: int, nonce: int) -> None:
+    """Données aléatoires dont chaque secteur commence par sa position absolue sur le support
+    """
+    buf.seek(0)
+    buf.write(os.urandom(len(buf)))
+
+    for pos in range(0, len(buf), SECTOR_SIZE):
+        HEADER.pack_into(buf, pos, MAGIC, nonce, offset + pos)
+
+
+def _open_direct(path: str) -> int:
+    """Ouvre le support en O_DIRECT pour que la relecture vienne du support et non du cache
+    """
+    flags = os.O_RDWR | os.O_EXCL | getattr(os, "O_DIRECT", 0)
+
+    return os.open(path, flags)
+
+
+def probe_device(path: str, size: int, samples: int=DEFAULT_SAMPLES, sample_size: int=DEFAULT_SAMPLE_SIZE) -> ProbeResult:
+    """Écrit un motif unique sur chaque zone, dans l'ordre, puis relit tout. Une contrefaçon qui
+    boucle sur sa capacité réelle écrase les premières zones avec les suivantes, ou renvoie des
+    erreurs d'E/S. Les zones basses, celles que les suivantes écrasent, sont relues une
+    dernière fois à la fin
+    """
+    result = ProbeResult(path, size)
+    offsets = sample_offsets(size, samples, sample_size)
+    nonce = struct.unpack("<Q", os.urandom(8))[0]
+
+    logger.info("Sonde de {} ({} zones de {} octets)".format(path, len(offsets), sample_size))
+
+    expected = mmap.mmap(-1, sample_size)  # mmap: tampons alignés sur la page, requis par O_DIRECT
+    readback = mmap.mmap(-1, sample_size)
+    written: List[int] = list()
+
+    fd = _open_direct(path)
+    try:
+        start = time.monotonic()
+        for offset in offsets:
+            _fill_pattern(expected, offset, nonce)
+            try:
+                if os.pwrite(fd, expected, offset) < sample_size:
+                    result.errors.append("écriture incomplète à {}".format(offset))
+                    continue
+                written.append(offset)
+            except OSError as e:
+                result.errors.append("écriture à {}: {}".format(offset, e.strerror))
+        os.fsync(fd)
+        elapsed = time.monotonic() - start
+        result.write_bps = len(written) * sample_size / elapsed if elapsed else 0.0
+
+        start = time.monotonic()
+        for offset in written:
+            _read_and_check(fd, readback, offset, nonce, result)
+        elapsed = time.monotonic() - start
+        result.read_bps = len(written) * sample_size / elapsed if elapsed else 0.0
+
+        # après toutes les lectures: un cache du support ne peut plus masquer un repli
+        for offset in written:
+            if offset < MIN_WRAP_CAPACITY and offset not in result.bad_offsets:
+                _read_and_check(fd, readback, offset, nonce, result)
+    finally:
+        os.close(fd)
+        expected.close()
+        readback.close()
+
+    logger.info(str(result))
+
+    return result
+
+
+def _read_and_check(fd: int, buf: mmap.mmap, offset: int, nonce: int, result: ProbeResult) -> None:
+    try:
+        if os.preadv(fd, [buf], offset) < len(buf):
+            result.errors.append("lecture incomplète à {}".format(offset))
+            return
+    except OSError as e:
+        result.errors.append("lecture à {}: {}".format(offset, e.strerror))
+        return
+
+    _check_pattern(buf, offset, nonce, result)
+
+
+def _check_pattern(buf: mmap.mmap, offset: int, nonce: int, result: ProbeResult) -> None:
+    """Vérifie les en-têtes des secteurs relus. Un en-tête d'une autre zone révèle un repli
+    de la capacité
+    """
+    for pos in range(0, len(buf), SECTOR_SIZE):
+        magic, found_nonce, found_offset = HEADER.unpack_from(buf, pos)
+
+        if magic != MAGIC or found_nonce != nonce or found_offset != offset + pos:
+            result.bad_offsets.append(offset)
+
+            if magic == MAGIC and found_nonce == nonce:
+                logger.warning("{}: la zone {} contient les données écrites en {}".format(result.path, offset + pos, found_offset))
+
+            return
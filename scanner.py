@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Parcours parallèle d'une arborescence source avec un pool de threads os.scandir.
+
+Sur un partage réseau (NFS, SMB) chaque lecture de répertoire coûte un aller-retour: plusieurs
+répertoires sont lus en même temps. Les entrées sont remises au fur et à mesure à la copie,
+qui démarre sans attendre la fin du parcours; un répertoire est toujours remis avant son contenu.
+Les totaux (fichiers, octets) servent à l'avancement et vérifient au plus tôt que la charge
+tient sur le support; la perte en fin de clusters, comptée pour quelques tailles de cluster,
+sert à choisir celle d'un système FAT sans second parcours.
+"""
+
+from typing import Dict, Iterator, List, Optional, Sequence
+import os
+import queue
+import stat
+import threading
+
+from utils import get_logger
+
+
+logger = get_logger("scanner", "INFO")
+
+DEFAULT_SCAN_WORKERS = 8
+DEFAULT_BLOCK_SIZE = 4096 # unité d'allocation supposée pour estimer la place occupée
+SCAN_QUEUE_ENTRIES = 100000 # entrées parcourues d'avance au plus
+PUT_TIMEOUT = 0.5 # secondes, pour remarquer l'arrêt du parcours
+
+# kinds
+FILE, DIR, SYMLINK, OTHER = "file", "dir", "symlink", "other"
+
+
+class PayloadTooLarge(Exception):
+    """La source ne tient pas sur le support
+    """
+
+
+class ScanEntry:
+    """Entrée de la source: chemin, chemin relatif à la racine, type et lstat
+    """
+    __slots__ = ("path", "rel", "kind", "st")
+
+    def __init__(self, path: str, rel: str, kind: str, st: os.stat_result) -> None:
+        self.path = path
+        self.rel = rel
+        self.kind = kind
+        self.st = st
+
+
+    def __repr__(self) -> str:
+        return "ScanEntry: {}  {}  {} octets".format(self.rel, self.kind, self.st.st_size)
+
+
+class _EndOfScan:
+    """Fin du parcours"""
+
+END_OF_SCAN = _EndOfScan()
+
+
+class TreeScanner:
+    """Parcours de 'src' par 'workers' threads. Itérer donne les entrées (une seule itération).
+    'limit' (octets, 0: pas de limite): le parcours s'arrête en erreur dès que la place occupée
+    estimée ('allocated': fichiers arrondis à 'block_size', un bloc par répertoire) le dépasse.
+    'cluster_sizes': tailles de cluster pour lesquelles la perte en fin de fichiers ('slack')
+    est comptée
+    """
+    def __init__(self, src: str, workers: int=DEFAULT_SCAN_WORKERS, limit: int=0, block_size: int=DEFAULT_BLOCK_SIZE, cluster_sizes: Sequence[int]=()) -> None:
+        self.src = src
+        self.workers = max(1, workers)
+        self.limit = limit
+        self.block_size = block_size
+
+        self.files = 0
+        self.dirs = 0
+        self.links = 0
+        self.bytes = 0
+        self.allocated = 0
+        self.slack: Dict[int, int] = {size: 0 for size in cluster_sizes}
+        self.done = threading.Event()
+        self.error: Optional[Exception] = None
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._dirs: 'queue.Queue[Optional[str]]' = queue.Queue()
+        self._entries: 'queue.Queue[object]' = queue.Queue(maxsize=SCAN_QUEUE_ENTRIES)
+        self._pending = 0
+        self._threads: List[threading.Thread] = list()
+
+
+    def start(self) -> 'TreeScanner':
+        self._pending = 1
+        self._dirs.put(self.src)
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name="scanner-{}".format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        return self
+
+
+    def stop(self) -> None:
+        """Interrompt le parcours (copie en erreur ou annulée)
+        """
+        self._stop.set()
+
+
+    def check(self) -> None:
+        """Lève l'erreur du parcours si elle est déjà connue (charge trop grosse...)
+        """
+        if self.error is not None:
+            raise self.error
+
+
+    def settle(self) -> bool:
+        """Attend la fin du parcours, ou qu'il soit suspendu faute de consommateur (file pleine).
+        'True' si les totaux sont définitifs, sinon ils portent sur les SCAN_QUEUE_ENTRIES
+        premières entrées au moins
+        """
+        while not self.done.is_set() and not self._entries.full():
+            self.done.wait(PUT_TIMEOUT)
+
+        self.check()
+
+        return self.done.is_set()
+
+
+    def set_limit(self, limit: int) -> None:
+        """Change la limite en cours de parcours, quand la place disponible n'est connue qu'une fois
+        le support monté. Le parcours s'arrête en erreur si elle est déjà dépassée
+        """
+        with self._lock:
+            self.limit = limit
+            too_large = limit and self.allocated > limit
+
+        if too_large:
+            self._fail(self._too_large())
+
+
+    def _too_large(self) -> PayloadTooLarge:
+        return PayloadTooLarge("{}: plus de {} octets une fois écrits, le support n'en offre que {}".format(self.src, self.allocated, self.limit))
+
+
+    def _put(self, item: object) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._entries.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+
+    def _fail(self, error: Exception) -> None:
+        with self._lock:
+            if self.error is None:
+                self.error = error
+        self._stop.set()
+        self.done.set()
+
+
+    def _run(self) -> None:
+        while True:
+            dirpath = self._dirs.get()
+            if dirpath is None:
+                return
+
+            try:
+                if not self._stop.is_set():
+                    self._scan(dirpath)
+            except (OSError, PayloadTooLarge) as e:
+                self._fail(e)
+
+            with self._lock:
+                self._pending -= 1
+                finished = self._pending == 0
+
+            if finished:
+                # réveille les autres threads pour qu'ils s'arrêtent
+                for _ in self._threads:
+                    self._dirs.put(None)
+                if self.error is None:
+                    self.done.set()
+                    logger.info(str(self))
+                self._put(END_OF_SCAN)
+
+
+    def _scan(self, dirpath: str) -> None:
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                st = entry.stat(follow_symlinks=False)
+
+                if stat.S_ISDIR(st.st_mode):
+                    kind = DIR
+                elif stat.S_ISLNK(st.st_mode):
+                    kind = SYMLINK
+                elif stat.S_ISREG(st.st_mode):
+                    kind = FILE
+                else:
+                    kind = OTHER
+
+                with self._lock:
+                    if kind == DIR:
+                        self.dirs += 1
+                        self.allocated += self.block_size
+                    elif kind == SYMLINK:
+                        self.links += 1
+                    elif kind == FILE:
+                        self.files += 1
+                        self.bytes += st.st_size
+                        self.allocated += st.st_size + -st.st_size % self.block_size
+                        for size in self.slack:
+                            self.slack[size] += -st.st_size % size
+
+                    too_large = self.limit and self.allocated > self.limit
+
+                if too_large:
+                    raise self._too_large()
+
+                # le répertoire est remis avant d'être parcouru: avant son contenu
+                if not self._put(ScanEntry(entry.path, os.path.relpath(entry.path, self.src), kind, st)):
+                    return
+
+                if kind == DIR:
+                    # compté avant la fin du répertoire courant: '_pending' ne peut pas tomber à 0 entre-temps
+                    with self._lock:
+                        self._pending += 1
+                    self._dirs.put(entry.path)
+
+
+    def __iter__(self) -> Iterator[ScanEntry]:
+        while True:
+            try:
+                item = self._entries.get(timeout=PUT_TIMEOUT)
+            except queue.Empty:
+                self.check()
+                continue
+
+            if item is END_OF_SCAN:
+                self.check()
+                return
+
+            yield item
+
+
+    def __repr__(self) -> str:
+        state = "terminé" if self.done.is_set() else "en cours"
+        return "TreeScanner: {} ({})  Fichiers: {}  Répertoires: {}  Liens: {}  Octets: {}".format(self.src, state, self.files, self.dirs, self.links, self.bytes)
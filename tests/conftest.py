@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import pytest
+
+# les modules de wildcopy sont à la racine du dépôt
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeClock:
+    """Horloge simulée: 'sleep' avance le temps au lieu d'attendre
+    """
+    def __init__(self) -> None:
+        self.now = 100.0
+        self.slept = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.slept += seconds
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_clock() -> FakeClock:
+    return FakeClock()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import stat
+import tarfile
+
+import pytest
+
+from archive import inside_symlink, open_archive, safe_path
+from copier import copy_archive
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("a/b.txt", "a/b.txt"),
+    ("./a//b/../c", "a/c"),
+    ("/etc/passwd", "etc/passwd"),
+    ("./", "."),
+    ("/", "."),
+    ("..", None),
+    ("../x", None),
+    ("a/../../x", None),
+])
+def test_safe_path(name, expected):
+    assert safe_path(name) == expected
+
+
+def test_inside_symlink():
+    symlinks = {"a", "b/c"}
+
+    assert inside_symlink("a/x", symlinks)
+    assert inside_symlink("b/c/d/e", symlinks)
+    assert not inside_symlink("a", symlinks)
+    assert not inside_symlink("b/x", symlinks)
+    assert not inside_symlink("ab/x", symlinks)
+
+
+def _tar(path, members):
+    with tarfile.open(path, "w") as tf:
+        for info, data in members:
+            tf.addfile(info, io.BytesIO(data) if data is not None else None)
+
+
+def _info(name, kind, mode=0o755, linkname="", size=0, mtime=1000):
+    info = tarfile.TarInfo(name)
+    info.type = kind
+    info.mode = mode
+    info.linkname = linkname
+    info.size = size
+    info.mtime = mtime
+    return info
+
+
+def test_directory_entry_over_symlink_does_not_escape(tmp_path):
+    victim = tmp_path / "esc" / "victim"
+    victim.mkdir(parents=True)
+    os.chmod(str(victim), 0o700)
+    before = os.stat(str(victim))
+
+    archive = str(tmp_path / "evil.tar")
+    _tar(archive, [
+        (_info("a", tarfile.SYMTYPE, linkname=str(victim)), None),
+        (_info("a/", tarfile.DIRTYPE, mode=0o777, mtime=0), None),
+        (_info("a/x", tarfile.REGTYPE, size=3), b"pwn"),
+        (_info("a", tarfile.REGTYPE, size=3), b"pwn"),
+    ])
+
+    dst = tmp_path / "dst"
+    dst.mkdir()
+
+    copy_archive(open_archive(archive), str(dst))
+
+    after = os.stat(str(victim))
+    assert stat.S_IMODE(after.st_mode) == 0o700
+    assert after.st_mtime_ns == before.st_mtime_ns
+    assert os.listdir(str(victim)) == []
+    assert os.path.islink(str(dst / "a"))
+
+
+def test_traversal_entries_are_skipped(tmp_path):
+    archive = str(tmp_path / "evil.tar")
+    _tar(archive, [
+        (_info("../outside", tarfile.REGTYPE, size=3), b"bad"),
+        (_info("ok/file", tarfile.REGTYPE, mode=0o644, size=2), b"ok"),
+        (_info("hard", tarfile.LNKTYPE, linkname="../outside"), None),
+    ])
+
+    dst = tmp_path / "dst"
+    dst.mkdir()
+
+    stats = copy_archive(open_archive(archive), str(dst))
+
+    assert not (tmp_path / "outside").exists()
+    assert (dst / "ok" / "file").read_bytes() == b"ok"
+    assert not (dst / "hard").exists()
+    assert stats.files == 1
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+import autotune
+from autotune import IOTuner
+
+
+@pytest.fixture
+def clock(monkeypatch, fake_clock):
+    monkeypatch.setattr(autotune.time, "monotonic", fake_clock.monotonic)
+    monkeypatch.setattr(autotune, "WINDOW_BYTES", 100)
+    return fake_clock
+
+
+def _cache(tmp_path, bps):
+    path = tmp_path / "iotune.json"
+    path.write_text(json.dumps({"model|serial": {"chunk_size": 1 << 20, "depth": 2, "bps": bps}}))
+    return str(path)
+
+
+def _window(tuner, clock, seconds):
+    tuner.record(0)
+    clock.now += seconds
+    tuner.record(100)
+
+
+def test_cached_setting_kept_while_fast(tmp_path, clock):
+    tuner = IOTuner("model|serial", "none", _cache(tmp_path, 100.0))
+
+    _window(tuner, clock, 1.2)
+
+    assert tuner.converged
+    assert (tuner.chunk_size, tuner.depth) == (1 << 20, 2)
+
+
+def test_cached_setting_retuned_when_slow(tmp_path, clock):
+    cache_file = _cache(tmp_path, 10**9) # mesuré autrefois dans le cache de pages
+    tuner = IOTuner("model|serial", "none", cache_file)
+
+    _window(tuner, clock, 1.0)
+
+    assert not tuner.converged
+    assert tuner.chunk_size == 2 << 20
+
+    tuner.save()
+    assert json.loads(open(cache_file).read())["model|serial"]["bps"] == pytest.approx(100.0)
+
+
+def test_nothing_saved_without_measure(tmp_path):
+    cache_file = str(tmp_path / "iotune.json")
+
+    IOTuner("model|serial", "none", cache_file).save()
+
+    assert not (tmp_path / "iotune.json").exists()
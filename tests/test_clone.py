@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import subprocess
+from types import SimpleNamespace
+
+import pytest
+
+from clone import CloneError, _has_backup, clone_device, ext_used_ranges, merge_ranges
+from copier import IOLimits
+
+
+def test_merge_ranges_sorts_and_merges():
+    assert merge_ranges([(50, 60), (0, 10), (5, 20), (20, 30)]) == [(0, 30), (50, 60)]
+
+
+def test_merge_ranges_gap_and_empty():
+    assert merge_ranges([(0, 10), (15, 20), (40, 40), (30, 35)], gap=5) == [(0, 20), (30, 35)]
+
+
+def test_has_backup_sparse_super():
+    groups = [group for group in range(60) if _has_backup(group, True)]
+
+    assert groups == [0, 1, 3, 5, 7, 9, 25, 27, 49]
+    assert all(_has_backup(group, False) for group in range(10))
+
+
+def test_more_targets_than_writers(tmp_path):
+    golden = SimpleNamespace(path=str(tmp_path / "absent"))
+    targets = [SimpleNamespace(path="/dev/sd" + c, name="sd" + c) for c in "bc"]
+
+    # refusé avant toute ouverture: une place d'écrivain par cible
+    with pytest.raises(CloneError, match="2 cibles"):
+        clone_device(golden, targets, IOLimits(max_writers=1))
+
+
+def test_unknown_filesystem(tmp_path):
+    path = tmp_path / "zeros.img"
+    path.write_bytes(bytes(64 * 1024))
+
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        assert ext_used_ranges(fd, 0, 64 * 1024) is None
+    finally:
+        os.close(fd)
+
+
+@pytest.mark.skipif(not (shutil.which("mke2fs") and shutil.which("e2fsck") and shutil.which("debugfs")), reason="e2fsprogs absent")
+@pytest.mark.parametrize("fstype, offset", [("ext2", 0), ("ext4", 0), ("ext4", 1024 * 1024)])
+def test_used_ranges_copy_is_a_valid_filesystem(tmp_path, fstype, offset):
+    """Une image ne contenant que les zones utilisées doit rester un système de fichiers sain
+    """
+    size = 64 * 1024 * 1024
+    content = os.urandom(3 * 1024 * 1024 + 123)
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "data.bin").write_bytes(content)
+
+    fs = str(tmp_path / "fs.img")
+    subprocess.run(["mke2fs", "-q", "-F", "-t", fstype, "-d", str(src), fs, str(size // 1024)], check=True)
+
+    golden = str(tmp_path / "golden.img")
+    with open(golden, "wb") as g, open(fs, "rb") as f:
+        g.seek(offset)
+        shutil.copyfileobj(f, g)
+
+    fd = os.open(golden, os.O_RDONLY)
+    try:
+        ranges = ext_used_ranges(fd, offset, size)
+        assert ranges is not None
+        assert sum(end - start for start, end in ranges) < size // 2
+
+        clone = str(tmp_path / "clone.img")
+        with open(clone, "wb") as c:
+            c.truncate(size)
+            for start, end in ranges:
+                c.seek(start)
+                c.write(os.pread(fd, end - start, offset + start))
+    finally:
+        os.close(fd)
+
+    assert subprocess.run(["e2fsck", "-fn", clone], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+    dumped = str(tmp_path / "dumped.bin")
+    subprocess.run(["debugfs", "-R", "dump /data.bin {}".format(dumped), clone], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    assert open(dumped, "rb").read() == content
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+from types import SimpleNamespace
+
+import pytest
+
+import wildcopy
+from wildcopy import PedPartition, choose_cluster_size, fat32_fits, logical_block_size
+
+GIB = 2**30
+MIB = 2**20
+
+
+def test_small_files_keep_small_clusters():
+    assert choose_cluster_size("exfat", [1000] * 10000, 64 * GIB) == 4096
+
+
+def test_large_files_get_large_clusters():
+    assert choose_cluster_size("exfat", [3 * GIB] * 10, 64 * GIB) == 1024 * 1024
+
+
+def test_cluster_never_exceeds_erase_block():
+    assert choose_cluster_size("exfat", [3 * GIB] * 10, 64 * GIB, erase_block=128 * 1024) == 128 * 1024
+
+
+def test_fat32_keeps_minimum_cluster_count():
+    size = choose_cluster_size("vfat", [3 * GIB], 1 * GIB)
+
+    assert 1 * GIB // size >= wildcopy.FAT32_MIN_CLUSTERS
+
+
+def test_logical_block_size(monkeypatch):
+    monkeypatch.setattr(wildcopy, "read_sysfs_int", lambda name, attr, default=0: 4096 if name == "sdz" else 0)
+
+    assert logical_block_size("sdz") == 4096
+    assert logical_block_size("absent") == wildcopy.FAT_SECTOR_SIZE
+
+
+def test_fat32_fits():
+    assert not fat32_fits(255 * MIB)
+    assert fat32_fits(257 * MIB)
+
+
+def test_small_partition_lets_mkfs_choose():
+    assert choose_cluster_size("vfat", [1000] * 100, 128 * MIB) == 0
+
+
+class FakePartition(PedPartition):
+    """PedPartition sans parted: seule la commande de formatage nous intéresse"""
+    path = "/dev/sdz1"
+    mountpoint = None
+    fstype = None
+
+    def __init__(self, size):
+        self._size = size
+        self._device = SimpleNamespace(path="/dev/sdz")
+
+    @property
+    def size(self):
+        return self._size
+
+    def _check_before(self):
+        pass
+
+    def is_mounted(self):
+        return False
+
+
+@pytest.fixture
+def commands(monkeypatch):
+    commands = list()
+    monkeypatch.setattr(wildcopy, "run_command", lambda cmd, **kwargs: commands.append(cmd))
+    monkeypatch.setattr(wildcopy, "invalidate_cache", lambda: None)
+    monkeypatch.setattr(wildcopy, "read_sysfs_int", lambda name, attr, default=0: 0)
+    monkeypatch.setattr(wildcopy.time, "sleep", lambda seconds: None)
+    return commands
+
+
+def test_format_small_partition_without_fat32(commands):
+    partition = FakePartition(128 * MIB)
+    partition.format("vfat", "usb", cluster_size=choose_cluster_size("vfat", [1000], partition.size))
+
+    assert commands == [["mkfs.vfat", "-n", "USB", "/dev/sdz1"]]
+
+
+def test_format_fat32(commands):
+    partition = FakePartition(8 * GIB)
+    partition.format("vfat", "usb", cluster_size=32768)
+
+    assert commands == [["mkfs.vfat", "-n", "USB", "-F", "32", "-s", "64", "/dev/sdz1"]]
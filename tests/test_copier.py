@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+
+import pytest
+
+from copier import PermPolicy, copy_file, copy_tree
+
+
+def _tree(root):
+    (root / "dir").mkdir(parents=True)
+    (root / "dir" / "file").write_bytes(b"data")
+    (root / "top").write_bytes(b"top")
+    os.symlink("top", str(root / "link"))
+
+    os.chmod(str(root / "dir" / "file"), 0o604)
+    for i, path in enumerate(["dir/file", "top", "dir"]):
+        os.utime(str(root / path), ns=(10**18 + i, 10**18 + i))
+
+    return root
+
+
+def test_copy_file_does_not_follow_destination_link(tmp_path):
+    (tmp_path / "src").write_bytes(b"new")
+    victim = tmp_path / "victim"
+    victim.write_bytes(b"old")
+    os.symlink(str(victim), str(tmp_path / "dst"))
+
+    with pytest.raises(OSError):
+        copy_file(str(tmp_path / "src"), str(tmp_path / "dst"))
+
+    assert victim.read_bytes() == b"old"
+
+
+def test_policy_preserves_mode_and_times(tmp_path):
+    src = _tree(tmp_path / "src")
+    dst = tmp_path / "dst"
+    dst.mkdir()
+
+    copy_tree(str(src), str(dst), policy=PermPolicy())
+
+    for path in ["dir/file", "top", "dir"]:
+        assert (dst / path).stat().st_mtime_ns == (src / path).stat().st_mtime_ns
+    assert stat.S_IMODE((dst / "dir" / "file").stat().st_mode) == 0o604
+    assert os.readlink(str(dst / "link")) == "top"
+
+
+def test_policy_forces_mode_and_owner(tmp_path):
+    src = _tree(tmp_path / "src")
+    dst = tmp_path / "dst"
+    dst.mkdir()
+
+    # propriétaire arbitraire seulement pour root
+    uid, gid = (4242, 4343) if os.geteuid() == 0 else (os.getuid(), os.getgid())
+    policy = PermPolicy(file_mode=0o640, dir_mode=0o750, root_mode=0o711, uid=uid, gid=gid, preserve_times=False)
+
+    copy_tree(str(src), str(dst), policy=policy)
+
+    assert stat.S_IMODE(dst.stat().st_mode) == 0o711
+    assert stat.S_IMODE((dst / "dir").stat().st_mode) == 0o750
+    for path in ["dir/file", "top"]:
+        st = (dst / path).stat()
+        assert stat.S_IMODE(st.st_mode) == 0o640
+        assert (st.st_uid, st.st_gid) == (uid, gid)
+        assert st.st_mtime_ns != (src / path).stat().st_mtime_ns
+    assert (dst / "dir").stat().st_uid == uid
+    assert os.lstat(str(dst / "link")).st_uid == uid
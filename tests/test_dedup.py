@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from copier import DEDUP_MIN_SIZE, DedupIndex, PermPolicy, copy_tree
+
+
+def _write(path, data, mode=0o644, mtime=1000000000):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    os.chmod(str(path), mode)
+    os.utime(str(path), (mtime, mtime))
+
+
+def _inode(path):
+    return os.stat(str(path)).st_ino
+
+
+def test_identical_files_are_linked(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    blob = os.urandom(3 * DEDUP_MIN_SIZE)
+    other = os.urandom(3 * DEDUP_MIN_SIZE) # même taille, contenu différent
+
+    _write(src / "a" / "1.bin", blob)
+    _write(src / "b" / "2.bin", blob)
+    _write(src / "c" / "3.bin", blob)
+    _write(src / "other.bin", other)
+    dst.mkdir()
+
+    dedup = DedupIndex()
+    stats = copy_tree(str(src), str(dst), dedup=dedup)
+
+    inodes = {_inode(dst / rel) for rel in ("a/1.bin", "b/2.bin", "c/3.bin")}
+    assert len(inodes) == 1
+    assert _inode(dst / "other.bin") not in inodes
+    assert (dst / "other.bin").read_bytes() == other
+    assert stats.deduped == 2
+    assert stats.bytes_saved == 2 * len(blob)
+    # la première copie de cette taille est hachée pendant sa copie, jamais relue
+    assert dedup.bytes_hashed == 3 * len(blob)
+
+
+def test_mode_and_times_keep_files_apart(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    blob = os.urandom(2 * DEDUP_MIN_SIZE)
+
+    _write(src / "x.bin", blob, mode=0o644)
+    _write(src / "y.bin", blob, mode=0o600)
+    _write(src / "z.bin", blob, mtime=1200000000)
+    dst.mkdir()
+
+    stats = copy_tree(str(src), str(dst), dedup=DedupIndex())
+
+    assert stats.deduped == 0
+    assert len({_inode(dst / name) for name in ("x.bin", "y.bin", "z.bin")}) == 3
+
+
+def test_forced_file_mode_allows_linking(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    blob = os.urandom(2 * DEDUP_MIN_SIZE)
+
+    _write(src / "x.bin", blob, mode=0o644)
+    _write(src / "y.bin", blob, mode=0o600)
+    dst.mkdir()
+
+    policy = PermPolicy(file_mode=0o640)
+    stats = copy_tree(str(src), str(dst), policy=policy, dedup=DedupIndex(policy))
+
+    assert stats.deduped == 1
+    assert _inode(dst / "x.bin") == _inode(dst / "y.bin")
+
+
+def test_small_files_and_source_hardlinks(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    small = os.urandom(DEDUP_MIN_SIZE - 1)
+    blob = os.urandom(2 * DEDUP_MIN_SIZE)
+
+    _write(src / "s1", small)
+    _write(src / "s2", small)
+    _write(src / "h1", blob)
+    os.link(str(src / "h1"), str(src / "h2"))
+    dst.mkdir()
+
+    dedup = DedupIndex()
+    stats = copy_tree(str(src), str(dst), dedup=dedup)
+
+    assert _inode(dst / "s1") != _inode(dst / "s2")
+    assert _inode(dst / "h1") == _inode(dst / "h2")
+    assert stats.deduped == 1
+    assert dedup.bytes_hashed == 0 # même inode source: pas besoin de comparer
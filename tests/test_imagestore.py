@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from imagestore import IMAGE_SUFFIX, META_SUFFIX, ImageStore, image_key, source_manifest
+
+
+def _tree(root):
+    (root / "sub").mkdir(parents=True)
+    (root / "a.txt").write_bytes(b"aaaa")
+    (root / "sub" / "b.bin").write_bytes(b"b" * 1000)
+    os.symlink("a.txt", str(root / "link"))
+    return str(root)
+
+
+def test_manifest_is_stable(tmp_path):
+    src = _tree(tmp_path / "src")
+
+    assert source_manifest(src) == source_manifest(src)
+
+
+def test_manifest_changes_with_content(tmp_path):
+    src = _tree(tmp_path / "src")
+    path = tmp_path / "src" / "a.txt"
+    before = source_manifest(src)
+    st = path.stat()
+
+    # même taille, même mtime: seul le ctime trahit la réécriture
+    path.write_bytes(b"bbbb")
+    os.utime(str(path), ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    assert source_manifest(src) != before
+
+
+@pytest.mark.parametrize("change", [
+    lambda root: (root / "new").write_bytes(b""),
+    lambda root: (root / "sub" / "b.bin").unlink(),
+    lambda root: os.chmod(str(root / "a.txt"), 0o600),
+    lambda root: os.rename(str(root / "a.txt"), str(root / "c.txt")),
+])
+def test_manifest_changes_with_tree(tmp_path, change):
+    src = _tree(tmp_path / "src")
+    before = source_manifest(src)
+
+    change(tmp_path / "src")
+
+    assert source_manifest(src) != before
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="chown réservé à root")
+def test_manifest_changes_with_group(tmp_path):
+    src = _tree(tmp_path / "src")
+    path = str(tmp_path / "src" / "a.txt")
+    before = source_manifest(src)
+
+    os.chown(path, -1, os.stat(path).st_gid + 1)
+
+    assert source_manifest(src) != before
+
+
+def test_key_changes_with_options():
+    keys = {image_key("m", "ext4", None, None), image_key("m", "ext3", None, None),
+            image_key("m", "ext4", "USB", None), image_key("m", "ext4", None, 0o755),
+            image_key("m2", "ext4", None, None)}
+
+    assert len(keys) == 5
+    assert image_key("m", "ext4", "USB", 0o755) == image_key("m", "ext4", "USB", 0o755)
+
+
+def test_manifest_computed_once_per_source(tmp_path, monkeypatch):
+    import imagestore
+
+    src = _tree(tmp_path / "src")
+    calls = list()
+    monkeypatch.setattr(imagestore, "source_manifest", lambda path: calls.append(path) or "m")
+
+    store = ImageStore(str(tmp_path / "store"))
+
+    assert store.key_for(src, "ext4") == store.key_for(src, "ext4")
+    assert store.key_for(src, "ext4") != store.key_for(src, "ext4", label="USB")
+    assert calls == [src]
+
+
+def _add_image(store, key, size, age):
+    path = store.image_path(key)
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    with open(os.path.join(store.directory, key + META_SUFFIX), "w") as f:
+        f.write('{"image_size": %d}' % size)
+    os.utime(path, (1000 - age, 1000 - age))
+
+
+def _keys(store):
+    return sorted(name[:-len(IMAGE_SUFFIX)] for name in os.listdir(store.directory) if name.endswith(IMAGE_SUFFIX))
+
+
+def test_evicts_least_recently_used(tmp_path):
+    store = ImageStore(str(tmp_path), budget=250)
+    for key, age in [("old", 30), ("mid", 20), ("new", 10)]:
+        _add_image(store, key, 100, age)
+
+    assert store.evict() == ["old"]
+    assert _keys(store) == ["mid", "new"]
+    assert not os.path.exists(os.path.join(str(tmp_path), "old" + META_SUFFIX))
+
+
+def test_lookup_refreshes_lru_order(tmp_path):
+    store = ImageStore(str(tmp_path), budget=150)
+    for key, age in [("old", 30), ("mid", 20), ("new", 10)]:
+        _add_image(store, key, 100, age)
+
+    assert store.lookup("old") == {"image_size": 100}
+    assert store.evict() == ["mid", "new"]
+    assert _keys(store) == ["old"]
+
+
+def test_image_in_use_is_never_evicted(tmp_path):
+    store = ImageStore(str(tmp_path), budget=0)
+    for key, age in [("old", 30), ("new", 10)]:
+        _add_image(store, key, 100, age)
+
+    with store.using("old"):
+        assert store.evict() == ["new"]
+
+    assert _keys(store) == ["old"]
+    assert store.evict() == ["old"]
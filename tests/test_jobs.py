@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import io
+import tarfile
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+import jobs
+from copier import CopyStats, IOLimits, copy_archive
+from jobs import BackgroundJobs, Job, JobError, JobResult, _share_archives, summarize
+
+
+def _archive(path):
+    with tarfile.open(path, "w") as tf:
+        for i in range(3):
+            data = b"x" * 100000
+            info = tarfile.TarInfo("f{}".format(i))
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+
+
+class PeakLimits(IOLimits):
+    """IOLimits qui retient le nombre maximal de places occupées"""
+    def __init__(self, max_writers):
+        super().__init__(max_writers)
+        self.peak = 0
+
+    @contextmanager
+    def writer(self, count=1):
+        with super().writer(count):
+            self.peak = max(self.peak, self.writers)
+            yield
+
+
+def test_archive_jobs_respect_max_writers(tmp_path):
+    archive = str(tmp_path / "src.tar")
+    _archive(archive)
+    for name in "bc":
+        (tmp_path / name).mkdir()
+
+    limits = PeakLimits(max_writers=1)
+    runnable = [JobResult(Job(archive, "sd{}".format(c))) for c in "bc"]
+    sources = _share_archives(runnable, workers=4, limits=limits)
+
+    streams = [sources[id(result)] for result in runnable]
+    assert streams[0].fanout is not streams[1].fanout # un groupe par place d'écrivain
+
+    threads = [threading.Thread(target=copy_archive, args=(stream, str(tmp_path / name))) for stream, name in zip(streams, "bc")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+
+    assert limits.peak == 1
+    assert limits.writers == 0
+    assert (tmp_path / "b" / "f2").stat().st_size == 100000
+    assert (tmp_path / "c" / "f2").stat().st_size == 100000
+
+
+def test_archive_fanout_takes_one_slot_per_consumer(tmp_path):
+    archive = str(tmp_path / "src.tar")
+    _archive(archive)
+    for name in "bc":
+        (tmp_path / name).mkdir()
+
+    limits = IOLimits(max_writers=2)
+    runnable = [JobResult(Job(archive, "sd{}".format(c))) for c in "bc"]
+    sources = _share_archives(runnable, workers=4, limits=limits)
+    streams = [sources[id(result)] for result in runnable]
+    assert streams[0].fanout is streams[1].fanout
+
+    with limits.writer():
+        threads = [threading.Thread(target=copy_archive, args=(stream, str(tmp_path / name))) for stream, name in zip(streams, "bc")]
+        for thread in threads:
+            thread.start()
+
+        # une place libre pour deux supports: la lecture attend
+        threads[0].join(timeout=0.5)
+        assert threads[0].is_alive()
+        assert streams[0].fanout.bytes_read == 0
+
+    for thread in threads:
+        thread.join(timeout=30)
+
+    assert (tmp_path / "b" / "f2").stat().st_size == 100000
+    assert (tmp_path / "c" / "f2").stat().st_size == 100000
+
+
+class FakeExecute:
+    """execute_job simulé: la tâche dure jusqu'à 'release' ou à son annulation"""
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Semaphore(0)
+
+    def __call__(self, result, limits=None, store=None, cancel=None, source=None):
+        self.started.release()
+        while not self.release.is_set():
+            if cancel is not None and cancel.wait(0.01):
+                result.error = "annulée"
+                result.cancelled = True
+                return result
+        return result
+
+
+@pytest.fixture
+def background(monkeypatch):
+    fake = FakeExecute()
+    monkeypatch.setattr(jobs, "execute_job", fake)
+    background = BackgroundJobs(workers=2)
+    yield background, fake
+    fake.release.set()
+    background.shutdown()
+
+
+def test_background_rejects_busy_device(tmp_path, background):
+    background, fake = background
+
+    first = background.submit(Job(str(tmp_path), "sdb"), "/dev/sdb")
+    assert fake.started.acquire(timeout=5)
+
+    with pytest.raises(JobError):
+        background.submit(Job(str(tmp_path), "sdb"), "/dev/sdb")
+
+    other = background.submit(Job(str(tmp_path), "sdc"), "/dev/sdc")
+    assert background.busy_paths() == ["/dev/sdb", "/dev/sdc"]
+
+    fake.release.set()
+    assert background.wait() == [first, other]
+    assert background.busy_paths() == []
+
+    # support libéré: il peut de nouveau servir
+    again = background.submit(Job(str(tmp_path), "sdb"), "/dev/sdb")
+    assert background.wait(again.id)[0].result.ok
+
+
+def test_background_cancel(tmp_path, background):
+    background, fake = background
+
+    job = background.submit(Job(str(tmp_path), "sdb"), "/dev/sdb")
+    assert fake.started.acquire(timeout=5)
+
+    assert background.cancel(job.id)
+    assert job.cancel_event.is_set()
+
+    background.wait(job.id, timeout=5)
+    assert job.result.cancelled
+    assert not background.cancel(job.id) # plus active
+    assert not background.cancel(999)
+
+
+def test_background_cancel_pending(tmp_path, background):
+    background, fake = background
+
+    running = [background.submit(Job(str(tmp_path), "sd" + c), "/dev/sd" + c) for c in "bc"]
+    pending = background.submit(Job(str(tmp_path), "sdd"), "/dev/sdd")
+
+    assert background.cancel(pending.id)
+    assert pending.future.cancelled()
+    assert [job.id for job in background.active()] == [job.id for job in running]
+
+
+def test_summarize():
+    results = [JobResult(Job("src", "sd" + c)) for c in "bcde"]
+    for result, (nbytes, deduped, saved) in zip(results, [(100, 2, 50), (200, 0, 0), (30, 1, 7)]):
+        result.stats = CopyStats()
+        result.stats.bytes, result.stats.deduped, result.stats.bytes_saved = nbytes, deduped, saved
+    results[2].error = "échec"
+    results[3].error, results[3].cancelled = "annulée", True
+
+    assert summarize(results) == "Bilan: 2 OK, 1 en échec, 1 annulée(s)  Octets écrits: 330  Doublons liés: 3 (57 octets évités)"
+    assert "Doublons" not in summarize(results[1:2])
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+import lsblk
+from lsblk import BlockDevices
+
+
+def _part(name, **props):
+    return dict({"name": name, "type": "part", "size": 500}, **props)
+
+
+BLOCKDEVICES = [
+    {"name": "sda", "type": "disk", "size": 10**12, "rm": False, "serial": "SYS", "model": "SSD ",
+     "children": [_part("sda1", uuid="u-sys", label="root", mountpoint="/")]},
+    {"name": "sdb", "type": "disk", "size": 8 * 10**9, "rm": True, "serial": " KEY1 ", "wwn": "w1",
+     "children": [_part("sdb1", uuid="u-b1", label="DATA", partuuid="pu-b1", fstype="vfat")]},
+    {"name": "sdc", "type": "disk", "size": 16 * 10**9, "rm": True, "serial": "KEY2",
+     "children": [_part("sdc1", uuid="u-c1", partlabel="Partition1", partuuid="pu-c1")]},
+    {"name": "sr0", "type": "rom", "size": 1024, "rm": True, "serial": "ROM"},
+    {"name": "loop0", "type": "loop", "size": 4096, "rm": False, "children": None},
+]
+
+
+@pytest.fixture
+def canned(monkeypatch):
+    monkeypatch.setattr(lsblk, "_run_lsblk", lambda: json.dumps({"blockdevices": BLOCKDEVICES}))
+
+
+def test_devices(canned):
+    blk = BlockDevices()
+
+    assert [dev.name for dev in blk.get_all()] == ["sda", "sdb", "sdc", "sr0"]
+    assert [dev.name for dev in blk.get_all(ignore_loop=False)][-1] == "loop0"
+    assert [dev.name for dev in blk.get_removables()] == ["sdb", "sdc", "sr0"]
+
+    sdb = blk.get_by_path("/dev/sdb")
+    assert sdb.serial == "KEY1"
+    assert sdb.stable_id == "KEY1"
+    assert blk.get_by_path("/dev/sda").ident == "SSD"
+    assert blk.get_by_path("/dev/loop0").get_partitions() == []
+
+
+@pytest.mark.parametrize("selector, expected", [
+    ("/dev/sdb", "sdb"),
+    ("path:/dev/sdc", "sdc"),
+    ("KEY2", "sdc"),
+    ("serial:KEY1", "sdb"),
+    ("uuid:u-c1", "sdc"),
+    ("partuuid:pu-b1", "sdb"),
+    ("label:DATA", "sdb"),
+    ("DATA", "sdb"),
+    ("Partition1", "sdc"), # label gpt, à défaut de label du système de fichiers
+    ("uuid:KEY1", None),   # le préfixe restreint la recherche
+    ("path:KEY1", None),
+    ("nothing", None),
+    ("bogus:/dev/sdb", None), # préfixe inconnu: cherché tel quel
+])
+def test_find(canned, selector, expected):
+    device = BlockDevices().find(selector)
+
+    assert (device.name if device else None) == expected
+
+
+def test_partitions_are_built_lazily(canned):
+    blk = BlockDevices()
+    sdb = blk.get_by_name("sdb")
+
+    assert blk._partitions_by_path is None
+    assert sdb._partitions is None
+
+    assert blk.find("serial:KEY1") is sdb
+    assert blk._partitions_by_path is None # pas de recherche de partition
+
+    partition = blk.get_partition_by_uuid("u-b1")
+    assert blk._partitions_by_path is not None
+    assert partition is sdb.get_partition_by_path("/dev/sdb1")
+    assert sdb._children is None # json des partitions libéré une fois construites
+    assert blk.get_device_of(partition) is sdb
+    assert blk.get_partition_by_path("/dev/sda1").is_mounted()
+    assert not hasattr(partition, "__dict__")
+
+
+def test_removables_only(canned):
+    blk = BlockDevices(removables_only=True)
+
+    assert [dev.name for dev in blk.get_all()] == ["sdb", "sdc", "sr0"]
+    assert blk.get_by_path("/dev/sda") is None
+    assert blk.find("root") is None
+    assert blk.get_partition_by_uuid("u-sys") is None
+
+
+def test_ignore_types(canned):
+    blk = BlockDevices(removables_only=True, ignore_types=["rom"])
+
+    assert [dev.name for dev in blk.get_all()] == ["sdb", "sdc"]
+    assert blk.get_types() == ["disk"]
+    assert blk.get_by_type("rom") == []
+    assert blk.find("ROM") is None
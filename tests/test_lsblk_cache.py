@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+import pytest
+
+import lsblk
+from lsblk import get_block_devices, invalidate_cache
+
+
+RAW = json.dumps({"blockdevices": [{"name": "sdz", "type": "disk", "size": 1000, "rm": True, "serial": "S1", "children": []}]})
+
+
+class Lsblk:
+    """Faux lsblk qui compte ses lancements"""
+    def __init__(self) -> None:
+        self.runs = 0
+
+    def __call__(self) -> str:
+        self.runs += 1
+        return RAW
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch, fake_clock):
+    runner = Lsblk()
+    stamp = {"value": 1}
+
+    monkeypatch.setattr(lsblk, "_run_lsblk", runner)
+    monkeypatch.setattr(lsblk, "_dev_dir_stamp", lambda: stamp["value"])
+    monkeypatch.setattr(lsblk, "LSBLK_CACHE_FILE", str(tmp_path / "lsblk.json"))
+    monkeypatch.setattr(lsblk.time, "time", fake_clock.monotonic)
+    lsblk._cache.clear()
+    yield runner, stamp, fake_clock
+    lsblk._cache.clear()
+
+
+def test_served_from_cache_within_ttl(env):
+    runner, stamp, clock = env
+
+    first = get_block_devices()
+    clock.now += lsblk.LSBLK_CACHE_TTL / 2
+    second = get_block_devices()
+
+    assert runner.runs == 1
+    assert second is first
+    assert second.get_by_path("/dev/sdz").serial == "S1"
+
+
+def test_expires_after_ttl(env):
+    runner, stamp, clock = env
+
+    get_block_devices()
+    clock.now += lsblk.LSBLK_CACHE_TTL + 0.1
+    get_block_devices()
+
+    assert runner.runs == 2
+
+
+def test_dev_change_invalidates(env):
+    runner, stamp, clock = env
+
+    get_block_devices()
+    stamp["value"] += 1 # support branché ou retiré
+    get_block_devices()
+
+    assert runner.runs == 2
+
+
+def test_max_age_zero_and_invalidate(env):
+    runner, stamp, clock = env
+
+    get_block_devices()
+    get_block_devices(max_age=0)
+    assert runner.runs == 2
+
+    invalidate_cache()
+    get_block_devices()
+    assert runner.runs == 3
+
+
+def test_cache_file_shared_between_processes(env):
+    runner, stamp, clock = env
+
+    get_block_devices()
+    lsblk._cache.clear() # comme un nouveau processus
+    get_block_devices()
+
+    assert runner.runs == 1
+
+
+def test_cache_file_of_another_user_ignored(env, monkeypatch):
+    runner, stamp, clock = env
+
+    get_block_devices()
+    lsblk._cache.clear()
+    monkeypatch.setattr(lsblk.os, "getuid", lambda: os.stat(lsblk.LSBLK_CACHE_FILE).st_uid + 1)
+    get_block_devices()
+
+    assert runner.runs == 2
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from metrics import Exporter, Registry
+
+
+def test_prometheus_text_format():
+    registry = Registry()
+    counter = registry.counter("wc_devices_total", "Supports")
+    histogram = registry.histogram("wc_phase_seconds", "Durées", buckets=(1, 10))
+
+    counter.inc(status="ok")
+    counter.inc(2, status='fa"il')
+    histogram.observe(5, phase="copy")
+
+    lines = registry.prometheus().splitlines()
+
+    assert "# TYPE wc_devices_total counter" in lines
+    assert 'wc_devices_total{status="ok"} 1' in lines
+    assert 'wc_devices_total{status="fa\\"il"} 2' in lines
+    assert 'wc_phase_seconds_bucket{phase="copy",le="1"} 0' in lines
+    assert 'wc_phase_seconds_bucket{phase="copy",le="10"} 1' in lines
+    assert 'wc_phase_seconds_bucket{phase="copy",le="+Inf"} 1' in lines
+    assert 'wc_phase_seconds_sum{phase="copy"} 5.0' in lines
+
+
+def test_json_snapshot(tmp_path):
+    registry = Registry()
+    registry.counter("wc_bytes_total", "Octets").inc(42)
+    path = str(tmp_path / "metrics.json")
+
+    registry.write(path)
+
+    assert json.load(open(path))["metrics"]["wc_bytes_total"] == [{"labels": {}, "value": 42}]
+
+
+def test_exporter_survives_write_errors(tmp_path):
+    path = str(tmp_path / "missing" / "metrics.prom")
+    exporter = Exporter(path, interval=0.01, registry=Registry()).start()
+
+    exporter._stop.wait(0.05)
+    assert exporter._thread.is_alive()
+
+    exporter.stop() # ne lève pas
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import errno
+import os
+
+import pytest
+
+import mounts
+from mounts import MountError
+
+
+class FakeLibc:
+    """mount(2) et umount2(2) simulés: 'errors' donne l'errno du prochain appel (0: succès)"""
+    def __init__(self):
+        self.calls = list()
+        self.errors = list()
+
+    def _result(self):
+        err = self.errors.pop(0) if self.errors else 0
+        ctypes.set_errno(err)
+        return -1 if err else 0
+
+    def mount(self, source, target, fstype, flags, data):
+        self.calls.append(("mount", source, target, fstype, flags.value, data))
+        return self._result()
+
+    def umount2(self, target, flags):
+        self.calls.append(("umount2", target, flags))
+        return self._result()
+
+
+@pytest.fixture
+def libc(tmp_path, monkeypatch):
+    libc = FakeLibc()
+    monkeypatch.setattr(mounts, "_get_libc", lambda: libc)
+    monkeypatch.setattr(mounts, "MOUNT_ROOT", str(tmp_path / "mnt"))
+    monkeypatch.setattr(mounts, "_mounted", dict())
+    return libc
+
+
+def test_mountpoint_for(libc):
+    assert mounts.mountpoint_for("/dev/sdb1") == os.path.join(mounts.MOUNT_ROOT, "sdb1")
+
+
+def test_mount_and_umount(libc):
+    target = mounts.mount("/dev/sdb1", "ext4")
+
+    assert target == mounts.mountpoint_for("/dev/sdb1")
+    assert os.path.isdir(target)
+    assert mounts.mounted_at("/dev/sdb1") == target
+    assert libc.calls == [("mount", b"/dev/sdb1", target.encode(), b"ext4", mounts.MOUNT_FLAGS, b"commit=60")]
+
+    mounts.umount("/dev/sdb1")
+
+    assert libc.calls[-1] == ("umount2", target.encode(), 0) # jamais de démontage différé
+    assert mounts.mounted_at("/dev/sdb1") is None
+    assert not os.path.exists(target)
+
+
+def test_mount_failure(libc):
+    libc.errors = [errno.EBUSY]
+
+    with pytest.raises(MountError) as info:
+        mounts.mount("/dev/sdb1", "vfat")
+
+    assert info.value.errno == errno.EBUSY
+    assert libc.calls[0][-1] is None # pas d'options pour vfat
+    assert mounts.mounted_at("/dev/sdb1") is None
+    assert not os.path.exists(mounts.mountpoint_for("/dev/sdb1"))
+
+
+@pytest.mark.parametrize("err", [errno.EINVAL, errno.ENOENT])
+def test_umount_not_mounted_is_ignored(libc, err):
+    target = mounts.mount("/dev/sdb1", "ext4")
+    libc.errors = [err]
+
+    mounts.umount("/dev/sdb1")
+
+    assert mounts.mounted_at("/dev/sdb1") is None
+    assert not os.path.exists(target)
+
+
+def test_umount_busy(libc):
+    target = mounts.mount("/dev/sdb1", "ext4")
+    libc.errors = [errno.EBUSY]
+
+    with pytest.raises(MountError):
+        mounts.umount("/dev/sdb1")
+
+    assert mounts.mounted_at("/dev/sdb1") == target
+    assert os.path.isdir(target)
+
+
+def test_system_mountpoint(tmp_path, monkeypatch):
+    rdev = os.stat("/dev/null").st_rdev
+    device = "{}:{}".format(os.major(rdev), os.minor(rdev))
+    mountinfo = tmp_path / "mountinfo"
+    mountinfo.write_text("22 1 8:2 / / rw,relatime - ext4 /dev/sda2 rw\n"
+                         "40 22 {} / /media/my\\040key rw,nosuid - vfat /dev/sdb1 rw\n".format(device))
+    monkeypatch.setattr(mounts, "MOUNTINFO", str(mountinfo))
+
+    assert mounts.system_mountpoint("/dev/null") == "/media/my key"
+    assert mounts.system_mountpoint(str(tmp_path / "absent")) is None
+
+    mountinfo.write_text("22 1 8:2 / / rw,relatime - ext4 /dev/sda2 rw\n")
+    assert mounts.system_mountpoint("/dev/null") is None
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from jobs import JobError, _parse_owner
+
+
+@pytest.mark.parametrize("owner, expected", [
+    ("0:0", (0, 0)),
+    ("root", (0, 0)),
+    ("root:0", (0, 0)),
+    (":0", (None, 0)),
+    ("54321:65432", (54321, 65432)), # inconnus localement: gardés tels quels
+    ("54321", (54321, None)),
+])
+def test_parse_owner(owner, expected):
+    assert _parse_owner(owner) == expected
+
+
+@pytest.mark.parametrize("owner", ["no-such-user-wc", "root:no-such-group-wc", "54321:no-such-group-wc"])
+def test_unknown_owner(owner):
+    with pytest.raises(JobError):
+        _parse_owner(owner)
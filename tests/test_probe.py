@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+import probe
+from probe import probe_device, sample_offsets
+
+
+FAKE_FD = 1000003
+SAMPLE_SIZE = 64 * 1024
+GB = 10**9
+GIB = 2**30
+
+
+class WrappingDevice:
+    """Support qui annonce 'size' octets mais n'en stocke que 'capacity': au-delà, les écritures
+    reviennent au début (position modulo la capacité réelle)
+    """
+    def __init__(self, size: int, capacity: int) -> None:
+        self.size = size
+        self.capacity = capacity
+        self.sectors = dict()
+
+    def pwrite(self, fd, data, offset):
+        data = bytes(data)
+        for pos in range(0, len(data), probe.SECTOR_SIZE):
+            self.sectors[(offset + pos) % self.capacity] = data[pos:pos + probe.SECTOR_SIZE]
+        return len(data)
+
+    def preadv(self, fd, buffers, offset):
+        buf = buffers[0]
+        for pos in range(0, len(buf), probe.SECTOR_SIZE):
+            buf[pos:pos + probe.SECTOR_SIZE] = self.sectors.get((offset + pos) % self.capacity, bytes(probe.SECTOR_SIZE))
+        return len(buf)
+
+
+@pytest.fixture
+def fake_device(monkeypatch):
+    def install(size, capacity):
+        device = WrappingDevice(size, capacity)
+        real_fsync, real_close = os.fsync, os.close
+
+        monkeypatch.setattr(probe, "_open_direct", lambda path: FAKE_FD)
+        monkeypatch.setattr(os, "pwrite", device.pwrite)
+        monkeypatch.setattr(os, "preadv", device.preadv)
+        monkeypatch.setattr(os, "fsync", lambda fd: None if fd == FAKE_FD else real_fsync(fd))
+        monkeypatch.setattr(os, "close", lambda fd: None if fd == FAKE_FD else real_close(fd))
+
+        return device
+
+    return install
+
+
+@pytest.mark.parametrize("size, capacity", [
+    (64 * GB, 8 * GB),
+    (32 * GB, 4 * GB),
+    (128 * GB, 16 * GB),
+    (16 * GB, 2 * GB),
+    (64 * GIB, 8 * GIB),
+    (32 * GIB, 3 * GIB),
+])
+def test_wrapping_device_is_fake(fake_device, size, capacity):
+    fake_device(size, capacity)
+
+    result = probe_device("/dev/fake", size, sample_size=SAMPLE_SIZE)
+
+    assert not result.genuine
+    assert result.bad_offsets
+
+
+@pytest.mark.parametrize("size", [64 * GB, 64 * GIB, 7 * GB + 12345 * 4096])
+def test_genuine_device(fake_device, size):
+    fake_device(size, size)
+
+    result = probe_device("/dev/genuine", size, sample_size=SAMPLE_SIZE)
+
+    assert result.genuine, result.bad_offsets
+
+
+@pytest.mark.parametrize("size", [10**6, 128 * 2**20, 16 * GB, 64 * GIB, 1000 * GB])
+def test_sample_offsets_do_not_overlap(size):
+    sample_size = probe.DEFAULT_SAMPLE_SIZE
+    offsets = sample_offsets(size, sample_size=sample_size)
+
+    assert offsets[0] == 0
+    assert all(b - a >= sample_size for a, b in zip(offsets, offsets[1:]))
+    assert all(offset % probe.DIRECT_ALIGN == 0 for offset in offsets)
+    assert offsets[-1] + sample_size <= max(size, sample_size)
+
+
+def test_sample_offsets_reach_the_end():
+    size = 16 * GB
+    offsets = sample_offsets(size)
+
+    assert size - offsets[-1] - probe.DEFAULT_SAMPLE_SIZE < probe.PROBE_ALIGN
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+
+from wildcopy import SIGNATURE_WIPE_SIZE, wipe_device, wipe_offsets
+
+MiB = 1024 * 1024
+
+
+def test_wipe_offsets():
+    size = 100 * MiB
+
+    assert wipe_offsets(size, []) == [0, size - SIGNATURE_WIPE_SIZE]
+    assert wipe_offsets(size, [MiB, 50 * MiB, MiB]) == [0, MiB, 50 * MiB, size - SIGNATURE_WIPE_SIZE]
+    # début inconnu (0) ou hors du support: ignorés
+    assert wipe_offsets(size, [0, size, 2 * size]) == [0, size - SIGNATURE_WIPE_SIZE]
+
+
+def test_wipe_offsets_small_device():
+    assert wipe_offsets(SIGNATURE_WIPE_SIZE // 2, []) == [0]
+    assert wipe_offsets(SIGNATURE_WIPE_SIZE, []) == [0]
+
+
+def test_wipe_without_discard_support(tmp_path, caplog):
+    size = 8 * MiB
+    path = str(tmp_path / "disk.img")
+    with open(path, "wb") as f:
+        f.write(b"\xff" * size)
+
+    offsets = wipe_offsets(size, [3 * MiB])
+
+    fd = os.open(path, os.O_RDWR)
+    try:
+        # un fichier ordinaire ne supporte pas BLKDISCARD: avertissement, puis effacement
+        with caplog.at_level(logging.WARNING, logger="wildcopy"):
+            wipe_device(fd, path, size, offsets, discard=True)
+    finally:
+        os.close(fd)
+
+    assert "Discard impossible" in caplog.text
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    assert len(data) == size
+    for offset in offsets:
+        assert data[offset:offset + SIGNATURE_WIPE_SIZE] == bytes(SIGNATURE_WIPE_SIZE)
+    assert data[MiB:3 * MiB] == b"\xff" * (2 * MiB)
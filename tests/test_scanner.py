@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from scanner import DIR, FILE, SYMLINK, PayloadTooLarge, TreeScanner
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for i in range(5):
+        sub = tmp_path / "d{}".format(i) / "sub"
+        sub.mkdir(parents=True)
+        for j in range(4):
+            (sub / "f{}".format(j)).write_bytes(b"x" * (1000 * j + 1))
+    os.symlink("d0", str(tmp_path / "link"))
+    return tmp_path
+
+
+def test_directories_come_before_their_contents(tree):
+    seen = set()
+
+    for entry in TreeScanner(str(tree), workers=4).start():
+        parent = os.path.dirname(entry.rel)
+        assert not parent or parent in seen
+        if entry.kind == DIR:
+            seen.add(entry.rel)
+
+
+def test_totals(tree):
+    scanner = TreeScanner(str(tree), block_size=4096, cluster_sizes=[4096, 8192]).start()
+    entries = list(scanner)
+
+    assert scanner.done.is_set()
+    assert (scanner.files, scanner.dirs, scanner.links) == (20, 10, 1)
+    assert scanner.bytes == 5 * (1 + 1001 + 2001 + 3001)
+    assert scanner.allocated == 20 * 4096 + 10 * 4096
+    assert scanner.slack == {4096: 5 * sum(4096 - size for size in (1, 1001, 2001, 3001)),
+                             8192: 5 * sum(8192 - size for size in (1, 1001, 2001, 3001))}
+    assert sorted(entry.kind for entry in entries).count(SYMLINK) == 1
+    assert sum(entry.kind == FILE for entry in entries) == 20
+
+
+def test_payload_too_large(tree):
+    scanner = TreeScanner(str(tree), limit=10 * 4096).start()
+
+    with pytest.raises(PayloadTooLarge):
+        list(scanner)
+
+
+def test_limit_set_after_start(tree):
+    # sans limite au départ: la partition n'est pas encore montée
+    scanner = TreeScanner(str(tree)).start()
+    scanner.settle()
+
+    scanner.set_limit(10 * 4096)
+
+    with pytest.raises(PayloadTooLarge):
+        scanner.check()
+
+
+def test_limit_set_after_start_not_exceeded(tree):
+    scanner = TreeScanner(str(tree)).start()
+    scanner.set_limit(10**9)
+
+    assert len(list(scanner)) == 31
+    scanner.check()
+
+
+def test_settle_when_nobody_consumes(tree, monkeypatch):
+    monkeypatch.setattr("scanner.SCAN_QUEUE_ENTRIES", 5)
+    scanner = TreeScanner(str(tree)).start()
+
+    assert not scanner.settle() # file pleine: le parcours attend la copie
+    assert len(list(scanner)) == 31
+    assert scanner.settle()
+
+
+def test_unreadable_source(tmp_path):
+    with pytest.raises(OSError):
+        list(TreeScanner(str(tmp_path / "absent")).start())
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import copier
+from copier import IOLimits, Throttle
+
+
+@pytest.fixture
+def clock(monkeypatch, fake_clock):
+    monkeypatch.setattr(copier.time, "monotonic", fake_clock.monotonic)
+    monkeypatch.setattr(copier.time, "sleep", fake_clock.sleep)
+    return fake_clock
+
+
+def test_unlimited_never_waits(clock):
+    throttle = Throttle(0)
+
+    for _ in range(100):
+        throttle.consume(10**9)
+
+    assert clock.slept == 0
+
+
+def test_rate_is_enforced(clock):
+    throttle = Throttle(1000)
+
+    throttle.consume(1000) # seau plein au départ
+    assert clock.slept == 0
+
+    for _ in range(10):
+        throttle.consume(500)
+
+    assert abs(clock.slept - 5.0) < 1e-6
+
+
+def test_idle_time_refills_up_to_one_second(clock):
+    throttle = Throttle(1000)
+
+    throttle.consume(1000)
+    clock.now += 60 # inactif: pas plus d'une seconde de crédit
+
+    throttle.consume(1000)
+    throttle.consume(1000)
+
+    assert abs(clock.slept - 1.0) < 1e-6
+
+
+def test_writer_slots():
+    limits = IOLimits(max_writers=1)
+
+    with limits.writer():
+        assert limits.writers == 1
+
+    assert limits.writers == 0
+
+
+def test_writer_count_is_capped():
+    limits = IOLimits(max_writers=2)
+
+    with limits.writer(5):
+        assert limits.writers == 2
+
+    assert limits.writers == 0
@@ -4,6 +4,9 @@
 import os
 import subprocess
 import shlex
+import importlib
+from types import ModuleType
+from typing import Any, List, Optional, Union
 
 import logging
 from logging import Logger
@@ -43,6 +46,26 @@ def running_as_root() -> bool:
     return True
 
 
+def run_command(args: Union[str, List[str]], name: Optional[str]=None, **kwargs: Any) -> subprocess.CompletedProcess:
+    """subprocess.run, compté dans les métriques sous 'name' (par défaut le nom de la commande)
+    """
+    from metrics import SPAWNS # pas au chargement: inutile aux commandes en lecture seule
+
+    SPAWNS.inc(command=name or os.path.basename(args[0] if isinstance(args, list) else args.split()[0]))
+
+    return subprocess.run(args, **kwargs)
+
+
+def popen_command(args: List[str], name: Optional[str]=None, **kwargs: Any) -> subprocess.Popen:
+    """subprocess.Popen, compté dans les métriques comme 'run_command'
+    """
+    from metrics import SPAWNS
+
+    SPAWNS.inc(command=name or os.path.basename(args[0]))
+
+    return subprocess.Popen(args, **kwargs)
+
+
 def sudo_exec_as_normal_user(orig_cmd: str) -> None:
     """Exécuter un commande comme utilisateur normal quand sudo (sinon exécuté avec la user id courante)
     """
@@ -53,7 +76,28 @@ def sudo_exec_as_normal_user(orig_cmd: str) -> None:
     else:
         cmd = orig_cmd
 
-    subprocess.run(shlex.split(cmd))
+    run_command(shlex.split(cmd), name=shlex.split(orig_cmd)[0])
+
+
+class LazyModule:
+    """Module importé au premier accès à l'un de ses attributs.
+    Pour les dépendances lourdes (pyparted...) inutiles aux commandes en lecture seule.
+    """
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._module: Optional[ModuleType] = None
+
+
+    def __getattr__(self, attr: str) -> Any:
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+
+        return getattr(self._module, attr)
+
+
+    def __repr__(self) -> str:
+        state = "chargé" if self._module is not None else "non chargé"
+        return "<LazyModule {} ({})>".format(self._name, state)
 
 
 if __name__ == "__main__":
@@ -5,22 +5,29 @@
 # TODO: intercepter ctrl+c
 # TODO: aérer l'interface
 
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, TYPE_CHECKING
 import sys, os
 import cmd
 import shlex
 
-import readline #! pour historique etc
+import click
+from lsblk import Device, get_block_devices
 
+if TYPE_CHECKING:
+    from jobs import BackgroundJobs
 
-import click
-from lsblk import BlockDevices, Device
 
+# readline n'est importé que pour le shell interactif (historique etc), voir __main__
 
 
+def lsblk_list(removables: bool=True, max_age: Optional[float]=None) -> List[Device]:
+    """Liste des devices. La sortie de lsblk est servie depuis un cache de courte durée
+    """
+    if max_age is None:
+        bdev = get_block_devices(removables_only=removables)
+    else:
+        bdev = get_block_devices(max_age, removables_only=removables)
 
-def lsblk_list(removables: bool=True) -> List[Device]:
-    bdev = BlockDevices()
     if removables:
         return bdev.get_removables()
     else:
@@ -34,13 +41,148 @@ def cli():
 
 @cli.command()
 @click.option("-r", "--removables", is_flag=True, default=True)
-def devices(removables: bool) -> List[Device]:
+@click.option("--fresh", is_flag=True, default=False, help="Ignore le cache de lsblk")
+def devices(removables: bool, fresh: bool) -> List[Device]:
     """Liste les devices
     """
-    for dev in lsblk_list(removables):
+    for dev in lsblk_list(removables, max_age=0 if fresh else None):
         print(dev)
 
 
+@cli.command()
+@click.argument("device_path")
+@click.option("--no-discard", is_flag=True, default=False, help="N'envoie pas de discard (TRIM)")
+@click.confirmation_option(prompt="Toutes les données du support seront perdues. Continuer?")
+def reset(device_path: str, no_discard: bool) -> None:
+    """Remise à zéro rapide d'un support amovible (discard + effacement des signatures)
+    """
+    from utils import running_as_root
+    from lsblk import invalidate_cache
+    from wildcopy import PedDevice
+
+    if not running_as_root():
+        raise click.ClickException("Doit être exécuté en tant que root (sudo)")
+
+    PedDevice(device_path, force=True).fast_reset(discard=not no_discard)
+    invalidate_cache()
+
+
+@cli.command()
+@click.argument("device_paths", nargs=-1, required=True)
+@click.option("-s", "--samples", default=8, show_default=True, help="Nombre de zones sondées")
+@click.confirmation_option(prompt="Les zones sondées seront écrasées. Continuer?")
+def probe(device_paths: Tuple[str], samples: int) -> None:
+    """Mesure le débit des supports et vérifie leur capacité réelle (destructif)
+    """
+    from utils import running_as_root
+    from probe import probe_device
+
+    if not running_as_root():
+        raise click.ClickException("Doit être exécuté en tant que root (sudo)")
+
+    removables = {dev.path: dev for dev in lsblk_list(max_age=0)}
+
+    for path in device_paths:
+        if path not in removables:
+            raise click.ClickException("{} n'est pas un support amovible connecté".format(path))
+
+    for path in device_paths:
+        try:
+            print(probe_device(path, removables[path].size, samples=samples))
+        except OSError as e:
+            raise click.ClickException("Sonde de {} impossible (partition montée?): {}".format(path, e))
+
+
+@cli.command()
+@click.argument("golden_path")
+@click.argument("target_paths", nargs=-1, required=True)
+@click.option("--bwlimit", default=0, help="Débit d'écriture total max en octets/s (0: illimité)")
+@click.option("--metrics", "metrics_path", default=None, help="Fichier de métriques (.prom: texte Prometheus, .json: JSON)")
+@click.confirmation_option(prompt="Toutes les données des supports cibles seront perdues. Continuer?")
+def clone(golden_path: str, target_paths: Tuple[str], bwlimit: int, metrics_path: Optional[str]) -> None:
+    """Clone un support modèle sur un ou plusieurs supports (table de partitions, chargeur de
+    démarrage et systèmes de fichiers; seuls les blocs utilisés des partitions ext sont copiés)
+    """
+    from utils import running_as_root
+    from copier import IOLimits
+    from clone import CloneError, clone_device, resolve_clone
+    from lsblk import invalidate_cache
+    from metrics import Exporter
+
+    if not running_as_root():
+        raise click.ClickException("Doit être exécuté en tant que root (sudo)")
+
+    try:
+        golden, targets = resolve_clone(golden_path, list(target_paths), get_block_devices(max_age=0, removables_only=True))
+    except CloneError as e:
+        raise click.ClickException(str(e))
+
+    exporter = Exporter(metrics_path).start() if metrics_path else None
+
+    try:
+        results = clone_device(golden, targets, IOLimits(bytes_per_sec=bwlimit))
+    except CloneError as e:
+        raise click.ClickException(str(e))
+    finally:
+        invalidate_cache()
+        if exporter:
+            exporter.stop()
+
+    for result in results:
+        print(result)
+    print(summarize(results))
+
+    if not all(result.ok for result in results):
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument("jobfile", type=click.Path(exists=True, dir_okay=False))
+@click.option("-w", "--workers", default=4, show_default=True, help="Nombre de tâches exécutées en parallèle")
+@click.option("--max-writers", default=0, help="Nombre max de supports écrits simultanément (0: illimité)")
+@click.option("--bwlimit", default=0, help="Débit d'écriture total max en octets/s (0: illimité)")
+@click.option("--min-write-speed", default=0, help="Rejette les supports sondés qui écrivent moins vite (octets/s)")
+@click.option("--image-store", default=None, help="Répertoire du cache d'images (tâches avec 'cache')")
+@click.option("--image-budget", default=20 * 1024**3, show_default=True, help="Taille max du cache d'images en octets")
+@click.option("--metrics", "metrics_path", default=None, help="Fichier de métriques (.prom: texte Prometheus, .json: JSON)")
+def batch(jobfile: str, workers: int, max_writers: int, bwlimit: int, min_write_speed: int, image_store: Optional[str], image_budget: int, metrics_path: Optional[str]) -> None:
+    """Exécute les copies décrites dans un fichier de tâches (JSON ou TOML)
+    """
+    from utils import running_as_root
+    from copier import IOLimits
+    from jobs import JobError, load_job_file, run_jobs, summarize
+    from probe import ProbeRules
+    from imagestore import ImageStore, DEFAULT_STORE_DIR
+    from metrics import Exporter
+
+    if not running_as_root():
+        raise click.ClickException("Doit être exécuté en tant que root (sudo)")
+
+    try:
+        jobs = load_job_file(jobfile)
+    except (JobError, ValueError) as e:
+        raise click.ClickException("Fichier de tâches invalide: {}".format(e))
+
+    store = None
+    if any(job.cache for job in jobs):
+        store = ImageStore(image_store or DEFAULT_STORE_DIR, budget=image_budget)
+
+    exporter = Exporter(metrics_path).start() if metrics_path else None
+
+    try:
+        results = run_jobs(jobs, workers=workers, limits=IOLimits(max_writers, bwlimit), probe_rules=ProbeRules(min_write_bps=min_write_speed), store=store)
+    finally:
+        if exporter:
+            exporter.stop()
+
+    for result in results:
+        print(result)
+    print(summarize(results))
+
+    if not all(result.ok for result in results):
+        sys.exit(1)
+
+
 intro_string = """Copie le contenu du répertoire spécifié sur le support amovible sélectionné. Le support de destination sera formaté selon le format spécifié. Le support sera partitionné s'il comprend plus d'une partition.
 
 Exécuter "help" pour afficher la liste des commandes.
@@ -58,16 +200,22 @@ class Wcp(cmd.Cmd):
         self._device: str = ""
         self._dirpath: str = ""
         self._format: bool = True
+        self._dedup: bool = False
         self._fstype = "ext2"
+        self._jobs: Optional['BackgroundJobs'] = None
 
         self.intro += self._get_params()
 
 
     def default(self, arg: str) -> Optional[bool]:
         if arg == "EOF":
-            # ctrl+d, on quitte
+            # ctrl+d ou fin des commandes lues sur un tube: on quitte une fois les copies terminées.
+            # Jamais 'False' ici: cmdloop relirait aussitôt EOF, indéfiniment
             self.stdout.write("\n")
-            return True
+            if self._jobs and self._jobs.active():
+                self.stdout.write("Attente de la fin des copies en cours...\n")
+                self.do_wait("")
+            return self.do_quit("")
 
         print("Commande inconnue: {}".format(arg))
 
@@ -94,6 +242,9 @@ class Wcp(cmd.Cmd):
         if len(arg) and arg not in path_list:
             self.stdout.write("La cible de la copie doit être le chemin (ex: /dev/sdb) d'un support amovible connecté.\nFaire \"devices\" pour afficher une liste.\n")
 
+        elif len(arg) and arg in self._busy_paths():
+            self.stdout.write("{} est la cible d'une copie en cours. Faire \"jobs\" pour afficher les copies.\n".format(arg))
+
         else:
             self._device = arg
 
@@ -121,10 +272,12 @@ class Wcp(cmd.Cmd):
         if len(splitted) == 1:
             abs_path = os.path.abspath(splitted[0])
 
-            if os.path.isdir(abs_path):
+            from archive import is_archive
+
+            if os.path.isdir(abs_path) or is_archive(abs_path):
                 self._dirpath = abs_path
             else:
-                self.stdout.write("La source doit être un répertoire.\n")
+                self.stdout.write("La source doit être un répertoire ou une archive (tar, tar.gz, tar.xz, tar.zst, zip).\n")
                 return
 
         self._print_param("_dirpath")
@@ -133,7 +286,7 @@ class Wcp(cmd.Cmd):
     def help_src(self) -> str:
         """Aide longue de do_src
         """
-        help_txt = "Sélectionne ou affiche la source sélectionnée.\n\nUsage: src CHEMIN\n\n  CHEMIN est le chemin du répertoire à copier.\n  Si aucun argument n'est donné, la source actuellement sélectionnée est affichée.\n"
+        help_txt = "Sélectionne ou affiche la source sélectionnée.\n\nUsage: src CHEMIN\n\n  CHEMIN est le chemin du répertoire ou de l'archive à copier. Une archive est lue en flux, sans extraction préalable.\n  Si aucun argument n'est donné, la source actuellement sélectionnée est affichée.\n"
 
         return help_txt
 
@@ -147,10 +300,19 @@ class Wcp(cmd.Cmd):
         self.stdout.write("Formater le support: {}\n".format(option))
 
 
+    def do_dedup(self, arg: str) -> None:
+        """Bascule le dédoublonnage: fichiers identiques écrits une fois puis liés (ext uniquement).
+        """
+        self._dedup = not(self._dedup)
+        option = "Oui" if self._dedup else "Non"
+
+        self.stdout.write("Dédoublonner les fichiers identiques: {}\n".format(option))
+
+
     def do_fstype(self, arg: str) -> None:
         """Sélectionne ou affiche le type de système de fichier utilisé pour formater le support.
         """
-        fstypes = ["ext2", "ext3", "ext4"]
+        fstypes = ["ext2", "ext3", "ext4", "vfat", "exfat"]
 
         if not arg in fstypes:
             self.stdout.write("Le système de fichier doit être de l'un des types suivants: {}\n".format(" ".join(fstypes)))
@@ -163,7 +325,9 @@ class Wcp(cmd.Cmd):
     def _get_params(self) -> str:
         _format = "Oui" if self._format else "Non"
 
-        params_txt = """Paramètres actuels de la copie:\n  Source: {source}\n  Destination: {destination}\n  Formater le support: {formater}\n  Système de fichier: {fstype}\n""".format(source=self._dirpath, destination=self._device, formater=_format, fstype=self._fstype)
+        _dedup = "Oui" if self._dedup else "Non"
+
+        params_txt = """Paramètres actuels de la copie:\n  Source: {source}\n  Destination: {destination}\n  Formater le support: {formater}\n  Système de fichier: {fstype}\n  Dédoublonner: {dedup}\n""".format(source=self._dirpath, destination=self._device, formater=_format, fstype=self._fstype, dedup=_dedup)
 
         return params_txt
 
@@ -175,7 +339,7 @@ class Wcp(cmd.Cmd):
 
 
     def do_copy(self, arg: str) -> None:
-        """Réalise l'opération de copie avec les paramètres choisis.
+        """Lance la copie avec les paramètres choisis, en arrière-plan.
         """
         params_ok = True
 
@@ -188,23 +352,126 @@ class Wcp(cmd.Cmd):
             params_ok = False
 
         if params_ok:
+            from utils import running_as_root
+            from jobs import BackgroundJobs, Job, JobError
+
+            if not running_as_root():
+                self.stdout.write("La copie doit être exécutée en tant que root (sudo).\n")
+                return
+
             self.stdout.write(self._get_params())
             res = input("\nT'es sûr de vouloir faire ça? [o/N] ")
 
             if res in ["o", "O", "y", "Y"]:
-                self.stdout.write("Allons-y alors! Démarrage de la copie...\n")
-                self.stdout.write("Copie effectuée sans encombre!\n")
+                if self._jobs is None:
+                    self._jobs = BackgroundJobs()
+
+                job = Job(self._dirpath, self._device, fstype=self._fstype, format=self._format, dedup=self._dedup)
+
+                try:
+                    background = self._jobs.submit(job, self._device)
+                except JobError as e:
+                    self.stdout.write("Copie impossible: {}\n".format(e))
+                    return
+
+                self.stdout.write("Copie lancée en arrière-plan: tâche {}. Faire \"jobs\" pour suivre son avancement.\n".format(background.id))
             else:
                 self.stdout.write("Abandon.\n")
 
     def help_copy(self) -> str:
-        help_txt = "Réalise l'opération de copie avec les paramètres choisis. Les paramètres sont affichés et une confirmation est demandée.\n"
+        help_txt = "Lance la copie avec les paramètres choisis. Les paramètres sont affichés et une confirmation est demandée.\nLa copie s'exécute en arrière-plan: le shell reste disponible pour préparer et lancer d'autres copies.\n"
 
         return help_txt
 
+
+    def _busy_paths(self) -> List[str]:
+        return self._jobs.busy_paths() if self._jobs else []
+
+
+    def _get_job_id(self, arg: str) -> Optional[int]:
+        """Numéro de tâche donné en argument, 'None' (et un message) s'il est invalide
+        """
+        try:
+            id = int(arg)
+        except ValueError:
+            self.stdout.write("Numéro de tâche invalide: {}\n".format(arg))
+            return None
+
+        if self._jobs is None or self._jobs.get(id) is None:
+            self.stdout.write("Pas de tâche {}\n".format(id))
+            return None
+
+        return id
+
+
+    def do_jobs(self, arg: str) -> None:
+        """Liste les copies lancées et leur état.
+        """
+        if not self._jobs or not self._jobs.get_all():
+            self.stdout.write("Aucune copie lancée.\n")
+            return
+
+        for background in self._jobs.get_all():
+            self.stdout.write("{}\n".format(background))
+
+
+    def do_status(self, arg: str) -> None:
+        """Affiche le détail d'une copie: status NUMÉRO.
+        """
+        id = self._get_job_id(arg.strip())
+        if id is None:
+            return
+
+        background = self._jobs.get(id)
+        self.stdout.write("{}\n".format(background))
+
+        if background.result.stats:
+            self.stdout.write("  {}\n".format(background.result.stats))
+        if background.result.error:
+            self.stdout.write("  Erreur: {}\n".format(background.result.error))
+
+
+    def do_wait(self, arg: str) -> None:
+        """Attend la fin d'une copie (wait NUMÉRO) ou de toutes les copies en cours (wait).
+        """
+        id = None
+        if arg.strip():
+            id = self._get_job_id(arg.strip())
+            if id is None:
+                return
+
+        if self._jobs is None:
+            return
+
+        for background in self._jobs.wait(id):
+            self.stdout.write("{}\n".format(background))
+
+
+    def do_cancel(self, arg: str) -> None:
+        """Annule une copie: cancel NUMÉRO.
+        """
+        id = self._get_job_id(arg.strip())
+        if id is None:
+            return
+
+        if self._jobs.cancel(id):
+            self.stdout.write("Annulation de la tâche {} demandée.\n".format(id))
+        else:
+            self.stdout.write("La tâche {} est déjà terminée.\n".format(id))
+
+
     def do_quit(self, arg: str) -> bool:
-        """Quitte l'application.
+        """Quitte l'application. "quit -f" annule les copies en cours.
         """
+        active = self._jobs.active() if self._jobs else []
+
+        if active and arg.strip() != "-f":
+            self.stdout.write("{} copie(s) en cours. Faire \"wait\" pour attendre leur fin, ou \"quit -f\" pour les annuler.\n".format(len(active)))
+            return False
+
+        if self._jobs:
+            self._jobs.shutdown(cancel=True)
+
         return True
 
 
@@ -276,5 +543,6 @@ if __name__ == "__main__":
     if len(sys.argv) > 1:
         cli()
     else:
+        import readline #! pour historique etc
         test = Wcp()
         test.cmdloop()
@@ -8,28 +8,50 @@
 # TODO: faire des tests
 # TODO: décidement essayer de comprendre ce qui se passe avec label de type gpt
 
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
 
 import subprocess
 import os
 import time
+import fcntl
+import struct
 
-import parted
-from parted import Device, Disk, Partition, Geometry
+from lsblk import Partition as LsblkPartition, get_block_devices, invalidate_cache, read_sysfs_int
+from utils import get_logger, sudo_exec_as_normal_user, run_command, running_as_root, LazyModule
+import mounts
 
-from lsblk import BlockDevices, Partition as LsblkPartition
-from utils import get_logger, sudo_exec_as_normal_user
+if TYPE_CHECKING:
+    from parted import Device, Disk, Partition, Geometry
+
+# pyparted (libparted) n'est chargé qu'à la première manipulation d'un support
+parted = LazyModule("parted")
 
 
 logger = get_logger("wildcopy", "INFO")
 
 ROOT_MOUNTPOINT = "/"
 MKE2FS_FILESYSTEMS = ["ext2", "ext3", "ext4"]
+FAT_FILESYSTEMS = ["vfat", "exfat"]
+SUPPORTED_FILESYSTEMS = MKE2FS_FILESYSTEMS + FAT_FILESYSTEMS
+# type de système de fichiers parted, qui détermine l'id de partition msdos (0x0c FAT32 LBA, 0x07 exFAT/NTFS)
+PARTED_FS_TYPES = {"vfat": "fat32", "exfat": "ntfs"}
+FAT_LABEL_MAX = 11
+FAT_SECTOR_SIZE = 512 # à défaut de queue/logical_block_size (4096 sur les supports 4Kn)
+FAT32_MIN_CLUSTERS = 65525
+DEFAULT_ERASE_BLOCK = 4 * 1024 * 1024 # taille de bloc d'effacement courante des clés, si le noyau n'en dit rien
+CLUSTER_SIZES = {"vfat": [4096 * 2**i for i in range(4)],     # 4 KiB .. 32 KiB (au-delà, mal supporté)
+                 "exfat": [4096 * 2**i for i in range(9)]}    # 4 KiB .. 1 MiB
+MAX_CLUSTER_SLACK = 0.05 # part max de la charge perdue en fin de clusters
 DEFAULT_FSTYPE = "ext4"
 DEFAULT_LABEL = "msdos"
 DEFAULT_MODE = 0o777
 DEFAULT_PART_LABEL = "Partition1"
 
+# ioctl (linux/fs.h)
+BLKRRPART = 0x125f      # _IO(0x12, 95): relire la table des partitions
+BLKDISCARD = 0x1277     # _IO(0x12, 119): discard d'une plage (début, longueur) en octets
+SIGNATURE_WIPE_SIZE = 1024 * 1024 # zone effacée en début et fin de support et en début de chaque partition
+
 
 class NotRemovable(Exception):
     """N'est pas un média amovible.
@@ -52,28 +74,143 @@ class PartitionExists(Exception):
     """Il existe déjà une ou plusieurs partitions
     """
 
+class DeviceBusy(Exception):
+    """Le support est utilisé par ailleurs (partition montée...)
+    """
+
+class UnsupportedFilesystem(Exception):
+    """Type de système de fichiers non supporté
+    """
+
+
+def erase_block_size(device_name: str) -> int:
+    """Taille du bloc d'effacement de la mémoire flash telle qu'exposée par le noyau
+    (granularité du discard, taille d'E/S optimale), DEFAULT_ERASE_BLOCK à défaut
+    """
+    for attr in ["queue/discard_granularity", "queue/optimal_io_size"]:
+        size = read_sysfs_int(device_name, attr)
+        if size >= 64 * 1024:
+            return size
+
+    return DEFAULT_ERASE_BLOCK
+
+
+def logical_block_size(device_name: str) -> int:
+    """Taille de secteur logique du support, celle que mkfs.vfat compte dans '-s'
+    """
+    return read_sysfs_int(device_name, "queue/logical_block_size") or FAT_SECTOR_SIZE
+
+
+def choose_cluster_size(fstype: str, file_sizes: List[int], partition_size: int, erase_block: int=DEFAULT_ERASE_BLOCK) -> int:
+    """Plus grande taille de cluster dont la perte en fin de fichiers reste sous MAX_CLUSTER_SLACK
+    de la charge: grands clusters pour la vidéo, petits pour beaucoup de petits fichiers.
+    Jamais plus grande que le bloc d'effacement, et FAT32 garde au moins FAT32_MIN_CLUSTERS clusters.
+    0 si la partition est trop petite pour FAT32 (voir fat32_fits): mkfs.vfat choisit alors seul
+    """
+    slack = {size: sum(-file_size % size for file_size in file_sizes) for size in CLUSTER_SIZES[fstype]}
+
+    return cluster_size_for_slack(fstype, sum(file_sizes), slack, partition_size, erase_block)
+
+
+def cluster_size_for_slack(fstype: str, payload: int, slack: Dict[int, int], partition_size: int, erase_block: int=DEFAULT_ERASE_BLOCK) -> int:
+    """Comme choose_cluster_size, d'après la charge et la perte par taille de cluster déjà
+    comptées (voir scanner.TreeScanner)
+    """
+    candidates = [size for size in CLUSTER_SIZES[fstype] if size <= erase_block]
+
+    if fstype == "vfat":
+        if not fat32_fits(partition_size):
+            logger.debug("Partition de {} octets trop petite pour FAT32".format(partition_size))
+            return 0
+
+        candidates = [size for size in candidates if partition_size // size >= FAT32_MIN_CLUSTERS] or candidates[:1]
+
+    chosen = candidates[0]
+
+    for size in candidates:
+        if payload and slack[size] > payload * MAX_CLUSTER_SLACK:
+            break
+
+        chosen = size
+
+    logger.debug("Cluster {}: {} octets ({} octets)".format(fstype, chosen, payload))
+
+    return chosen
+
+
+def fat32_fits(partition_size: int) -> bool:
+    """'True' si la partition peut recevoir un FAT32 valide: au moins FAT32_MIN_CLUSTERS clusters
+    de la plus petite taille proposée (environ 256 MiB). En dessous, FAT12/16
+    """
+    return partition_size // CLUSTER_SIZES["vfat"][0] >= FAT32_MIN_CLUSTERS
+
+
+def wipe_offsets(size: int, partition_starts: List[int]) -> List[int]:
+    """Débuts des zones de SIGNATURE_WIPE_SIZE octets à effacer sur un support de 'size' octets:
+    début et fin du support (GPT de secours), début de chaque partition. Triés, sans doublons
+    """
+    offsets = {0, max(0, size - SIGNATURE_WIPE_SIZE)}
+    offsets.update(start for start in partition_starts if 0 < start < size)
+
+    return sorted(offsets)
+
+
+def discard_range(fd: int, path: str, start: int, length: int) -> bool:
+    """Discard (BLKDISCARD) de la plage [start, start + length[ de 'fd'. Retourne 'False' si le
+    support ne le permet pas
+    """
+    try:
+        fcntl.ioctl(fd, BLKDISCARD, struct.pack("QQ", start, length))
+    except OSError as e:
+        logger.warning("Discard impossible sur {}: {}".format(path, e))
+        return False
+
+    logger.debug("Discard: {} octets sur {}".format(length, path))
+    return True
+
+
+def wipe_device(fd: int, path: str, size: int, offsets: List[int], discard: bool=True) -> None:
+    """Discard de tout le support si 'discard', puis mise à zéro des zones de signatures
+    aux 'offsets' (voir wipe_offsets). Un échec du discard n'est pas bloquant: les signatures
+    sont effacées dans tous les cas
+    """
+    if discard:
+        discard_range(fd, path, 0, size)
+
+    zeros = bytes(SIGNATURE_WIPE_SIZE)
+    for offset in offsets:
+        os.pwrite(fd, zeros[:size - offset], offset)
+    os.fsync(fd)
+
 
 class PedPartition:
     @classmethod
-    def get_new_partition(cls, device: 'PedDevice') -> Partition:
-        """Retourne une nouvelle partition (parted).
+    def get_new_partition(cls, device: 'PedDevice', fstype: Optional[str]=None) -> 'Partition':
+        """Retourne une nouvelle partition (parted). Pour les systèmes FAT, le type de partition
+        est renseigné pour être reconnu par les autres systèmes d'exploitation
         """
         ped_device: Device = device.get_ped_device()
         ped_disk: Disk = device.get_ped_disk()
 
-        geometry = Geometry(start=1, length=ped_device.getLength() - 1, device=ped_device)
-        partition = Partition(disk=ped_disk, type=parted.PARTITION_NORMAL, geometry=geometry)
+        geometry = parted.Geometry(start=1, length=ped_device.getLength() - 1, device=ped_device)
+
+        if fstype in PARTED_FS_TYPES:
+            filesystem = parted.FileSystem(type=PARTED_FS_TYPES[fstype], geometry=geometry)
+            partition = parted.Partition(disk=ped_disk, type=parted.PARTITION_NORMAL, fs=filesystem, geometry=geometry)
+        else:
+            partition = parted.Partition(disk=ped_disk, type=parted.PARTITION_NORMAL, geometry=geometry)
 
         logger.debug("PedPartition: Nouvelle partition: {}".format(partition))
 
         return partition
 
 
-    def __init__(self, ped_part: Partition, device: 'PedDevice') -> None:
+    def __init__(self, ped_part: 'Partition', device: 'PedDevice') -> None:
         self._device = device
         self._ped_disk: Disk = device.get_ped_disk()
 
         self._ped_part = ped_part
+        self._formatted_fstype: Optional[str] = None
 
         self._lsblk_part: Optional[LsblkPartition] = None
         self._refresh_status()
@@ -88,11 +225,18 @@ class PedPartition:
 
     @property
     def mountpoint(self) -> Optional[str]:
-        """Retourne le point de montage de la partition
+        """Retourne le point de montage de la partition. Connu sans lsblk: montée par ce processus
+        ou d'après mounts.MOUNTINFO
         """
-        self._refresh_status()
+        return mounts.mounted_at(self.path) or mounts.system_mountpoint(self.path)
 
-        return self._lsblk_part.mountpoint if self._lsblk_part else None
+
+    @property
+    def size(self) -> int:
+        """Taille de la partition en octets
+        """
+        geometry = self._ped_part.geometry
+        return geometry.length * geometry.device.sectorSize
 
 
     @property
@@ -111,9 +255,7 @@ class PedPartition:
     def is_mounted(self) -> bool:
         """Retourne 'True' si l partition est montée, 'False' sinon
         """
-        self._refresh_status()
-
-        return self._lsblk_part.is_mounted() if self._lsblk_part else False
+        return self.mountpoint is not None
 
 
     def umount(self) -> None:
@@ -121,18 +263,41 @@ class PedPartition:
         """
         logger.debug("Démontage de {}".format(self.path))
 
-        if self.is_mounted():
-            subprocess.run(["udisksctl", "unmount", "-b", self.path])
+        if mounts.mounted_at(self.path):
+            mounts.umount(self.path)
+            invalidate_cache()
+        elif self.is_mounted():
+            run_command(["udisksctl", "unmount", "-b", self.path])
+            invalidate_cache()
             logger.info("Démonté: {}".format(self.path))
 
 
-    def mount(self) -> str:
-        """Monte la partition si pas encore montée, en utilisant 'udiskctl'. Tente de monter sur l'utilisateur ayant invoqué sudo. Retourne le point de montage
+    def mount(self, fstype: Optional[str]=None) -> str:
+        """Monte la partition si pas encore montée. En root, directement par mount(2) sur
+        mounts.MOUNT_ROOT (voir mounts.py), avec le type 'fstype', celui du dernier formatage
+        ou à défaut celui vu par lsblk. Sinon par 'udiskctl', en tentant de monter sur
+        l'utilisateur ayant invoqué sudo. Retourne le point de montage
         """
         logger.debug("Montage de {}".format(self.path))
 
+        # déjà montée, par ce processus ou ailleurs (udisks, bureau): jamais un second montage
+        if self.is_mounted():
+            return self.mountpoint
+
+        if running_as_root():
+            fstype = fstype or self._formatted_fstype
+            if not fstype:
+                self._refresh_status()
+                fstype = self._lsblk_part.fstype if self._lsblk_part else None
+
+            if fstype:
+                mountpoint = mounts.mount(self.path, fstype)
+                invalidate_cache()
+                return mountpoint
+
         if not self.is_mounted():
             sudo_exec_as_normal_user("udisksctl mount -b {}".format(self.path))
+            invalidate_cache()
             logger.info("{} montée sur {}".format(self.path, self.mountpoint))
 
         return self.mountpoint
@@ -150,6 +315,7 @@ class PedPartition:
 
         self._ped_disk.deletePartition(self._ped_part)
         self._ped_disk.commit()
+        invalidate_cache()
 
         logger.info("Partition supprimée: {}".format(self))
         # supprime de la liste des partitions de ped_disk
@@ -157,11 +323,15 @@ class PedPartition:
 
 
 
-    def format(self, fstype: str, partlabel: Optional[str]=None) -> None:
-        """Formate la partition
+    def format(self, fstype: str, partlabel: Optional[str]=None, cluster_size: Optional[int]=None) -> None:
+        """Formate la partition. 'cluster_size' (octets) ne s'applique qu'à vfat et exfat,
+        voir 'choose_cluster_size'
         """
         logger.info("Formatage de  {}".format(self))
 
+        if fstype not in SUPPORTED_FILESYSTEMS:
+            raise UnsupportedFilesystem("Système de fichiers non supporté: {}".format(fstype))
+
         self._check_before()
 
         if self.is_mounted():
@@ -170,9 +340,29 @@ class PedPartition:
         partlabel = self._get_label(partlabel)
 
         if fstype in MKE2FS_FILESYSTEMS:
-            subprocess.run(["mke2fs", "-t", fstype, "-L", partlabel, "-F", self.path])
-            time.sleep(0.5) # semble nécessaire sinon udisksctl veut pas la monter
-            logger.debug("Partition formatée {}".format(self))
+            run_command(["mke2fs", "-t", fstype, "-L", partlabel, "-F", self.path])
+        elif fstype == "vfat":
+            cmd = ["mkfs.vfat", "-n", partlabel[:FAT_LABEL_MAX].upper()]
+            if fat32_fits(self.size):
+                cmd += ["-F", "32"]
+            if cluster_size:
+                # '-s': secteurs par cluster, en secteurs logiques du support
+                sector_size = logical_block_size(os.path.basename(self._device.path))
+                cmd += ["-s", str(max(1, cluster_size // sector_size))]
+            run_command(cmd + [self.path])
+        elif fstype == "exfat":
+            # exfatprogs: -c taille de cluster, -b alignement de la zone de données (bloc d'effacement)
+            cmd = ["mkfs.exfat", "-L", partlabel[:FAT_LABEL_MAX]]
+            if cluster_size:
+                cmd += ["-c", str(cluster_size)]
+            cmd += ["-b", str(erase_block_size(os.path.basename(self._device.path)))]
+            run_command(cmd + [self.path])
+
+        self._formatted_fstype = fstype
+        invalidate_cache() # fstype, label et uuid ont changé
+
+        time.sleep(0.5) # semble nécessaire sinon udisksctl veut pas la monter
+        logger.debug("Partition formatée {}".format(self))
 
 
     def chmod(self, mode: int=0o777) -> None:
@@ -195,7 +385,7 @@ class PedPartition:
 
 
     def _check_before(self) -> None:
-        if self.mountpoint is ROOT_MOUNTPOINT:
+        if self.mountpoint == ROOT_MOUNTPOINT:
             raise IsRoot("La partition est montée sur la raçine du sytème de fichiers")
 
         if not self.is_created():
@@ -203,11 +393,11 @@ class PedPartition:
 
 
     def _refresh_status(self) -> None:
-        """Rafraîchit les infos de la partition
-        Peut ne pas y en avoir, si partition fraîchement créée
+        """Rafraîchit les infos de la partition, depuis le cache de lsblk (vidé à chaque
+        modification faite ici). Peut ne pas y en avoir, si partition fraîchement créée
         mais pas encore écrite dans la table de partition
         """
-        self._lsblk_part = BlockDevices().get_partition_by_path(self.path)
+        self._lsblk_part = get_block_devices().get_partition_by_path(self.path)
 
 
     def _get_label(self, partlabel: Optional[str]) -> str:
@@ -237,7 +427,7 @@ class PedDevice:
 
         logger.debug("PedDevice: path: {} _force_creation: {}".format(self.path, self._force_creation))
 
-        self._lsblk_dev = BlockDevices().get_by_path(self.path)
+        self._lsblk_dev = get_block_devices().get_by_path(self.path)
 
         if not self._lsblk_dev.is_removable():
             msg = "{} n'est pas un media amovible. Interruption.".format(self._lsblk_dev.path)
@@ -253,6 +443,13 @@ class PedDevice:
         self._get_disk_and_partitions()
 
 
+    @property
+    def size(self) -> int:
+        """Taille du support en octets
+        """
+        return self._lsblk_dev.size
+
+
     def get_partitions(self) -> List[PedPartition]:
         """Retourne la liste des partition
         """
@@ -269,9 +466,10 @@ class PedDevice:
         return None
 
 
-    def partition_device(self) -> PedPartition:
+    def partition_device(self, fstype: Optional[str]=None) -> PedPartition:
         """ Démonte et supprime toutes les partition, recrée une table de partition et
-        crée un partition qui prend toute la place disponible sur le media
+        crée un partition qui prend toute la place disponible sur le media.
+        'fstype' renseigne le type de partition pour les systèmes FAT
         """
 
         for partition in self.get_partitions():
@@ -281,21 +479,21 @@ class PedDevice:
         # nouvelle table de partitions
         self._ped_disk = self._get_fresh_disk()
 
-        partition = self._add_new_partition()
+        partition = self._add_new_partition(fstype)
 
         return partition
 
 
-    def format_partition(self, partition: PedPartition, fstype: str, partlabel: Optional[str]=None, mount: bool=True, mode: int=None) -> None:
+    def format_partition(self, partition: PedPartition, fstype: str, partlabel: Optional[str]=None, mount: bool=True, mode: int=None, cluster_size: Optional[int]=None) -> None:
         """ ... Pas de check du mode
         """
         if partition.is_mounted():
             partition.umount()
 
-        partition.format(fstype=fstype, partlabel=partlabel)
+        partition.format(fstype=fstype, partlabel=partlabel, cluster_size=cluster_size)
 
         if mount:
-            partition.mount()
+            partition.mount(fstype)
 
         mode = mode if mode else DEFAULT_MODE
 
@@ -305,13 +503,50 @@ class PedDevice:
             pass
 
 
-    def get_ped_device(self) -> Device:
+    def fast_reset(self, discard: bool=True) -> None:
+        """Remise à zéro rapide: démonte les partitions, envoie un discard (TRIM) sur tout le support
+        s'il le supporte, puis efface les signatures des tables de partitions et des systèmes de fichiers.
+        Le support se retrouve sans table de partitions, prêt pour 'partition_device'.
+        """
+        logger.info("Remise à zéro rapide de {}".format(self.path))
+
+        for partition in self.get_partitions():
+            partition._check_before()
+            partition.umount()
+
+        size = self._lsblk_dev.size
+        offsets = wipe_offsets(size, [part.start for part in self._lsblk_dev.get_partitions()])
+
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_EXCL)
+        except OSError as e:
+            raise DeviceBusy("Impossible d'ouvrir {} en exclusif: {}".format(self.path, e))
+
+        try:
+            wipe_device(fd, self.path, size, offsets, discard=discard and self._lsblk_dev.supports_discard())
+
+            try:
+                fcntl.ioctl(fd, BLKRRPART)
+            except OSError as e:
+                logger.debug("BLKRRPART sur {}: {}".format(self.path, e))
+        finally:
+            os.close(fd)
+
+        # Plus de table de partitions: on repart d'un disque vierge
+        invalidate_cache()
+        self._ped_disk = self._get_fresh_disk()
+        self._partitions = list()
+
+        logger.info("Support remis à zéro: {}".format(self.path))
+
+
+    def get_ped_device(self) -> 'Device':
         """Retourne le 'device' parted sous-jacent
         """
         return self._ped_dev
 
 
-    def get_ped_disk(self) -> Disk:
+    def get_ped_disk(self) -> 'Disk':
         """Retourne le 'disk' parted sous-jacent
         """
         return self._ped_disk
@@ -323,16 +558,17 @@ class PedDevice:
         return self._lsblk_dev.is_removable()
 
 
-    def _add_new_partition(self) -> PedPartition:
+    def _add_new_partition(self, fstype: Optional[str]=None) -> PedPartition:
         """Crée et ajoute un partition unique à une table de partitions vide.
         """
         if len(self.get_partitions()):
             raise Exception("Impossible de créer une partition unique s'il y a déjà des partitions.")
 
-        ped_part = PedPartition.get_new_partition(self)
+        ped_part = PedPartition.get_new_partition(self, fstype)
 
         self._ped_disk.addPartition(ped_part, self._ped_dev.optimalAlignedConstraint)
         self._ped_disk.commit()
+        invalidate_cache()
 
         logger.info("Partition ajoutée à la table des partitions: {}".format(ped_part))
         # On rafraîchir après ajout pour avoir nouvelle liste des partitions
@@ -344,7 +580,7 @@ class PedDevice:
         return new_partition
 
 
-    def _get_fresh_disk(self) -> Disk:
+    def _get_fresh_disk(self) -> 'Disk':
         """Retourne une nouvelle instance de Disk (parted). A pour effet d'écraser la table de partition
         """
         logger.debug("Création d'une nouvelle table de partitions")
@@ -387,7 +623,7 @@ def partition_formatatage_rapide_sdb(device_path: Optional[str]=None) -> None:
         ped_disk = parted.newDisk(ped_dev)
         for partition in ped_disk.partitions:
             print("Démontage de {}".format(partition.path))
-            subprocess.run(["udisksctl", "unmount", "-b", partition.path])
+            run_command(["udisksctl", "unmount", "-b", partition.path])
 
         # faut supprimer toutes les partitions avant de faire freshDisk, sinon plus rien
         print("Suppression de toutes les partitions")
@@ -409,12 +645,12 @@ def partition_formatatage_rapide_sdb(device_path: Optional[str]=None) -> None:
 
 
     print("Formatage de la partition {}".format(new_part.path))
-    subprocess.run(["mke2fs", "-t", fstype, "-L", partlabel, "-F", new_part.path])
+    run_command(["mke2fs", "-t", fstype, "-L", partlabel, "-F", new_part.path])
 
 
     print("Montage")
     time.sleep(0.5) # semble nécessaire
-    subprocess.run(["udisksctl", "mount", "-b", new_part.path])
+    run_command(["udisksctl", "mount", "-b", new_part.path])
 
 
 if __name__ == "__main__":